@@ -0,0 +1,370 @@
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'src')
+RESULTS = os.path.join(ROOT, 'bench', 'results')
+
+# First reading of the seeded data, the following ones are an hour apart for every city
+SEED_START = datetime.datetime(2020, 1, 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Seed a local Postgres, start the API against it and load it')
+    parser.add_argument('--db-host', default=os.environ.get('DB_HOST', 'localhost'))
+    parser.add_argument('--db-name', default=os.environ.get('DB_NAME', 'measurements'))
+    parser.add_argument('--db-user', default=os.environ.get('DB_USER', 'pgsql'))
+    parser.add_argument('--db-password', default=os.environ.get('DB_PASSWORD', 'pgsql'))
+
+    parser.add_argument('--seed', action='store_true', help='empty the database and seed it again')
+    parser.add_argument('--countries', type=int, default=200)
+    parser.add_argument('--cities', type=int, default=50000)
+    parser.add_argument('--readings', type=int, default=10000000)
+    parser.add_argument('--seed-batch', type=int, default=1000000, help='readings inserted per statement')
+
+    parser.add_argument('--server-mode', default='flask', choices=('flask', 'async', 'production'))
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-server', action='store_true', help='load an API that is already running')
+
+    parser.add_argument('--workload', default='mixed', choices=('mixed', 'read', 'write', 'endpoints'),
+                        help='endpoints loads every scenario alone, to tell their memory use apart')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load, per scenario for endpoints')
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--label', default='', help='saved with the results, to tell runs apart')
+    parser.add_argument('--compare', default=None, help='results file of an earlier run to compare with')
+    return parser.parse_args()
+
+
+def connect(args):
+    return psycopg2.connect(host=args.db_host, database=args.db_name, user=args.db_user,
+                            password=args.db_password)
+
+
+# Replace the contents of the database with generated countries, cities and readings.
+# Every row is generated by Postgres, so that volumes of hundreds of millions of readings
+# don't go through the client.
+def seed(args):
+    conn = connect(args)
+    conn.autocommit = True
+    cur = conn.cursor()
+    # Seeded readings are not pushed to the live feed
+    cur.execute("SELECT set_config('temperaturi.import', 'on', false);")
+
+    print('Seeding ' + str(args.countries) + ' countries, ' + str(args.cities) + ' cities, ' +
+          str(args.readings) + ' readings')
+    cur.execute('TRUNCATE Tari, Orase, Temperaturi, Agregate_Ore, Agregate_Zile, Segmente_Arhiva RESTART IDENTITY;')
+    cur.execute("INSERT INTO Tari(nume_tara, latitudine, longitudine) "
+                "SELECT 'Tara ' || i, random() * 180 - 90, random() * 360 - 180 "
+                "FROM generate_series(1, %(countries)s) i;", {'countries': args.countries})
+    cur.execute("INSERT INTO Orase(id_tara, nume_oras, latitudine, longitudine) "
+                "SELECT 1 + i %% %(countries)s, 'Oras ' || i, random() * 180 - 90, random() * 360 - 180 "
+                "FROM generate_series(1, %(cities)s) i;", {'countries': args.countries, 'cities': args.cities})
+
+    # Reading k belongs to city k mod cities, so that (city, timestamp) stays unique
+    for low in range(0, args.readings, args.seed_batch):
+        high = min(low + args.seed_batch, args.readings) - 1
+        started = time.time()
+        cur.execute("INSERT INTO Temperaturi(id_oras, valoare, timestamp) "
+                    "SELECT 1 + k %% %(cities)s, round((random() * 60 - 20)::numeric, 1), "
+                    "%(start)s + (k / %(cities)s) * interval '1 hour' "
+                    "FROM generate_series(%(low)s, %(high)s) k;",
+                    {'cities': args.cities, 'start': SEED_START, 'low': low, 'high': high})
+        print('  readings ' + str(low) + '-' + str(high) + ' in ' + str(round(time.time() - started, 1)) + 's')
+
+    # TRUNCATE doesn't fire the triggers bumping the table versions, so cached responses are invalidated here
+    cur.execute('UPDATE Versiuni SET versiune = versiune + 1, modificat = now();')
+    cur.execute('ANALYZE;')
+    cur.close()
+    conn.close()
+
+
+# Ids and time range of the seeded data, used to build realistic requests
+def read_dataset(args):
+    conn = connect(args)
+    cur = conn.cursor()
+    cur.execute('SELECT array_agg(id) FROM Tari;')
+    countries = cur.fetchone()[0] or []
+    cur.execute('SELECT id, latitudine, longitudine FROM Orase;')
+    cities = cur.fetchall()
+    cur.execute('SELECT min(timestamp), max(timestamp) FROM Temperaturi;')
+    first, last = cur.fetchone()
+    cur.close()
+    conn.close()
+
+    if not countries or not cities:
+        sys.exit('The database is empty, run with --seed first')
+    return {'countries': countries, 'cities': cities, 'first': first or SEED_START, 'last': last or SEED_START}
+
+
+def random_day(data):
+    span = max((data['last'] - data['first']).days, 1)
+    return (data['first'] + datetime.timedelta(days=random.randrange(span))).strftime('%Y-%m-%d')
+
+
+# Requests of the scenarios of TestAPI.json, as (name, weight, kind, build) tuples where build
+# returns the method, path and body of a request for the seeded data
+def scenarios(data):
+    def city():
+        return random.choice(data['cities'])
+
+    def new_temperature():
+        return {'idOras': city()[0], 'valoare': round(random.uniform(-20, 40), 1)}
+
+    return [
+        ('GET /api/countries', 5, 'read', lambda: ('GET', '/api/countries', None)),
+        ('GET /api/cities?limit=100', 5, 'read', lambda: ('GET', '/api/cities?limit=100', None)),
+        ('GET /api/cities/country/{id}', 10, 'read',
+         lambda: ('GET', '/api/cities/country/' + str(random.choice(data['countries'])), None)),
+        ('GET /api/temperatures?lat&lon', 15, 'read',
+         lambda: ('GET', '/api/temperatures?lat=%s&lon=%s&limit=1000' % city()[1:], None)),
+        ('GET /api/temperatures?from&until', 10, 'read',
+         lambda: ('GET', '/api/temperatures?from=%s&until=%s&limit=1000' % ((random_day(data),) * 2), None)),
+        ('GET /api/temperatures/cities/{id}', 20, 'read',
+         lambda: ('GET', '/api/temperatures/cities/' + str(city()[0]) + '?limit=1000', None)),
+        ('GET /api/temperatures/countries/{id}', 10, 'read',
+         lambda: ('GET', '/api/temperatures/countries/' + str(random.choice(data['countries'])) + '?limit=1000',
+                  None)),
+        ('GET /api/temperatures/stats', 5, 'read',
+         lambda: ('GET', '/api/temperatures/stats?city=' + str(city()[0]) + '&granularity=day', None)),
+        ('POST /api/temperatures', 15, 'write', lambda: ('POST', '/api/temperatures', new_temperature())),
+        ('POST /api/temperatures/batch', 5, 'write',
+         lambda: ('POST', '/api/temperatures/batch', [new_temperature() for _ in range(100)])),
+    ]
+
+
+class Recorder:
+    # Latencies, statuses and sizes of the responses of every scenario
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, name, latency, status, size):
+        with self.lock:
+            self.samples.setdefault(name, []).append((latency, status, size))
+
+
+class MemorySampler(threading.Thread):
+    # Resident memory of a process and its children, sampled until stopped
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def processes(self, pid):
+        pids = [pid]
+        try:
+            for task in os.listdir('/proc/' + str(pid) + '/task'):
+                with open('/proc/' + str(pid) + '/task/' + task + '/children') as f:
+                    for child in f.read().split():
+                        pids.extend(self.processes(int(child)))
+        except OSError:
+            pass
+        return pids
+
+    # Resident memory in kB, or None if it can't be read
+    def rss(self):
+        total = 0
+        for pid in self.processes(self.pid):
+            try:
+                with open('/proc/' + str(pid) + '/status') as f:
+                    total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            except (OSError, StopIteration):
+                pass
+        return total or None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = self.rss()
+            if rss:
+                self.samples.append(rss)
+
+    def take(self):
+        samples, self.samples = self.samples, []
+        if not samples:
+            return None
+        return {'peak_kb': max(samples), 'mean_kb': round(sum(samples) / len(samples))}
+
+
+# Send requests of the given scenarios, picked by weight, until the deadline
+def worker(args, chosen, deadline, recorder):
+    conn = http.client.HTTPConnection('localhost', args.port, timeout=60)
+    names = [scenario[0] for scenario in chosen]
+    weights = [scenario[1] for scenario in chosen]
+    builders = {scenario[0]: scenario[3] for scenario in chosen}
+
+    while time.time() < deadline:
+        name = random.choices(names, weights)[0]
+        method, path, body = builders[name]()
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, payload, headers)
+            response = conn.getresponse()
+            size = len(response.read())
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection('localhost', args.port, timeout=60)
+            size, status = 0, 0
+        recorder.add(name, time.perf_counter() - started, status, size)
+    conn.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(samples, duration):
+    latencies = sorted(latency for latency, _, _ in samples)
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, status, _ in samples if status == 0 or status >= 500),
+        'rps': round(len(samples) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_bytes': round(sum(size for _, _, size in samples) / len(samples)),
+    }
+
+
+# Load the API with the chosen scenarios for the given duration, returning the summary of each
+def load(args, chosen, duration, sampler):
+    recorder = Recorder()
+    if sampler:
+        sampler.take()
+
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=worker, args=(args, chosen, deadline, recorder))
+               for _ in range(args.concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    memory = sampler.take() if sampler else None
+    results = {name: summarize(samples, elapsed) for name, samples in recorder.samples.items()}
+    everything = [sample for samples in recorder.samples.values() for sample in samples]
+    if everything:
+        results['total'] = summarize(everything, elapsed)
+        results['total']['memory'] = memory
+    return results
+
+
+def start_server(args):
+    env = dict(os.environ, SERVER_MODE=args.server_mode, DB_HOST=args.db_host, DB_NAME=args.db_name,
+               DB_USER=args.db_user, DB_PASSWORD=args.db_password)
+    server = subprocess.Popen([sys.executable, 'main.py'], cwd=SRC, env=env)
+
+    # Wait for the API to answer before loading it
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('localhost', args.port, timeout=1)
+            conn.request('GET', '/api/countries')
+            conn.getresponse().read()
+            conn.close()
+            return server
+        except (OSError, http.client.HTTPException):
+            if server.poll() is not None:
+                sys.exit('The API exited with status ' + str(server.returncode))
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit('The API did not start')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, previous=None):
+    print('%-40s %9s %7s %9s %9s %9s %9s' % ('endpoint', 'rps', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'peak MB'))
+    for name, result in sorted(results.items()):
+        memory = result.get('memory')
+        print('%-40s %9s %7s %9s %9s %9s %9s' % (
+            name, result['rps'], result['errors'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            round(memory['peak_kb'] / 1024) if memory else '-'))
+
+        # Change against the earlier run, as a percentage of its value
+        if previous and name in previous:
+            deltas = []
+            for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if previous[name][key]:
+                    deltas.append('%+.1f%%' % ((result[key] - previous[name][key]) * 100 / previous[name][key]))
+                else:
+                    deltas.append('-')
+            print('%-40s %9s %7s %9s %9s %9s' % ('  vs earlier run', deltas[0], '', *deltas[1:]))
+
+
+def main():
+    args = parse_args()
+    if args.seed:
+        seed(args)
+    data = read_dataset(args)
+
+    chosen = scenarios(data)
+    if args.workload in ('read', 'write'):
+        chosen = [scenario for scenario in chosen if scenario[2] == args.workload]
+
+    server = None if args.no_server else start_server(args)
+    sampler = MemorySampler(server.pid) if server else None
+    if sampler:
+        sampler.start()
+
+    try:
+        if args.warmup:
+            load(args, chosen, args.warmup, sampler)
+
+        if args.workload == 'endpoints':
+            results = {}
+            for scenario in chosen:
+                result = load(args, [scenario], args.duration, sampler)
+                results[scenario[0]] = dict(result[scenario[0]], memory=result['total']['memory'])
+        else:
+            results = load(args, chosen, args.duration, sampler)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    report(results, previous)
+
+    os.makedirs(RESULTS, exist_ok=True)
+    started = datetime.datetime.now()
+    path = os.path.join(RESULTS, started.strftime('%Y%m%d-%H%M%S') + (('-' + args.label) if args.label else '')
+                        + '.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'date': started.isoformat(),
+            'commit': git_commit(),
+            'label': args.label,
+            'settings': {key: value for key, value in vars(args).items() if key != 'db_password'},
+            'results': results
+        }, f, indent=2)
+    print('Results saved to ' + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Let the replica of docker-compose.yml stream the WAL of this database
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -27,3 +27,355 @@ CREATE TABLE IF NOT EXISTS Temperaturi (
     CONSTRAINT FK_id_oras FOREIGN KEY(id_oras)
 	REFERENCES Orase(id) ON DELETE CASCADE ON UPDATE CASCADE
 );
+
+-- Range filters on timestamp, also sorted by id for keyset pagination
+CREATE INDEX IF NOT EXISTS Temperaturi_timestamp ON Temperaturi(timestamp, id);
+-- Coordinates are looked up in the city index of the API, which loads Orase in full
+DROP INDEX IF EXISTS Orase_coordonate;
+
+-- Readings older than the retention horizon, moved out of Temperaturi by arhiveaza_temperaturi().
+-- A segment holds the readings of a city in a month as arrays, which Postgres stores compressed,
+-- along with the time range of its readings so that queries only unpack the segments they need.
+CREATE TABLE IF NOT EXISTS Segmente_Arhiva (
+    id           serial      PRIMARY KEY,
+    id_oras      integer     NOT NULL,
+    inceput      timestamp   NOT NULL,
+    sfarsit      timestamp   NOT NULL,
+    numar        integer     NOT NULL,
+    ids          integer[]   NOT NULL,
+    valori       REAL[]      NOT NULL,
+    timestampuri timestamp[] NOT NULL,
+
+    CONSTRAINT FK_id_oras FOREIGN KEY(id_oras)
+	REFERENCES Orase(id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS Segmente_Arhiva_oras ON Segmente_Arhiva(id_oras, sfarsit);
+CREATE INDEX IF NOT EXISTS Segmente_Arhiva_sfarsit ON Segmente_Arhiva(sfarsit, inceput);
+
+-- Whether the reading of a city at a timestamp was moved to the archive. The UNIQUE (id_oras, timestamp)
+-- constraint of Temperaturi doesn't cover the archive, so inserts skip such readings with this check, which
+-- only unpacks the segments of the city whose time range holds the timestamp.
+CREATE OR REPLACE FUNCTION arhivata(oras integer, moment timestamp) RETURNS boolean AS $$
+    SELECT EXISTS (
+        SELECT 1
+        FROM Segmente_Arhiva s
+        WHERE s.id_oras = oras AND s.sfarsit >= moment AND s.inceput <= moment AND moment = ANY(s.timestampuri)
+    );
+$$ LANGUAGE sql STABLE;
+
+-- Readings of both tiers, unpacking only the segments that overlap [de_la, pana_la] (NULL for no bound).
+-- Being a single SQL statement, it is inlined in the queries selecting from it, so that their filters
+-- on the readings still use the indexes of Temperaturi and Segmente_Arhiva.
+CREATE OR REPLACE FUNCTION temperaturi_toate(de_la timestamp, pana_la timestamp)
+RETURNS TABLE (id integer, valoare REAL, timestamp timestamp, id_oras integer) AS $$
+    SELECT t.id, t.valoare, t.timestamp, t.id_oras
+    FROM Temperaturi t
+    UNION ALL
+    SELECT r.id, r.valoare, r.timestamp, s.id_oras
+    FROM Segmente_Arhiva s, unnest(s.ids, s.valori, s.timestampuri) AS r(id, valoare, timestamp)
+    WHERE (de_la IS NULL OR s.sfarsit >= de_la) AND (pana_la IS NULL OR s.inceput <= pana_la);
+$$ LANGUAGE sql STABLE;
+
+-- Latest timestamp among the first randuri readings after de_la (NULL for no bound) of the given cities
+-- (NULL for every city), as far as the archive tells: once the segments lying entirely after de_la that end
+-- first hold randuri readings, none of these readings is later than the end of the last of them.
+-- NULL if the archive holds fewer readings, or if randuri is NULL. Only the time ranges and counts of the
+-- segments are read, walking them in the order of their end until the count is reached.
+CREATE OR REPLACE FUNCTION orizont_arhiva(de_la timestamp, orase integer[], randuri bigint) RETURNS timestamp AS $$
+    SELECT sfarsit
+    FROM (
+        SELECT s.sfarsit, sum(s.numar) OVER (ORDER BY s.sfarsit) AS cumulat
+        FROM Segmente_Arhiva s
+        WHERE s.sfarsit > coalesce(de_la, '-infinity') AND s.inceput > coalesce(de_la, '-infinity')
+          AND (orase IS NULL OR s.id_oras = ANY(orase))
+    ) s
+    WHERE cumulat >= randuri
+    ORDER BY sfarsit
+    LIMIT 1;
+$$ LANGUAGE sql STABLE;
+
+-- Move the readings older than inainte_de to archive segments, one per city and month,
+-- returning the number of segments created. Their rollups are kept as they are.
+CREATE OR REPLACE FUNCTION arhiveaza_temperaturi(inainte_de timestamp) RETURNS bigint AS $$
+DECLARE
+    segmente bigint;
+BEGIN
+    PERFORM set_config('temperaturi.arhivare', 'on', true);
+
+    WITH vechi AS (
+        DELETE FROM Temperaturi WHERE timestamp < inainte_de
+        RETURNING id, valoare, timestamp, id_oras
+    )
+    INSERT INTO Segmente_Arhiva(id_oras, inceput, sfarsit, numar, ids, valori, timestampuri)
+    SELECT id_oras, min(timestamp), max(timestamp), count(*),
+           array_agg(id ORDER BY timestamp, id),
+           array_agg(valoare ORDER BY timestamp, id),
+           array_agg(timestamp ORDER BY timestamp, id)
+    FROM vechi
+    GROUP BY id_oras, date_trunc('month', timestamp);
+    GET DIAGNOSTICS segmente = ROW_COUNT;
+
+    PERFORM set_config('temperaturi.arhivare', 'off', true);
+    RETURN segmente;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Hourly and daily rollups of the readings of every city, maintained by the triggers below
+CREATE TABLE IF NOT EXISTS Agregate_Ore (
+    id_oras integer          NOT NULL,
+    inceput timestamp        NOT NULL,
+    numar   bigint           NOT NULL,
+    suma    double precision NOT NULL,
+    minim   REAL             NOT NULL,
+    maxim   REAL             NOT NULL,
+
+    PRIMARY KEY (id_oras, inceput),
+    CONSTRAINT FK_id_oras FOREIGN KEY(id_oras)
+	REFERENCES Orase(id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS Agregate_Zile (
+    id_oras integer          NOT NULL,
+    inceput timestamp        NOT NULL,
+    numar   bigint           NOT NULL,
+    suma    double precision NOT NULL,
+    minim   REAL             NOT NULL,
+    maxim   REAL             NOT NULL,
+
+    PRIMARY KEY (id_oras, inceput),
+    CONSTRAINT FK_id_oras FOREIGN KEY(id_oras)
+	REFERENCES Orase(id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS Agregate_Ore_inceput ON Agregate_Ore(inceput);
+CREATE INDEX IF NOT EXISTS Agregate_Zile_inceput ON Agregate_Zile(inceput);
+
+-- New readings are added to the rollups of their hour and day. Rollups are written in (id_oras, inceput)
+-- order, by every function below, so that concurrent batches covering the same cities wait for each other
+-- instead of deadlocking.
+CREATE OR REPLACE FUNCTION adauga_agregate() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO Agregate_Ore AS a(id_oras, inceput, numar, suma, minim, maxim)
+    SELECT id_oras, date_trunc('hour', timestamp), count(*), sum(valoare::double precision), min(valoare), max(valoare)
+    FROM temperaturi_noi
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (id_oras, inceput) DO UPDATE
+    SET numar = a.numar + EXCLUDED.numar,
+        suma  = a.suma + EXCLUDED.suma,
+        minim = least(a.minim, EXCLUDED.minim),
+        maxim = greatest(a.maxim, EXCLUDED.maxim);
+
+    INSERT INTO Agregate_Zile AS a(id_oras, inceput, numar, suma, minim, maxim)
+    SELECT id_oras, date_trunc('day', timestamp), count(*), sum(valoare::double precision), min(valoare), max(valoare)
+    FROM temperaturi_noi
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (id_oras, inceput) DO UPDATE
+    SET numar = a.numar + EXCLUDED.numar,
+        suma  = a.suma + EXCLUDED.suma,
+        minim = least(a.minim, EXCLUDED.minim),
+        maxim = greatest(a.maxim, EXCLUDED.maxim);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Minimum and maximum can't be updated incrementally when readings are removed,
+-- so the rollups of the given (city, hour) pairs are computed again from the readings of both tiers
+CREATE OR REPLACE FUNCTION recalculeaza_agregate(orase integer[], ore timestamp[]) RETURNS void AS $$
+BEGIN
+    PERFORM 1
+    FROM Agregate_Ore a
+    JOIN unnest(orase, ore) AS o(id_oras, inceput) ON a.id_oras = o.id_oras AND a.inceput = o.inceput
+    ORDER BY a.id_oras, a.inceput
+    FOR UPDATE OF a;
+
+    DELETE FROM Agregate_Ore a
+    USING unnest(orase, ore) AS o(id_oras, inceput)
+    WHERE a.id_oras = o.id_oras AND a.inceput = o.inceput;
+
+    INSERT INTO Agregate_Ore(id_oras, inceput, numar, suma, minim, maxim)
+    SELECT t.id_oras, o.inceput, count(*), sum(t.valoare::double precision), min(t.valoare), max(t.valoare)
+    FROM (SELECT DISTINCT * FROM unnest(orase, ore) AS o(id_oras, inceput)) o
+    JOIN temperaturi_toate((SELECT min(h) FROM unnest(ore) h), (SELECT max(h) FROM unnest(ore) h) + interval '1 hour') t
+      ON t.id_oras = o.id_oras AND t.timestamp >= o.inceput AND t.timestamp < o.inceput + interval '1 hour'
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
+
+    PERFORM 1
+    FROM Agregate_Zile a
+    JOIN unnest(orase, ore) AS o(id_oras, inceput) ON a.id_oras = o.id_oras AND a.inceput = date_trunc('day', o.inceput)
+    ORDER BY a.id_oras, a.inceput
+    FOR UPDATE OF a;
+
+    DELETE FROM Agregate_Zile a
+    USING unnest(orase, ore) AS o(id_oras, inceput)
+    WHERE a.id_oras = o.id_oras AND a.inceput = date_trunc('day', o.inceput);
+
+    -- Days are rebuilt from their (at most 24) hourly rollups
+    INSERT INTO Agregate_Zile(id_oras, inceput, numar, suma, minim, maxim)
+    SELECT a.id_oras, o.inceput, sum(a.numar), sum(a.suma), min(a.minim), max(a.maxim)
+    FROM (SELECT DISTINCT o.id_oras, date_trunc('day', o.inceput) AS inceput
+          FROM unnest(orase, ore) AS o(id_oras, inceput)) o
+    JOIN Agregate_Ore a ON a.id_oras = o.id_oras
+                       AND a.inceput >= o.inceput AND a.inceput < o.inceput + interval '1 day'
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sterge_agregate() RETURNS trigger AS $$
+BEGIN
+    -- Readings moved to the archive are still part of their rollups
+    IF current_setting('temperaturi.arhivare', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM recalculeaza_agregate(array_agg(id_oras), array_agg(date_trunc('hour', timestamp)))
+    FROM (SELECT DISTINCT id_oras, date_trunc('hour', timestamp) AS timestamp FROM temperaturi_vechi) v;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION modifica_agregate() RETURNS trigger AS $$
+BEGIN
+    PERFORM recalculeaza_agregate(array_agg(id_oras), array_agg(timestamp))
+    FROM (SELECT id_oras, date_trunc('hour', timestamp) AS timestamp FROM temperaturi_vechi
+          UNION
+          SELECT id_oras, date_trunc('hour', timestamp) FROM temperaturi_noi) v;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement level triggers update the rollups once for a whole multi-row insert
+DROP TRIGGER IF EXISTS Temperaturi_adauga ON Temperaturi;
+CREATE TRIGGER Temperaturi_adauga AFTER INSERT ON Temperaturi
+    REFERENCING NEW TABLE AS temperaturi_noi
+    FOR EACH STATEMENT EXECUTE FUNCTION adauga_agregate();
+
+DROP TRIGGER IF EXISTS Temperaturi_sterge ON Temperaturi;
+CREATE TRIGGER Temperaturi_sterge AFTER DELETE ON Temperaturi
+    REFERENCING OLD TABLE AS temperaturi_vechi
+    FOR EACH STATEMENT EXECUTE FUNCTION sterge_agregate();
+
+DROP TRIGGER IF EXISTS Temperaturi_modifica ON Temperaturi;
+CREATE TRIGGER Temperaturi_modifica AFTER UPDATE ON Temperaturi
+    REFERENCING OLD TABLE AS temperaturi_vechi NEW TABLE AS temperaturi_noi
+    FOR EACH STATEMENT EXECUTE FUNCTION modifica_agregate();
+
+-- Sessions listening on the temperaturi channel, registered by the live feeds of the API
+CREATE TABLE IF NOT EXISTS Ascultatori (
+    pid integer PRIMARY KEY
+);
+
+-- Register the current session as a listener, forgetting the sessions that ended
+CREATE OR REPLACE FUNCTION inregistreaza_ascultator() RETURNS void AS $$
+    DELETE FROM Ascultatori WHERE pid NOT IN (SELECT pid FROM pg_stat_activity);
+    INSERT INTO Ascultatori(pid) VALUES (pg_backend_pid()) ON CONFLICT DO NOTHING;
+$$ LANGUAGE sql;
+
+-- New readings are published on the temperaturi channel, one notification per reading, for the live
+-- feed of the API. Notifications are delivered when the inserting transaction commits.
+-- Every transaction that notifies takes a lock at commit that serializes the commits of the whole cluster,
+-- so readings are only published while a registered listener is connected. Bulk imports, which set
+-- temperaturi.import, publish nothing.
+CREATE OR REPLACE FUNCTION publica_temperaturi() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('temperaturi.import', true) = 'on'
+       OR NOT EXISTS (SELECT 1 FROM Ascultatori a JOIN pg_stat_activity s ON s.pid = a.pid) THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_notify('temperaturi', json_build_object('id', n.id, 'valoare', n.valoare,
+                                                       'timestamp', to_char(n.timestamp, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+                                                       'idOras', n.id_oras, 'idTara', o.id_tara)::text)
+    FROM temperaturi_noi n
+    JOIN Orase o ON o.id = n.id_oras
+    ORDER BY n.timestamp, n.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS Temperaturi_publica ON Temperaturi;
+CREATE TRIGGER Temperaturi_publica AFTER INSERT ON Temperaturi
+    REFERENCING NEW TABLE AS temperaturi_noi
+    FOR EACH STATEMENT EXECUTE FUNCTION publica_temperaturi();
+
+-- Rollups of readings stored before the triggers existed
+INSERT INTO Agregate_Ore(id_oras, inceput, numar, suma, minim, maxim)
+SELECT id_oras, date_trunc('hour', timestamp), count(*), sum(valoare::double precision), min(valoare), max(valoare)
+FROM Temperaturi
+GROUP BY 1, 2
+ON CONFLICT DO NOTHING;
+
+INSERT INTO Agregate_Zile(id_oras, inceput, numar, suma, minim, maxim)
+SELECT id_oras, date_trunc('day', inceput), sum(numar), sum(suma), min(minim), max(maxim)
+FROM Agregate_Ore
+GROUP BY 1, 2
+ON CONFLICT DO NOTHING;
+
+-- Version of every table, bumped by each statement writing to it. Responses use it as their
+-- ETag and Last-Modified validators. Bumps are part of the writing transaction, so a version
+-- becomes visible together with the rows it describes.
+-- The version of a table is the sum of 32 counters (felie), the latest change the latest of their
+-- times. Every connection bumps the counter of its backend, so that concurrent writers don't wait
+-- for each other's commits on a single row lock.
+CREATE TABLE IF NOT EXISTS Versiuni (
+    tabel     VARCHAR(100) NOT NULL,
+    felie     integer      NOT NULL,
+    versiune  bigint       NOT NULL,
+    modificat timestamptz  NOT NULL,
+
+    PRIMARY KEY (tabel, felie)
+);
+
+INSERT INTO Versiuni(tabel, felie, versiune, modificat)
+SELECT tabel, felie, CASE WHEN felie = 0 THEN 1 ELSE 0 END, now()
+FROM unnest(ARRAY['tari', 'orase', 'temperaturi']) AS tabel, generate_series(0, 31) AS felie
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION incrementeaza_versiune() RETURNS trigger AS $$
+BEGIN
+    UPDATE Versiuni
+    SET versiune = versiune + 1, modificat = greatest(modificat, clock_timestamp())
+    WHERE tabel = lower(TG_TABLE_NAME) AND felie = pg_backend_pid() % 32;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS Tari_versiune ON Tari;
+CREATE TRIGGER Tari_versiune AFTER INSERT OR UPDATE OR DELETE ON Tari
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementeaza_versiune();
+
+DROP TRIGGER IF EXISTS Orase_versiune ON Orase;
+CREATE TRIGGER Orase_versiune AFTER INSERT OR UPDATE OR DELETE ON Orase
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementeaza_versiune();
+
+DROP TRIGGER IF EXISTS Temperaturi_versiune ON Temperaturi;
+CREATE TRIGGER Temperaturi_versiune AFTER INSERT OR UPDATE OR DELETE ON Temperaturi
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementeaza_versiune();
+
+-- Text of a REAL value as Python's json module writes the float read back by psycopg2, so that
+-- response bodies rendered by the database match those rendered by the API. Both write the shortest
+-- digits of the value, in scientific notation below 1e-4, but Python only switches to it from 1e16
+-- where Postgres does from 1e6: exponents in between are written in full, from the exact digits of
+-- the text, and integral values keep a trailing '.0'.
+CREATE OR REPLACE FUNCTION valoare_json(valoare REAL) RETURNS text AS $$
+    SELECT CASE WHEN text ~ '^-?[0-9]+$' THEN text || '.0' ELSE text END
+    FROM (
+        SELECT CASE WHEN valoare::text ~ 'e\+(0[6-9]|1[0-5])$' THEN valoare::text::numeric::text
+                    ELSE valoare::text END AS text
+    ) valori;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Progress of the bulk imports of BulkTransfer.py. Every file is split into parts imported in parallel,
+-- each up to the byte offset pozitie, which is updated in the transaction of every batch of the part.
+CREATE TABLE IF NOT EXISTS Importuri (
+    fisier  text    NOT NULL,
+    parte   integer NOT NULL,
+    pozitie bigint  NOT NULL,
+    sfarsit bigint  NOT NULL,
+
+    PRIMARY KEY (fisier, parte)
+);
@@ -0,0 +1,694 @@
+import asyncio
+import contextlib
+import datetime
+import json
+
+import asyncpg
+from aiohttp import web
+
+import Config
+from Cache import Cache
+from Batching import group_rows, parse_ids
+from Cities import Cities, DELETE_QUERY as DELETE_CITY_QUERY, INSERT_QUERY as INSERT_CITY_QUERY, \
+    UPDATE_QUERY as UPDATE_CITY_QUERY
+from CityIndex import CITIES_QUERY, CITIES_VERSION_QUERY, CityIndex
+from Conditional import VERSIONS_QUERY, not_modified, validator_headers
+from Countries import Countries, DELETE_QUERY as DELETE_COUNTRY_QUERY, INSERT_QUERY as INSERT_COUNTRY_QUERY, \
+    UPDATE_QUERY as UPDATE_COUNTRY_QUERY
+from Downsampling import bucket_page, bucket_query, format_buckets, parse_interval
+from LiveFeed import CHANNEL, EVENT_HEADERS, EVENT_STREAM, HEARTBEAT, REGISTER_QUERY, Subscribers, Subscription
+from Formatting import CITY_COLUMNS, COUNTRY_COLUMNS, TEMPERATURE_COLUMNS, format_rows, format_temperatures
+from Pagination import Page
+from QueryBuilder import QueryBuilder, numbered_args
+from ReplicaRouter import READ_METHODS, WRITE_COOKIE, ReplicaSet, parse_hosts
+from Streaming import FORMATS, requested_format, stream_batch, stream_end, stream_start
+from Temperatures import DELETE_QUERY as DELETE_TEMPERATURE_QUERY, INSERT_QUERY as INSERT_TEMPERATURE_QUERY, \
+    UPDATE_QUERY as UPDATE_TEMPERATURE_QUERY, Temperatures
+from TemperaturesBatch import CITIES_QUERY as BATCH_CITIES_QUERY, INSERT_QUERY as INSERT_BATCH_QUERY, TemperaturesBatch
+from TemperaturesCities import TemperaturesCities
+from TemperaturesCountries import TemperaturesCountries
+from TemperaturesStats import GRANULARITIES, TemperaturesStats
+
+PAGE_ARGUMENTS = {'limit': int, 'next': str}
+DATE_ARGUMENTS = {'from': str, 'until': str}
+TEMPERATURE_ARGUMENTS = dict({'stream': str, 'interval': parse_interval}, **DATE_ARGUMENTS, **PAGE_ARGUMENTS)
+
+
+# Parse the query arguments of a request like reqparse does, returning None for missing arguments.
+# Raises HTTPBadRequest if an argument can't be converted to its type or is not one of its choices.
+def parse_args(request, types, choices=None):
+    args = {}
+    for name, parse in types.items():
+        value = request.query.get(name)
+        try:
+            args[name] = parse(value) if value is not None else None
+        except (ValueError, OverflowError):
+            raise web.HTTPBadRequest()
+
+    for name, allowed in (choices or {}).items():
+        if args[name] is not None and args[name] not in allowed:
+            raise web.HTTPBadRequest()
+    return args
+
+
+# Integer parameter of a statement. asyncpg doesn't convert strings or floats like psycopg2 does,
+# so values that Postgres would reject raise ValueError.
+def integer(value):
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(str(value) + ' is not an integer')
+    return int(number)
+
+
+# Bytes of a part of a streamed response, the columnar format being already binary
+def encode(chunk):
+    return chunk if isinstance(chunk, bytes) else chunk.encode()
+
+
+def respond(body, status, headers=None):
+    return web.Response(text=json.dumps(body) + '\n', status=status, headers=headers,
+                        content_type='application/json')
+
+
+class AsyncServer:
+    # Serves the routes of main.py on an asyncio event loop, with asyncpg and its own connection pool.
+    # Request validation and response formatting are those of the Flask resources.
+    def __init__(self, logger):
+        self.logger = logger
+        self.pool = None
+        self.replicas = ReplicaSet(logger, [], Config.DB_REPLICA_RETRY, Config.DB_REPLICA_WAIT)
+        self.cities = CityIndex(logger, Config.CITY_INDEX_CELL_SIZE, Config.CITY_INDEX_REFRESH)
+        self.cities_lock = asyncio.Lock()
+        self.cache = Cache(Config.METADATA_CACHE_SIZE, Config.METADATA_CACHE_TTL)
+        # Live feed subscribers, and the connection listening to the readings published by the database
+        self.feed = Subscribers(logger)
+        self.listener = None
+        self.listener_lock = asyncio.Lock()
+
+        # The resources are only used for their validation and queries, they never touch the database here
+        kwargs = {'logger': logger, 'router': None, 'cities': self.cities, 'cache': self.cache, 'metrics': None,
+                  'writer': None, 'feed': None, 'shards': None}
+        self.countries = Countries(**kwargs)
+        self.city_resource = Cities(**kwargs)
+        self.temperatures = Temperatures(**kwargs)
+        self.batch = TemperaturesBatch(**kwargs)
+        self.temperatures_cities = TemperaturesCities(**kwargs)
+        self.temperatures_countries = TemperaturesCountries(**kwargs)
+        self.stats = TemperaturesStats(**kwargs)
+
+    def app(self):
+        app = web.Application()
+        app.on_startup.append(self.startup)
+        app.on_cleanup.append(self.cleanup)
+        if Config.DB_REPLICA_HOSTS and Config.DB_READ_YOUR_WRITES > 0:
+            app.on_response_prepare.append(self.remember_write)
+        app.add_routes([
+            web.post('/api/countries', self.post_country),
+            web.get('/api/countries', self.get_countries),
+            web.put(r'/api/countries/{id:\d+}', self.put_country),
+            web.delete(r'/api/countries/{id:\d+}', self.delete_country),
+
+            web.post('/api/cities', self.post_city),
+            web.get('/api/cities', self.get_cities),
+            web.put(r'/api/cities/{id:\d+}', self.put_city),
+            web.delete(r'/api/cities/{id:\d+}', self.delete_city),
+
+            web.get(r'/api/cities/country/{id:\d+}', self.get_cities_country),
+
+            web.get('/api/cache', self.get_cache),
+
+            web.post('/api/temperatures', self.post_temperature),
+            web.get('/api/temperatures', self.get_temperatures),
+            web.put(r'/api/temperatures/{id:\d+}', self.put_temperature),
+            web.delete(r'/api/temperatures/{id:\d+}', self.delete_temperature),
+
+            web.post('/api/temperatures/batch', self.post_batch),
+            web.get('/api/temperatures/stats', self.get_stats),
+            web.get('/api/temperatures/stream', self.get_temperatures_stream),
+
+            web.get('/api/temperatures/cities', self.get_temperatures_cities_batch),
+            web.get(r'/api/temperatures/cities/{id:\d+}', self.get_temperatures_cities),
+            web.get(r'/api/temperatures/countries/{id:\d+}', self.get_temperatures_countries),
+        ])
+        return app
+
+    async def startup(self, app):
+        self.logger.info('Connecting to database')
+        self.pool = await asyncpg.create_pool(
+            min_size=Config.DB_POOL_MIN,
+            max_size=Config.DB_POOL_MAX,
+            host=Config.DB_HOST,
+            database=Config.DB_NAME,
+            user=Config.DB_USER,
+            password=Config.DB_PASSWORD
+        )
+        async with self.pool.acquire() as conn:
+            await self.load_cities(conn)
+
+        # Replica pools connect on first use, so that replicas can start after the API
+        for replica in parse_hosts(Config.DB_REPLICA_HOSTS):
+            self.replicas.replicas.append(await asyncpg.create_pool(
+                min_size=0,
+                max_size=Config.DB_POOL_MAX,
+                database=Config.DB_NAME,
+                user=Config.DB_USER,
+                password=Config.DB_PASSWORD,
+                **replica
+            ))
+            self.replicas.down_until.append(0)
+
+    # Load the city index, reading the version of Orase before its rows
+    async def load_cities(self, conn):
+        version = await conn.fetchval(CITIES_VERSION_QUERY)
+        self.cities.replace(await conn.fetch(CITIES_QUERY), version)
+
+    # Reload the city index if it is stale. Only one request reloads it at a time, the others keep using
+    # the current content meanwhile, unless there is none yet.
+    async def refresh_cities(self, conn):
+        version = await conn.fetchval(CITIES_VERSION_QUERY)
+        if not self.cities.stale(version):
+            return
+        if self.cities_lock.locked() and self.cities.loaded_at is not None:
+            return
+        async with self.cities_lock:
+            # Another request may have reloaded the index while this one waited
+            if self.cities.stale(version):
+                await self.load_cities(conn)
+
+    async def cleanup(self, app):
+        self.feed.end_all()
+        if self.listener is not None:
+            await self.listener.close()
+        self.logger.info('Database connections closed')
+        await self.pool.close()
+        for replica in self.replicas.replicas:
+            await replica.close()
+
+    # Connection serving the reads of a request: from a replica in turn, or from the primary
+    # for clients that wrote in the last DB_READ_YOUR_WRITES seconds or when no replica is available
+    @contextlib.asynccontextmanager
+    async def reading(self, request):
+        if WRITE_COOKIE not in request.cookies:
+            for index in self.replicas.candidates():
+                replica = self.replicas.replicas[index]
+                try:
+                    conn = await replica.acquire(timeout=self.replicas.wait)
+                except asyncio.TimeoutError:
+                    # Exhausted replicas are busy, not broken
+                    continue
+                except (OSError, asyncpg.PostgresError):
+                    self.replicas.failed(index)
+                    continue
+                try:
+                    yield conn
+                finally:
+                    await replica.release(conn)
+                return
+
+        async with self.pool.acquire() as conn:
+            yield conn
+
+    async def remember_write(self, request, response):
+        if request.method not in READ_METHODS and response.status < 400:
+            response.set_cookie(WRITE_COOKIE, '1', max_age=Config.DB_READ_YOUR_WRITES, httponly=True)
+
+    async def body(self, request):
+        try:
+            return await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+    async def validators(self, conn, tables, variant=None):
+        return validator_headers(await conn.fetch(*numbered_args(VERSIONS_QUERY, {'tables': sorted(tables)})), variant)
+
+    # Convert the from and until arguments to dates, returning False if one of them is invalid
+    def parse_dates(self, args):
+        for name in ('from', 'until'):
+            if args[name]:
+                try:
+                    args[name] = datetime.datetime.strptime(args[name], '%Y-%m-%d')
+                except ValueError:
+                    self.logger.error('%s not a YYYY-MM-DD date', args[name])
+                    return False
+        return True
+
+    # Run a list query for a page of rows, returning them with the headers of the response
+    async def fetch_page(self, request, conn, query, page, headers):
+        rows, next_headers = page.finish(await conn.fetch(*query.build_numbered()),
+                                         str(request.url.with_query(None)),
+                                         {name: request.query.getall(name) for name in request.query.keys()})
+        headers.update(next_headers)
+        return rows
+
+    # Write the rows of a query to the client in batches, through a server-side cursor
+    async def stream(self, request, conn, query, fmt, headers):
+        async with conn.transaction():
+            try:
+                cursor = await conn.cursor(*query.build_numbered())
+            except asyncpg.PostgresError:
+                self.logger.error('query %s failed', query.build())
+                return respond({}, 400)
+
+            response = web.StreamResponse(status=200, headers=headers)
+            response.content_type = FORMATS[fmt]
+            await response.prepare(request)
+
+            await response.write(encode(stream_start(TEMPERATURE_COLUMNS, fmt)))
+            first = True
+            while True:
+                rows = await cursor.fetch(Config.STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+
+                await response.write(encode(stream_batch(TEMPERATURE_COLUMNS, rows, fmt, first)))
+                first = False
+            await response.write(encode(stream_end(fmt)))
+
+        await response.write_eof()
+        return response
+
+    # Serve a cached country or city listing, or read it with the given query
+    async def get_listing(self, request, tag, table, query, cols):
+        # Clients that read their own writes from the primary skip the cache, which may hold a response
+        # read by another client from a lagging replica
+        cached = None if WRITE_COOKIE in request.cookies else self.cache.get(str(request.url))
+        if cached:
+            if not_modified(cached[2], request.headers):
+                return web.Response(status=304, headers=cached[2])
+            return respond(*cached)
+        version = self.cache.version(tag)
+
+        args = parse_args(request, PAGE_ARGUMENTS)
+        try:
+            page = Page(args, [('id', 0, int)])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return respond({}, 400)
+
+        async with self.reading(request) as conn:
+            headers = await self.validators(conn, [table])
+            if not_modified(headers, request.headers):
+                return web.Response(status=304, headers=headers)
+
+            rows = await self.fetch_page(request, conn, page.apply(query), page, headers)
+
+        rows = format_rows(cols, rows)
+        self.cache.put(str(request.url), tag, version, (rows, 200, headers))
+        return respond(rows, 200, headers)
+
+    async def get_countries(self, request):
+        return await self.get_listing(request, 'Tari', 'tari', QueryBuilder('SELECT * FROM Tari'), COUNTRY_COLUMNS)
+
+    async def get_cities(self, request):
+        args = parse_args(request, {'ids': parse_ids})
+        query = QueryBuilder('SELECT * FROM Orase').where('id = ANY(%(ids)s)', {'ids': args['ids']})
+        return await self.get_listing(request, 'Orase', 'orase', query, CITY_COLUMNS)
+
+    async def get_cities_country(self, request):
+        query = QueryBuilder('SELECT * FROM Orase').where('id_tara = %(id)s', {'id': int(request.match_info['id'])})
+        return await self.get_listing(request, 'Orase', 'orase', query, CITY_COLUMNS)
+
+    async def get_cache(self, request):
+        return respond(self.cache.stats(), 200)
+
+    async def post_country(self, request):
+        country = await self.body(request)
+        err = self.countries.check_post(country)
+        if err:
+            return respond({}, err)
+
+        try:
+            async with self.pool.acquire() as conn:
+                country_id = await conn.fetchval(*numbered_args(INSERT_COUNTRY_QUERY, {
+                    'nume': str(country['nume']), 'lat': float(country['lat']), 'lon': float(country['lon'])}))
+        except asyncpg.UniqueViolationError:
+            self.logger.warning('%s already exists in table', country['nume'])
+            return respond({}, 409)
+        except asyncpg.PostgresError:
+            self.logger.error('%s could not be inserted in database', country)
+            return respond({}, 409)
+
+        self.cache.invalidate('Tari')
+        return respond({'id': country_id}, 201)
+
+    async def put_country(self, request):
+        id = int(request.match_info['id'])
+        country = await self.body(request)
+        err = self.countries.check_put(country)
+        if err:
+            return respond({}, err)
+
+        try:
+            # Orase is versioned in the same transaction as the write, to keep the city index current
+            async with self.pool.acquire() as conn, conn.transaction():
+                before = await conn.fetchval(CITIES_VERSION_QUERY)
+                updated = await conn.execute(*numbered_args(UPDATE_COUNTRY_QUERY, {
+                    'id': int(country['id']), 'nume': str(country['nume']), 'lat': float(country['lat']),
+                    'lon': float(country['lon']), 'current_id': id}))
+                after = await conn.fetchval(CITIES_VERSION_QUERY)
+        except asyncpg.DataError:
+            self.logger.warning('%s not found in table', id)
+            return respond({}, 404)
+        except asyncpg.PostgresError:
+            self.logger.error('%s could not be inserted in database', country)
+            return respond({}, 400)
+
+        if updated != 'UPDATE 0':
+            self.cities.update_country(id, int(country['id']))
+            self.cities.advance(before, after)
+        self.cache.invalidate('Tari', 'Orase')
+        return respond({}, 200)
+
+    async def delete_country(self, request):
+        id = int(request.match_info['id'])
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                before = await conn.fetchval(CITIES_VERSION_QUERY)
+                await conn.execute(*numbered_args(DELETE_COUNTRY_QUERY, {'id': id}))
+                after = await conn.fetchval(CITIES_VERSION_QUERY)
+        except asyncpg.PostgresError:
+            self.logger.error('id=%s could not be deleted from database', id)
+            return respond({}, 400)
+
+        self.cities.remove_country(id)
+        self.cities.advance(before, after)
+        self.cache.invalidate('Tari', 'Orase')
+        return respond({}, 200)
+
+    async def post_city(self, request):
+        city = await self.body(request)
+        err = self.city_resource.check_post(city)
+        if err:
+            return respond({}, err)
+
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                before = await conn.fetchval(CITIES_VERSION_QUERY)
+                city_id, country_id, lat, lon = await conn.fetchrow(*numbered_args(INSERT_CITY_QUERY, {
+                    'idTara': integer(city['idTara']), 'nume': str(city['nume']), 'lat': float(city['lat']),
+                    'lon': float(city['lon'])}))
+                after = await conn.fetchval(CITIES_VERSION_QUERY)
+        except asyncpg.UniqueViolationError:
+            self.logger.warning('%s already exists in table', city['nume'])
+            return respond({}, 409)
+        except (asyncpg.PostgresError, ValueError):
+            self.logger.error('%s could not be inserted in database', city)
+            return respond({}, 409)
+
+        self.cities.add(city_id, country_id, lat, lon)
+        self.cities.advance(before, after)
+        self.cache.invalidate('Orase')
+        return respond({'id': city_id}, 201)
+
+    async def put_city(self, request):
+        id = int(request.match_info['id'])
+        city = await self.body(request)
+        err = self.city_resource.check_put(city)
+        if err:
+            return respond({}, err)
+
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                before = await conn.fetchval(CITIES_VERSION_QUERY)
+                updated = await conn.fetchrow(*numbered_args(UPDATE_CITY_QUERY, {
+                    'id': int(city['id']), 'idTara': integer(city['idTara']), 'nume': str(city['nume']),
+                    'lat': float(city['lat']), 'lon': float(city['lon']), 'current_id': id}))
+                after = await conn.fetchval(CITIES_VERSION_QUERY)
+        except (asyncpg.DataError, ValueError):
+            self.logger.warning('%s not found in table', id)
+            return respond({}, 404)
+        except asyncpg.PostgresError:
+            self.logger.error('%s could not be inserted in database', city)
+            return respond({}, 400)
+
+        if updated:
+            self.cities.remove(id)
+            self.cities.add(*updated)
+            self.cities.advance(before, after)
+        self.cache.invalidate('Orase')
+        return respond({}, 200)
+
+    async def delete_city(self, request):
+        id = int(request.match_info['id'])
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                before = await conn.fetchval(CITIES_VERSION_QUERY)
+                await conn.execute(*numbered_args(DELETE_CITY_QUERY, {'id': id}))
+                after = await conn.fetchval(CITIES_VERSION_QUERY)
+        except asyncpg.PostgresError:
+            self.logger.error('id=%s could not be deleted from database', id)
+            return respond({}, 400)
+
+        self.cities.remove(id)
+        self.cities.advance(before, after)
+        self.cache.invalidate('Orase')
+        return respond({}, 200)
+
+    async def post_temperature(self, request):
+        temp = await self.body(request)
+        err = self.temperatures.check_post(temp)
+        if err:
+            return respond({}, err)
+
+        try:
+            async with self.pool.acquire() as conn:
+                temp_id = await conn.fetchval(*numbered_args(INSERT_TEMPERATURE_QUERY, {
+                    'valoare': float(temp['valoare']), 'idOras': integer(temp['idOras'])}))
+        except asyncpg.UniqueViolationError:
+            self.logger.warning('Temperature for %s already exists in table', temp['idOras'])
+            return respond({}, 409)
+        except (asyncpg.PostgresError, ValueError):
+            self.logger.error('%s could not be inserted in database', temp)
+            return respond({}, 400)
+
+        return respond({'id': temp_id}, 201)
+
+    async def put_temperature(self, request):
+        id = int(request.match_info['id'])
+        temp = await self.body(request)
+        err = self.temperatures.check_put(temp)
+        if err:
+            return respond({}, err)
+
+        try:
+            async with self.pool.acquire() as conn:
+                status = await conn.execute(*numbered_args(UPDATE_TEMPERATURE_QUERY, {
+                    'id': int(temp['id']), 'idOras': integer(temp['idOras']), 'valoare': float(temp['valoare']),
+                    'current_id': id}))
+        except (asyncpg.DataError, ValueError):
+            self.logger.warning('%s not found in table', id)
+            return respond({}, 404)
+        except asyncpg.PostgresError:
+            self.logger.error('%s could not be inserted in database', temp)
+            return respond({}, 400)
+
+        # Archived readings can't be updated, like readings that don't exist
+        if status == 'UPDATE 0':
+            self.logger.warning('%s not found in table', id)
+            return respond({}, 404)
+        return respond({}, 200)
+
+    async def delete_temperature(self, request):
+        id = int(request.match_info['id'])
+        try:
+            async with self.pool.acquire() as conn:
+                status = await conn.execute(*numbered_args(DELETE_TEMPERATURE_QUERY, {'id': id}))
+        except asyncpg.PostgresError:
+            self.logger.error('id=%s could not be deleted from database', id)
+            return respond({}, 400)
+
+        # Archived readings can't be deleted, like readings that don't exist
+        if status == 'DELETE 0':
+            self.logger.warning('%s not found in table', id)
+            return respond({}, 404)
+        return respond({}, 200)
+
+    async def post_batch(self, request):
+        temps = await self.body(request)
+        err = self.batch.check_batch(temps)
+        if err:
+            return respond({}, err)
+
+        results, rows = self.batch.check_records(temps)
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    now = await conn.fetchval('SELECT localtimestamp;')
+                    cities = {city['id'] for city in await conn.fetch(*numbered_args(BATCH_CITIES_QUERY, {
+                        'cities': list({row[0] for row in rows.values()})}))}
+                    pending = self.batch.pending(rows, cities, now, results)
+
+                    inserted = await conn.fetch(*numbered_args(INSERT_BATCH_QUERY, self.batch.insert_params(pending)))
+        except asyncpg.PostgresError:
+            self.logger.error('batch of %s temperatures could not be inserted in database', len(temps))
+            return respond({}, 400)
+
+        return respond(self.batch.collect(results, pending, [tuple(row) for row in inserted]), 200)
+
+    # Serve a temperature listing, built by the query method of a temperature resource
+    async def get_temperature_listing(self, request, resource, args, tables):
+        if not self.parse_dates(args):
+            return respond({}, 400)
+
+        # Downsampled series are only sent as JSON, one bucket per interval
+        if args['interval'] and args['stream']:
+            self.logger.error('downsampled temperatures can not be streamed')
+            return respond({}, 400)
+        if not args['interval']:
+            args['stream'] = requested_format(args['stream'], request.headers.get('Accept', ''))
+
+        # Streamed responses are never paginated, they are meant for results of any size
+        try:
+            if args['interval']:
+                page = bucket_page(args)
+            else:
+                page = Page(args, resource.page_keys, paginate=not args['stream'])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return respond({}, 400)
+
+        async with self.reading(request) as conn:
+            headers = await self.validators(conn, tables, args['stream'])
+            headers['Vary'] = 'Accept'
+            if not_modified(headers, request.headers):
+                return web.Response(status=304, headers=headers)
+
+            if resource.needs_city_index(args):
+                await self.refresh_cities(conn)
+            query = bucket_query(resource, args, page) if args['interval'] else resource.query(args, page)
+
+            if args['stream']:
+                return await self.stream(request, conn, query, args['stream'], headers)
+
+            try:
+                rows = await self.fetch_page(request, conn, query, page, headers)
+            except asyncpg.PostgresError:
+                self.logger.error('query with args %s failed', args)
+                return respond({}, 400)
+
+        if args['interval']:
+            return respond(format_buckets(rows), 200, headers)
+        return respond(format_temperatures(rows), 200, headers)
+
+    async def get_temperatures(self, request):
+        args = parse_args(request, dict({'lat': float, 'lon': float, 'radius': float}, **TEMPERATURE_ARGUMENTS),
+                          {'stream': FORMATS})
+        if args['radius'] is not None and (args['lat'] is None or args['lon'] is None or args['radius'] < 0):
+            self.logger.error('radius %s needs both lat and lon', args['radius'])
+            return respond({}, 400)
+        return await self.get_temperature_listing(request, self.temperatures, args, ['temperaturi', 'orase'])
+
+    async def get_temperatures_cities(self, request):
+        args = parse_args(request, TEMPERATURE_ARGUMENTS, {'stream': FORMATS})
+        args['id'] = int(request.match_info['id'])
+        return await self.get_temperature_listing(request, self.temperatures_cities, args, ['temperaturi'])
+
+    async def get_temperatures_cities_batch(self, request):
+        args = parse_args(request, dict({'ids': parse_ids}, **DATE_ARGUMENTS))
+        if args['ids'] is None:
+            raise web.HTTPBadRequest()
+        if not self.parse_dates(args):
+            return respond({}, 400)
+
+        async with self.reading(request) as conn:
+            headers = await self.validators(conn, ['temperaturi'])
+            if not_modified(headers, request.headers):
+                return web.Response(status=304, headers=headers)
+
+            try:
+                rows = await conn.fetch(*self.temperatures_cities.batch_query(args).build_numbered())
+            except asyncpg.PostgresError:
+                self.logger.error('query with args %s failed', args)
+                return respond({}, 400)
+
+        return respond(group_rows(args['ids'], rows, format_temperatures), 200, headers)
+
+    async def get_temperatures_countries(self, request):
+        args = parse_args(request, TEMPERATURE_ARGUMENTS, {'stream': FORMATS})
+        args['id'] = int(request.match_info['id'])
+        return await self.get_temperature_listing(request, self.temperatures_countries, args,
+                                                  ['temperaturi', 'orase'])
+
+    async def get_stats(self, request):
+        args = parse_args(request, dict({'city': int, 'country': int, 'granularity': str}, **DATE_ARGUMENTS),
+                          {'granularity': GRANULARITIES})
+        args['granularity'] = args['granularity'] or 'day'
+        if args['city'] is not None and args['country'] is not None:
+            self.logger.error('statistics can be scoped to either a city or a country')
+            return respond({}, 400)
+        if not self.parse_dates(args):
+            return respond({}, 400)
+
+        async with self.reading(request) as conn:
+            headers = await self.validators(conn, ['temperaturi', 'orase'])
+            if not_modified(headers, request.headers):
+                return web.Response(status=304, headers=headers)
+
+            try:
+                rows = await conn.fetch(*self.stats.query(args).build_numbered())
+            except asyncpg.PostgresError:
+                self.logger.error('query with args %s failed', args)
+                return respond({}, 400)
+
+        return respond(self.stats.format(args, rows), 200, headers)
+
+    # Open the connection listening to new readings, unless it is already open
+    async def listen(self):
+        async with self.listener_lock:
+            if self.listener is not None and not self.listener.is_closed():
+                return
+            self.listener = await asyncpg.connect(host=Config.DB_HOST, database=Config.DB_NAME,
+                                                  user=Config.DB_USER, password=Config.DB_PASSWORD)
+            await self.listener.add_listener(CHANNEL, lambda conn, pid, channel, payload: self.feed.publish(payload))
+            await self.listener.execute(REGISTER_QUERY)
+            self.listener.add_termination_listener(self.listener_lost)
+
+    # Readings published until the next subscription reopens the connection are missed,
+    # so the streams are ended and their clients reconnect
+    def listener_lost(self, conn):
+        self.logger.error('live feed connection lost')
+        self.feed.end_all()
+
+    async def get_temperatures_stream(self, request):
+        args = parse_args(request, {'city': int, 'country': int})
+        if args['city'] is not None and args['country'] is not None:
+            self.logger.error('live feeds can be scoped to either a city or a country')
+            return respond({}, 400)
+        # The body of a HEAD response is never sent, so it gets the headers of a stream without subscribing
+        if request.method == 'HEAD':
+            return web.Response(status=200, headers=EVENT_HEADERS, content_type=EVENT_STREAM)
+
+        try:
+            await self.listen()
+        except (OSError, asyncpg.PostgresError):
+            self.logger.error('live feed could not connect to database')
+            return respond({}, 503)
+
+        subscription = Subscription(args['city'], args['country'], asyncio.Queue(Config.LIVE_FEED_QUEUE_SIZE))
+        self.feed.add(subscription)
+        try:
+            response = web.StreamResponse(status=200, headers=EVENT_HEADERS)
+            response.content_type = EVENT_STREAM
+            await response.prepare(request)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.events.get(), Config.LIVE_FEED_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    event = HEARTBEAT
+                if event is None:
+                    break
+                await response.write(encode(event))
+        finally:
+            self.feed.remove(subscription)
+
+        await response.write_eof()
+        return response
+
+
+def run(logger):
+    # Readings are only sharded by the Flask application, the queries of this server would miss the other shards
+    if Config.DB_SHARD_HOSTS:
+        logger.error('DB_SHARD_HOSTS is not supported by the asyncio server')
+        return
+    web.run_app(AsyncServer(logger).app(), host='0.0.0.0', port=5000)
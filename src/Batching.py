@@ -0,0 +1,20 @@
+import Config
+
+
+# Parse a comma-separated list of ids like 1,2,3, without duplicates,
+# raising ValueError if it is empty, too long or not made of integers
+def parse_ids(text):
+    ids = list(dict.fromkeys(int(value) for value in text.split(',')))
+    if len(ids) > Config.BATCH_MAX_IDS:
+        raise ValueError('more than ' + str(Config.BATCH_MAX_IDS) + ' ids')
+    return ids
+
+
+# Group rows by the entity id in their first column, formatting the rest of the rows of each entity.
+# Every requested id has an entry, which is empty if it has no rows.
+def group_rows(ids, rows, format_group):
+    groups = {entity_id: [] for entity_id in ids}
+    for row in rows:
+        row = tuple(row)
+        groups[row[0]].append(row[1:])
+    return {str(entity_id): format_group(group) for entity_id, group in groups.items()}
@@ -0,0 +1,474 @@
+import argparse
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+import psycopg2.extras
+
+import Config
+from Cities import Cities
+from ConnectionPool import ConnectionPool
+from Countries import Countries
+from QueryBuilder import QueryBuilder
+from ReplicaRouter import parse_hosts
+from ShardSet import ShardSet
+from TemperaturesBatch import TemperaturesBatch
+
+# Table of every kind of record
+TABLES = {'countries': 'tari', 'cities': 'orase', 'temperatures': 'temperaturi'}
+
+# Longest country and city name accepted by create-table.sql
+NAME_LENGTH = 100
+
+# Staging tables the records of a batch are copied to, before being inserted in their table
+STAGING_QUERIES = {
+    'countries': """
+                 CREATE TEMP TABLE incarcare_tari (id integer, nume_tara text, latitudine real, longitudine real)
+                 ON COMMIT DELETE ROWS;
+                 """,
+    'cities': """
+              CREATE TEMP TABLE incarcare_orase (id integer, id_tara integer, nume_oras text,
+                                                 latitudine real, longitudine real)
+              ON COMMIT DELETE ROWS;
+              """,
+    'temperatures': """
+                    CREATE TEMP TABLE incarcare_temperaturi (id integer, id_oras integer, valoare real,
+                                                             timestamp timestamp)
+                    ON COMMIT DELETE ROWS;
+                    """,
+}
+
+# Records without an id get one from the sequence of their table. Records whose id or name is taken,
+# readings already stored for their city and timestamp, in Temperaturi or in the archive, and records
+# of countries or cities that don't exist are skipped. The inserts fire the triggers of the tables, so that versions and rollups are kept up to date.
+# Reading ids of another shard are replaced, so that ids stay unique across shards.
+INSERT_QUERIES = {
+    'countries': """
+                 INSERT INTO Tari(id, nume_tara, latitudine, longitudine)
+                 SELECT coalesce(id, nextval(pg_get_serial_sequence('tari', 'id')::regclass)),
+                        nume_tara, latitudine, longitudine
+                 FROM incarcare_tari
+                 ON CONFLICT DO NOTHING
+                 RETURNING id, nume_tara, latitudine, longitudine;
+                 """,
+    'cities': """
+              INSERT INTO Orase(id, id_tara, nume_oras, latitudine, longitudine)
+              SELECT coalesce(i.id, nextval(pg_get_serial_sequence('orase', 'id')::regclass)),
+                     i.id_tara, i.nume_oras, i.latitudine, i.longitudine
+              FROM incarcare_orase i
+              WHERE EXISTS (SELECT 1 FROM Tari t WHERE t.id = i.id_tara)
+              ON CONFLICT DO NOTHING
+              RETURNING id, id_tara, nume_oras, latitudine, longitudine;
+              """,
+    'temperatures': """
+                    INSERT INTO Temperaturi(id, valoare, timestamp, id_oras)
+                    SELECT coalesce(CASE WHEN i.id %% %(shards)s = %(shard)s THEN i.id END,
+                                    nextval(pg_get_serial_sequence('temperaturi', 'id')::regclass)),
+                           i.valoare, coalesce(i.timestamp, localtimestamp), i.id_oras
+                    FROM incarcare_temperaturi i
+                    WHERE EXISTS (SELECT 1 FROM Orase o WHERE o.id = i.id_oras)
+                      AND NOT arhivata(i.id_oras, coalesce(i.timestamp, localtimestamp))
+                    ON CONFLICT DO NOTHING;
+                    """,
+}
+
+# Countries and cities inserted in the first shard are copied to the other ones with the same ids
+MIRROR_QUERIES = {
+    'countries': """
+                 INSERT INTO Tari(id, nume_tara, latitudine, longitudine)
+                 VALUES %s
+                 ON CONFLICT DO NOTHING;
+                 """,
+    'cities': """
+              INSERT INTO Orase(id, id_tara, nume_oras, latitudine, longitudine)
+              VALUES %s
+              ON CONFLICT DO NOTHING;
+              """,
+}
+
+# Records exported with the field names of the API, so that exported files can be imported again
+EXPORT_QUERIES = {
+    'countries': """
+                 SELECT id AS "id", nume_tara AS "nume", latitudine AS "lat", longitudine AS "lon"
+                 FROM Tari
+                 """,
+    'cities': """
+              SELECT id AS "id", id_tara AS "idTara", nume_oras AS "nume", latitudine AS "lat", longitudine AS "lon"
+              FROM Orase
+              """,
+    'temperatures': """
+                    SELECT t.id AS "id", t.id_oras AS "idOras", t.valoare AS "valoare",
+                           to_char(t.timestamp, 'YYYY-MM-DD"T"HH24:MI:SS.US') AS "timestamp"
+                    FROM temperaturi_toate(%(from)s, %(until)s) t
+                    """,
+}
+
+
+# Integer value of a field, which may be given as a number or a string, raising ValueError otherwise
+def integer(value):
+    value = float(value)
+    if not value.is_integer():
+        raise ValueError(value)
+    return int(value)
+
+
+# Format of a file, from its extension unless given
+def file_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+
+# Split the lines of a file between two byte offsets into parts of about the same size, all starting at a line
+def split(path, start, end, parts):
+    bounds = [start]
+    with open(path, 'rb') as f:
+        for part in range(1, parts):
+            f.seek(max(start + (end - start) * part // parts - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(max(f.tell(), bounds[-1]), end))
+    bounds.append(end)
+    return [(part_start, part_end) for part_start, part_end in zip(bounds, bounds[1:]) if part_start < part_end]
+
+
+class BulkTransfer:
+    # Imports and exports of countries, cities and readings, straight to and from the databases of every shard,
+    # given by their connection settings. Records are checked with the rules of the API and copied in batches
+    # of the given number of lines, each committed with the progress of its import.
+    def __init__(self, logger, dsns, batch):
+        self.logger = logger
+        self.dsns = dsns
+        self.batch = batch
+
+        # The resources are only used for their validation, they never touch the database here
+        kwargs = {'logger': logger, 'router': None, 'cities': None, 'cache': None, 'metrics': None,
+                  'writer': None, 'feed': None, 'shards': None}
+        self.countries = Countries(**kwargs)
+        self.city_resource = Cities(**kwargs)
+        self.temperatures = TemperaturesBatch(**kwargs)
+
+    # Connections to the databases of the first shards, or of every shard
+    def connect(self, shards=None):
+        return [psycopg2.connect(**dsn) for dsn in self.dsns[:shards]]
+
+    # Record of a line of a file, as a dict of fields, or None if it can't be read
+    def parse(self, label, line, columns):
+        try:
+            if columns is None:
+                return json.loads(line)
+            values = next(csv.reader([line.decode('utf-8')]))
+        except (ValueError, StopIteration):
+            self.logger.warning('record %s is not correctly formatted', label)
+            return None
+
+        if len(values) != len(columns):
+            self.logger.warning('record %s does not contain correct number of fields', label)
+            return None
+        return dict(zip(columns, values))
+
+    # Row of the staging table of a record, or None if the checks of the API reject it
+    def check(self, kind, label, record):
+        if not isinstance(record, dict):
+            self.logger.warning('record %s is not an object', label)
+            return None
+        # Empty fields are missing, as in requests that leave them out
+        record = {name: value for name, value in record.items() if value not in ('', None)}
+
+        try:
+            if kind == 'temperatures':
+                temp_id = integer(record.pop('id')) if 'id' in record else None
+                row = self.temperatures.check_record(label, record)
+                return (temp_id,) + row if row else None
+
+            resource = self.countries if kind == 'countries' else self.city_resource
+            if (resource.check_put(record) if 'id' in record else resource.check_post(record)) is not None:
+                self.logger.warning('record %s was rejected', label)
+                return None
+            if len(str(record['nume'])) > NAME_LENGTH:
+                self.logger.warning('in record %s, nume is longer than %s characters', label, NAME_LENGTH)
+                return None
+
+            row = (integer(record['id']) if 'id' in record else None,)
+            if kind == 'cities':
+                row += (integer(record['idTara']),)
+            return row + (str(record['nume']), float(record['lat']), float(record['lon']))
+        except (TypeError, ValueError):
+            self.logger.warning('record %s does not contain correct values', label)
+            return None
+
+    # Insert the rows of a batch in the databases of every shard, returning the number of records inserted.
+    # Readings go to the shard of their city, countries and cities to every shard.
+    def load(self, conns, kind, rows):
+        if kind == 'temperatures':
+            shards = {}
+            for row in rows:
+                shards.setdefault(row[1] % len(conns), []).append(row)
+        else:
+            shards = {0: rows}
+
+        inserted = 0
+        for index, shard_rows in shards.items():
+            data = io.StringIO()
+            csv.writer(data).writerows(shard_rows)
+            data.seek(0)
+
+            cur = conns[index].cursor()
+            try:
+                cur.copy_expert('COPY incarcare_' + TABLES[kind] + ' FROM STDIN WITH (FORMAT csv);', data)
+                cur.execute(INSERT_QUERIES[kind], {'shards': len(conns), 'shard': index})
+                inserted += cur.rowcount
+                if kind != 'temperatures':
+                    for conn in conns[1:]:
+                        mirror = conn.cursor()
+                        psycopg2.extras.execute_values(mirror, MIRROR_QUERIES[kind], cur.fetchall(),
+                                                       page_size=self.batch)
+                        mirror.close()
+            finally:
+                cur.close()
+        return inserted
+
+    # Import the lines of a part of a file from its last checkpoint, returning the number of records
+    # inserted, the number of records skipped and whether the whole part was imported
+    def import_part(self, kind, path, columns, key, part, start, end):
+        conns = self.connect()
+        inserted = skipped = 0
+        try:
+            for conn in conns:
+                cur = conn.cursor()
+                cur.execute(STAGING_QUERIES[kind])
+                # Imported readings are not pushed to the live feed
+                cur.execute("SELECT set_config('temperaturi.import', 'on', false);")
+                cur.close()
+                conn.commit()
+
+            with open(path, 'rb') as f:
+                f.seek(start)
+                position = start
+                while position < end:
+                    rows = []
+                    lines = 0
+                    while position < end and lines < self.batch:
+                        line = f.readline()
+                        if not line:
+                            break
+                        label = '%s@%s' % (os.path.basename(path), position)
+                        position += len(line)
+                        if not line.strip():
+                            continue
+                        lines += 1
+                        row = self.check(kind, label, self.parse(label, line, columns))
+                        if row:
+                            rows.append(row)
+
+                    try:
+                        count = self.load(conns, kind, rows) if rows else 0
+                        cur = conns[0].cursor()
+                        cur.execute('UPDATE Importuri SET pozitie = %s WHERE fisier = %s AND parte = %s;',
+                                    (position, key, part))
+                        cur.close()
+                        # The checkpoint is committed last, so that a batch committed by only some of the shards
+                        # is imported again, its committed records being skipped as duplicates
+                        for conn in conns[1:] + conns[:1]:
+                            conn.commit()
+                    except psycopg2.Error:
+                        for conn in conns:
+                            conn.rollback()
+                        self.logger.error('part %s of %s could not be imported from byte %s', part, path, start)
+                        return inserted, skipped, False
+
+                    inserted += count
+                    skipped += lines - count
+                    start = position
+                    self.logger.info('part %s of %s imported up to byte %s', part, path, position)
+        finally:
+            for conn in conns:
+                conn.close()
+        return inserted, skipped, True
+
+    # Parts of a file and the byte offset each of them was imported up to, planned by the first import
+    # of the file and kept by the database, so that an interrupted import resumes where it stopped
+    def checkpoints(self, conn, key, path, columns, workers):
+        cur = conn.cursor()
+        cur.execute('SELECT parte, pozitie, sfarsit FROM Importuri WHERE fisier = %s ORDER BY parte;', (key,))
+        parts = cur.fetchall()
+        if parts:
+            self.logger.info('resuming the import of %s', path)
+        else:
+            # The header of CSV files names their columns, and is read once here
+            start = 0
+            if columns is not None:
+                with open(path, 'rb') as f:
+                    start = len(f.readline())
+            parts = [(part, part_start, part_end) for part, (part_start, part_end)
+                     in enumerate(split(path, start, os.path.getsize(path), workers))]
+            psycopg2.extras.execute_values(cur, 'INSERT INTO Importuri(fisier, parte, pozitie, sfarsit) VALUES %s;',
+                                           parts)
+        cur.close()
+        conn.commit()
+        return [(part, position, end) for part, position, end in parts if position < end]
+
+    # Import files of one kind of records, the parts of every file in parallel. Returns whether every file
+    # was imported completely.
+    def import_files(self, kind, paths, fmt, workers, restart):
+        # Reading ids drawn by the shards are unique across them, like those of the API
+        pools = [ConnectionPool(self.logger, 0, 1, Config.DB_POOL_TIMEOUT, Config.DB_POOL_CHECK_INTERVAL, **dsn)
+                 for dsn in self.dsns]
+        shards = ShardSet(self.logger, None, pools)
+        shards.prepare()
+        shards.closeall()
+        pools[0].closeall()
+
+        conn = psycopg2.connect(**self.dsns[0])
+        complete = True
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for path in paths:
+                    path = os.path.abspath(path)
+                    key = '%s:%s' % (path, os.path.getsize(path))
+                    if restart:
+                        cur = conn.cursor()
+                        cur.execute('DELETE FROM Importuri WHERE fisier = %s;', (key,))
+                        cur.close()
+
+                    columns = None
+                    if file_format(path, fmt) == 'csv':
+                        with open(path, 'rb') as f:
+                            columns = next(csv.reader([f.readline().decode('utf-8-sig')]), [])
+
+                    parts = self.checkpoints(conn, key, path, columns, workers)
+                    futures = [executor.submit(import_part, self.dsns, self.batch, kind, path, columns, key,
+                                               part, position, end)
+                               for part, position, end in parts]
+                    results = [future.result() for future in futures]
+
+                    inserted = sum(result[0] for result in results)
+                    skipped = sum(result[1] for result in results)
+                    self.logger.info('%s: %s %s inserted, %s records skipped', path, inserted, kind, skipped)
+                    complete = complete and all(result[2] for result in results)
+
+            self.sync_sequences(kind)
+        finally:
+            conn.close()
+        return complete
+
+    # Move the sequence of the table past the ids imported with the records, on every shard
+    def sync_sequences(self, kind):
+        conns = self.connect()
+        try:
+            for index, conn in enumerate(conns):
+                cur = conn.cursor()
+                cur.execute("SELECT pg_get_serial_sequence(%s, 'id');", (TABLES[kind],))
+                sequence = cur.fetchone()[0]
+                cur.execute('SELECT (SELECT max(id) FROM ' + TABLES[kind] + '), last_value FROM ' + sequence + ';')
+                last, current = cur.fetchone()
+                if last is not None and last > current:
+                    # Reading sequences keep drawing the ids of their shard
+                    step = len(conns) if kind == 'temperatures' else 1
+                    cur.execute('SELECT setval(%s, %s);', (sequence, last + (index - last) % step))
+                cur.close()
+                conn.commit()
+        finally:
+            for conn in conns:
+                conn.close()
+
+    # Query exporting records with the given filters, and its parameters
+    def export_query(self, kind, since, until, city, country):
+        if kind == 'temperatures':
+            query = QueryBuilder(EXPORT_QUERIES[kind], {'from': since, 'until': until})
+            query.where('t.timestamp >= %(from)s', {'from': since})
+            query.where('t.timestamp <= %(until)s', {'until': until})
+            query.where('t.id_oras = %(city)s', {'city': city})
+            query.where('t.id_oras IN (SELECT id FROM Orase WHERE id_tara = %(country)s)', {'country': country})
+            return query.order_by('t.timestamp, t.id').build()
+
+        query = QueryBuilder(EXPORT_QUERIES[kind])
+        if kind == 'cities':
+            query.where('id_tara = %(country)s', {'country': country})
+        return query.order_by('id').build()
+
+    # Write the records of a query to a file as CSV with a header, or as one JSON object per line.
+    # Postgres writes the file through COPY TO, without the records being read by Python.
+    def export(self, kind, out, fmt, since=None, until=None, city=None, country=None):
+        sql, params = self.export_query(kind, since, until, city, country)
+        # Readings are spread over every shard, while each of them holds every country and city
+        conns = self.connect(None if kind == 'temperatures' else 1)
+        try:
+            for index, conn in enumerate(conns):
+                cur = conn.cursor()
+                select = cur.mogrify(sql.rstrip(';'), params).decode()
+                if fmt == 'ndjson':
+                    # JSON lines are copied as CSV whose quote and delimiter never appear in them,
+                    # so that they are written unchanged
+                    copy = "COPY (SELECT row_to_json(e) FROM (%s) e) TO STDOUT " \
+                           "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02');" % select
+                else:
+                    copy = 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER %s);' % (select, index == 0)
+                cur.copy_expert(copy, out)
+                cur.close()
+                conn.rollback()
+        finally:
+            for conn in conns:
+                conn.close()
+
+
+# Import a part of a file in a worker process
+def import_part(dsns, batch, kind, path, columns, key, part, start, end):
+    return BulkTransfer(logging.getLogger('BulkTransfer'), dsns, batch).import_part(
+        kind, path, columns, key, part, start, end)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Import or export countries, cities and temperatures in bulk')
+    parser.add_argument('--db-host', default=Config.DB_HOST)
+    parser.add_argument('--db-name', default=Config.DB_NAME)
+    parser.add_argument('--db-user', default=Config.DB_USER)
+    parser.add_argument('--db-password', default=Config.DB_PASSWORD)
+    parser.add_argument('--shard-hosts', default=Config.DB_SHARD_HOSTS,
+                        help='the other shards, as a comma separated list of host[:port] entries')
+    parser.add_argument('--format', default=None, choices=('csv', 'ndjson'),
+                        help='format of the files, from their extension by default')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importing = commands.add_parser('import', help='import CSV or NDJSON files, resuming interrupted imports')
+    importing.add_argument('kind', choices=TABLES)
+    importing.add_argument('files', nargs='+')
+    importing.add_argument('--workers', type=int, default=os.cpu_count(), help='processes importing every file')
+    importing.add_argument('--batch', type=int, default=100000, help='lines copied per transaction')
+    importing.add_argument('--restart', action='store_true', help='import the files again from their start')
+
+    exporting = commands.add_parser('export', help='export records to a CSV or NDJSON file, - for stdout')
+    exporting.add_argument('kind', choices=TABLES)
+    exporting.add_argument('file')
+    exporting.add_argument('--from', dest='since', type=datetime.datetime.fromisoformat, default=None)
+    exporting.add_argument('--until', type=datetime.datetime.fromisoformat, default=None)
+    exporting.add_argument('--city', type=int, default=None)
+    exporting.add_argument('--country', type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    logger = logging.getLogger('BulkTransfer')
+
+    credentials = {'database': args.db_name, 'user': args.db_user, 'password': args.db_password}
+    dsns = [dict(host=args.db_host, **credentials)] + [dict(credentials, **shard)
+                                                       for shard in parse_hosts(args.shard_hosts)]
+
+    if args.command == 'import':
+        transfer = BulkTransfer(logger, dsns, args.batch)
+        exit(0 if transfer.import_files(args.kind, args.files, args.format, args.workers, args.restart) else 1)
+
+    transfer = BulkTransfer(logger, dsns, 0)
+    fmt = file_format(args.file, args.format)
+    if args.file == '-':
+        transfer.export(args.kind, sys.stdout.buffer, fmt, args.since, args.until, args.city, args.country)
+    else:
+        with open(args.file, 'wb') as out:
+            transfer.export(args.kind, out, fmt, args.since, args.until, args.city, args.country)
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Cache:
+    # Bounded in-memory cache with a time to live and least recently used eviction.
+    # Every entry is tagged with the table it was read from, so writes can invalidate it.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # Key -> (expiry time, tag, value), from the least to the most recently used
+        self.entries = OrderedDict()
+        # Tag -> number of times it was invalidated
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def version(self, tag):
+        with self.lock:
+            return self.versions.get(tag, 0)
+
+    # Store a value read when the tag was at the given version. If the tag was invalidated
+    # since then, the value may predate the write and is not stored.
+    def put(self, key, tag, version, value):
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            if self.versions.get(tag, 0) != version:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, tag, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Drop every entry read from one of the given tables
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+            for key in [key for key, entry in self.entries.items() if entry[1] in tags]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
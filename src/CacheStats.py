@@ -0,0 +1,6 @@
+from DatabaseResource import DatabaseResource
+
+
+class CacheStats(DatabaseResource):
+    def get(self):
+        return self.cache.stats(), 200
@@ -1,35 +1,71 @@
 import psycopg2
 from flask import request
-from flask_restful import Resource
+from flask_restful import reqparse
 
+import Config
+from Batching import parse_ids
+from Conditional import not_modified, not_modified_response, validators
+from DatabaseResource import DatabaseResource
+from Formatting import CITY_COLUMNS, CITY_JSON, format_rows
+from Pagination import Page, add_page_arguments
+from QueryBuilder import QueryBuilder
+from Rendering import fetch_rendered, render
+from Statements import execute, register
 
-class Cities(Resource):
-    def __init__(self, **kwargs):
-        self.logger = kwargs['logger']
-        self.db = kwargs['db']
+# Statements writing a city, also applied to the copies of the other shards
+INSERT_QUERY = """
+               INSERT INTO Orase(id_tara, nume_oras, latitudine, longitudine)
+               VALUES (%(idTara)s, %(nume)s, %(lat)s, %(lon)s)
+               RETURNING id, id_tara, latitudine, longitudine;
+               """
+MIRROR_INSERT_QUERY = """
+                      INSERT INTO Orase(id, id_tara, nume_oras, latitudine, longitudine)
+                      VALUES (%(id)s, %(idTara)s, %(nume)s, %(lat)s, %(lon)s);
+                      """
+UPDATE_QUERY = """
+               UPDATE Orase
+               SET id = %(id)s, id_tara = %(idTara)s, nume_oras = %(nume)s, latitudine = %(lat)s, longitudine = %(lon)s
+               WHERE id = %(current_id)s
+               RETURNING id, id_tara, latitudine, longitudine;
+               """
+DELETE_QUERY = """
+               DELETE FROM Orase
+               WHERE id = %(id)s;
+               """
+INSERT_STATEMENT = register('insereaza_oras', INSERT_QUERY)
+MIRROR_INSERT_STATEMENT = register('copiaza_oras', MIRROR_INSERT_QUERY)
+UPDATE_STATEMENT = register('actualizeaza_oras', UPDATE_QUERY)
+DELETE_STATEMENT = register('sterge_oras', DELETE_QUERY)
 
+# Arguments of GET requests, parsed by a parser built once
+PARSER = reqparse.RequestParser()
+PARSER.add_argument('ids', default=None, required=False, type=parse_ids, location='args')
+add_page_arguments(PARSER)
+
+
+class Cities(DatabaseResource):
     # Check that the request body is correctly formatted as a city
     def check_city(self, req):
         if 'idTara' not in req or 'nume' not in req or 'lat' not in req or 'lon' not in req:
-            self.logger.warning('request ' + str(req) + ' does not contain a city')
+            self.logger.warning('request %s does not contain a city', req)
             return 400
 
         try:
             float(req['idTara'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', idTara is not an integer')
+            self.logger.warning('in request %s, idTara is not an integer', req)
             return 400
 
         try:
             float(req['lat'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', latitude is not a real number')
+            self.logger.warning('in request %s, latitude is not a real number', req)
             return 400
 
         try:
             float(req['lon'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', longitude is not a real number')
+            self.logger.warning('in request %s, longitude is not a real number', req)
             return 400
 
         return None
@@ -37,7 +73,7 @@ class Cities(Resource):
     # Check that the request body is correctly formatted for POST request
     def check_post(self, req):
         if len(req) != 4:
-            self.logger.warning('request ' + str(req) + ' does not contain correct number of parameters')
+            self.logger.warning('request %s does not contain correct number of parameters', req)
             return 400
 
         return self.check_city(req)
@@ -45,15 +81,15 @@ class Cities(Resource):
     # Check that the request body is correctly formatted for PUT request
     def check_put(self, req):
         if len(req) != 5:
-            self.logger.warning('request ' + str(req) + ' does not contain correct number of parameters')
+            self.logger.warning('request %s does not contain correct number of parameters', req)
             return 400
         if 'id' not in req:
-            self.logger.warning('request ' + str(req) + ' does not contain an id')
+            self.logger.warning('request %s does not contain an id', req)
             return 400
         try:
             int(req['id'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', id is not an integer')
+            self.logger.warning('in request %s, id is not an integer', req)
             return 400
 
         return self.check_city(req)
@@ -64,108 +100,182 @@ class Cities(Resource):
         if err:
             return {}, err
 
+        # Orase is versioned in the same transaction as the write, to keep the city index current
+        before = self.cities.read_version(self.db)
+
         # Execute INSERT SQL operation
         cur = self.db.cursor()
         try:
-            cur.execute("""
-                        INSERT INTO Orase(id_tara, nume_oras, latitudine, longitudine)
-                        VALUES (%(idTara)s, %(nume)s, %(lat)s, %(lon)s)
-                        RETURNING id;
-                        """,
-                        city)
+            execute(cur, INSERT_STATEMENT, city)
         except psycopg2.errors.UniqueViolation:
             cur.close()
             self.db.rollback()
-            self.logger.warning(city['nume'] + ' already exists in table')
+            self.logger.warning('%s already exists in table', city['nume'])
             return {}, 409
         except psycopg2.errors.DatabaseError:
             cur.close()
             self.db.rollback()
-            self.logger.error(str(city) + ' could not be inserted in database')
+            self.logger.error('%s could not be inserted in database', city)
             return {}, 409
 
         # Retrieve ID of city, if the insert was succesful
         try:
-            city_id = cur.fetchone()[0]
+            city_id, country_id, lat, lon = cur.fetchone()
         except psycopg2.ProgrammingError:
             cur.close()
             self.db.rollback()
-            self.logger.error(str(city) + ' could not be inserted in database')
+            self.logger.error('%s could not be inserted in database', city)
             return {}, 400
 
+        after = self.cities.read_version(self.db)
+
+        # Every shard holds a copy of the cities, with the same ids
+        try:
+            self.shards.mirror(MIRROR_INSERT_STATEMENT, dict(city, id=city_id))
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.shards.rollback()
+            self.logger.error('%s could not be copied to every shard', city)
+            return {}, 500
+
         cur.close()
-        self.db.commit()
+        self.shards.commit()
+        self.cities.add(city_id, country_id, lat, lon)
+        self.cities.advance(before, after)
+        self.cache.invalidate('Orase')
 
-        self.logger.info(str(city) + ' was inserted in database with id ' + str(city_id))
+        self.logger.info('%s was inserted in database with id %s', city, city_id)
         return {'id': city_id}, 201
 
     def get(self):
+        # Listings are served from memory until they expire or the table is written to
+        cached = self.cached()
+        if cached:
+            if not_modified(cached[2]):
+                return not_modified_response(cached[2])
+            return cached
+        version = self.cache.version('Orase')
+
+        args = PARSER.parse_args()
+        try:
+            page = Page(args, [('id', 0, int)])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return {}, 400
+
+        headers = validators(self.db, ['orase'])
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        # Several cities can be read at once by their ids
+        query = QueryBuilder('SELECT * FROM Orase').where('id = ANY(%(ids)s)', {'ids': args['ids']})
+        page.apply(query)
+
         cur = self.db.cursor()
-        cur.execute('SELECT * FROM Orase;')
-        rows = cur.fetchall()
+        if Config.DB_JSON_RENDERING:
+            cur.execute(*render(query, CITY_JSON, page))
+            rows, next_headers = fetch_rendered(cur, page)
+        else:
+            cur.execute(*query.build())
+            rows, next_headers = page.finish(cur.fetchall())
+        headers.update(next_headers)
         cur.close()
 
         # Format response as a list of dictionaries
-        cols = ['id', 'idTara', 'nume', 'lat', 'lon']
-        rows = [dict(zip(cols, row)) for row in rows]
-        self.logger.info('Selected rows: ' + str(rows))
+        if not Config.DB_JSON_RENDERING:
+            rows = format_rows(CITY_COLUMNS, rows)
+        self.logger.info('Selected rows: %s', rows)
 
-        return rows, 200
+        self.cache.put(request.url, 'Orase', version, (rows, 200, headers))
+        return rows, 200, headers
 
     def put(self, id):
         city = request.get_json()
         err = self.check_put(city)
         if err:
             return {}, err
+        # The readings of a city stay on its shard, so its new id must belong to the same shard
+        if self.shards.city_shard(city['id']) != self.shards.city_shard(id):
+            self.logger.warning('city with id=%s can not take id %s of another shard', id, city['id'])
+            return {}, 400
+
+        # Orase is versioned in the same transaction as the write, to keep the city index current
+        before = self.cities.read_version(self.db)
 
         # Execute UPDATE SQL operation
         cur = self.db.cursor()
         try:
-            cur.execute("""
-                        UPDATE Orase
-                        SET id = %s, id_tara = %s, nume_oras = %s, latitudine = %s, longitudine = %s
-                        WHERE id = %s;
-                        """,
-                        (city['id'], city['idTara'], city['nume'], city['lat'], city['lon'], id))
+            execute(cur, UPDATE_STATEMENT, dict(city, current_id=id))
         except psycopg2.errors.DataError:
             cur.close()
             self.db.rollback()
-            self.logger.warning(id + ' not found in table')
+            self.logger.warning('%s not found in table', id)
             return {}, 404
         except psycopg2.errors.DatabaseError:
             cur.close()
             self.db.rollback()
-            self.logger.error(str(city) + ' could not be inserted in database')
+            self.logger.error('%s could not be inserted in database', city)
             return {}, 400
 
+        updated = cur.fetchone()
+
+        after = self.cities.read_version(self.db)
+
+        # Every shard holds a copy of the cities, with the same ids
+        try:
+            self.shards.mirror(UPDATE_STATEMENT, dict(city, current_id=id))
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.shards.rollback()
+            self.logger.error('%s could not be copied to every shard', city)
+            return {}, 500
+
         cur.close()
-        self.db.commit()
+        self.shards.commit()
+        if updated:
+            self.cities.remove(id)
+            self.cities.add(*updated)
+            self.cities.advance(before, after)
+        self.cache.invalidate('Orase')
 
-        self.logger.info('city with id=' + str(id) + ' was updated in database to ' + str(city))
+        self.logger.info('city with id=%s was updated in database to %s', id, city)
         return {}, 200
 
     def delete(self, id):
+        # Orase is versioned in the same transaction as the write, to keep the city index current
+        before = self.cities.read_version(self.db)
+
         # Execute DELETE SQL operation
         cur = self.db.cursor()
         try:
-            cur.execute("""
-                        DELETE FROM Orase
-                        WHERE id = %s;
-                        """,
-                        (id,))
+            execute(cur, DELETE_STATEMENT, {'id': id})
         except psycopg2.errors.DataError:
             cur.close()
             self.db.rollback()
-            self.logger.warning(id + ' not found in table')
+            self.logger.warning('%s not found in table', id)
             return {}, 404
         except psycopg2.errors.DatabaseError:
             cur.close()
             self.db.rollback()
-            self.logger.error('id=' + str(id) + ' could not be deleted from database')
+            self.logger.error('id=%s could not be deleted from database', id)
             return {}, 400
 
+        after = self.cities.read_version(self.db)
+
+        # Every shard holds a copy of the cities, with the same ids
+        try:
+            self.shards.mirror(DELETE_STATEMENT, {'id': id})
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.shards.rollback()
+            self.logger.error('id=%s could not be deleted from every shard', id)
+            return {}, 500
+
         cur.close()
-        self.db.commit()
+        self.shards.commit()
+        self.cities.remove(id)
+        self.cities.advance(before, after)
+        self.cache.invalidate('Orase')
 
-        self.logger.info('country with id=' + str(id) + ' was deleted from database')
+        self.logger.info('country with id=%s was deleted from database', id)
         return {}, 200
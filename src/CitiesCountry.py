@@ -1,24 +1,52 @@
-from flask_restful import Resource
+from flask import request
 
+import Config
+from Conditional import not_modified, not_modified_response, validators
+from DatabaseResource import DatabaseResource
+from Formatting import CITY_COLUMNS, CITY_JSON, format_rows
+from Pagination import PAGE_PARSER, Page
+from QueryBuilder import QueryBuilder
+from Rendering import fetch_rendered, render
 
-class CitiesCountry(Resource):
-    def __init__(self, **kwargs):
-        self.logger = kwargs['logger']
-        self.db = kwargs['db']
 
+class CitiesCountry(DatabaseResource):
     def get(self, id):
+        # Listings are served from memory until they expire or the table is written to
+        cached = self.cached()
+        if cached:
+            if not_modified(cached[2]):
+                return not_modified_response(cached[2])
+            return cached
+        version = self.cache.version('Orase')
+
+        args = PAGE_PARSER.parse_args()
+        try:
+            page = Page(args, [('id', 0, int)])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return {}, 400
+
+        headers = validators(self.db, ['orase'])
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        query = QueryBuilder('SELECT * FROM Orase').where('id_tara = %(id)s', {'id': id})
+        page.apply(query)
+
         cur = self.db.cursor()
-        cur.execute("""
-                    SELECT * FROM Orase
-                    WHERE id_tara = %s;
-                    """,
-                    (id,))
-        rows = cur.fetchall()
+        if Config.DB_JSON_RENDERING:
+            cur.execute(*render(query, CITY_JSON, page))
+            rows, next_headers = fetch_rendered(cur, page)
+        else:
+            cur.execute(*query.build())
+            rows, next_headers = page.finish(cur.fetchall())
+        headers.update(next_headers)
         cur.close()
 
         # Format response as a list of dictionaries
-        cols = ['id', 'idTara', 'nume', 'lat', 'lon']
-        rows = [dict(zip(cols, row)) for row in rows]
-        self.logger.info('Selected rows: ' + str(rows))
+        if not Config.DB_JSON_RENDERING:
+            rows = format_rows(CITY_COLUMNS, rows)
+        self.logger.info('Selected rows: %s', rows)
 
-        return rows, 200
+        self.cache.put(request.url, 'Orase', version, (rows, 200, headers))
+        return rows, 200, headers
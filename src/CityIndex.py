@@ -0,0 +1,201 @@
+import math
+import threading
+import time
+
+from Statements import execute, register
+
+# Mean radius of the Earth, in km
+EARTH_RADIUS = 6371.0088
+# Length of one degree of latitude, in km
+DEGREE_LENGTH = math.pi * EARTH_RADIUS / 180
+
+CITIES_QUERY = 'SELECT id, id_tara, latitudine, longitudine FROM Orase;'
+# Version of Orase, bumped by every write to it
+CITIES_VERSION_QUERY = "SELECT sum(versiune) FROM Versiuni WHERE tabel = 'orase';"
+CITIES_VERSION_STATEMENT = register('citeste_versiune_orase', CITIES_VERSION_QUERY)
+
+
+# Great-circle distance in km between two points given in degrees
+def distance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CityIndex:
+    # In-memory grid of city coordinates, resolving coordinates to city ids without querying Orase
+    def __init__(self, logger, cell_size, refresh_interval):
+        self.logger = logger
+        self.cell_size = cell_size
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        # Held by the one request reloading the index
+        self.loading = threading.Lock()
+
+        # City id -> (country id, latitude, longitude)
+        self.cities = {}
+        # Grid cell -> set of ids of the cities in that cell
+        self.cells = {}
+        # Country id -> set of ids of its cities
+        self.countries = {}
+        self.loaded_at = None
+        # Version of Orase the index was loaded from
+        self.version = None
+
+    def cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    # Version of Orase in the database, or None if the table versions are not available
+    def read_version(self, db):
+        cur = db.cursor()
+        execute(cur, CITIES_VERSION_STATEMENT)
+        row = cur.fetchone()
+        cur.close()
+        return row[0] if row else None
+
+    def load(self, db):
+        # The version is read first, so that the index never claims to be newer than its content
+        version = self.read_version(db)
+        cur = db.cursor()
+        cur.execute(CITIES_QUERY)
+        rows = cur.fetchall()
+        cur.close()
+        self.replace(rows, version)
+
+    # Replace the content of the index with (city id, country id, latitude, longitude) rows
+    def replace(self, rows, version=None):
+        with self.lock:
+            self.cities = {}
+            self.cells = {}
+            self.countries = {}
+            for city_id, country_id, lat, lon in rows:
+                self.add(city_id, country_id, lat, lon)
+            self.loaded_at = time.monotonic()
+            self.version = version
+        self.logger.info('Loaded %s cities in the city index', len(rows))
+
+    # Whether the index is older than the refresh interval, or than the given version of Orase.
+    # Cities written by other processes are only seen through the version or the interval.
+    def stale(self, version=None):
+        if version is not None and version != self.version:
+            return True
+        if not self.refresh_interval:
+            return False
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh_interval
+
+    # Reload the index if it is stale. Only one request reloads it at a time, the others keep using
+    # the current content meanwhile, unless there is none yet.
+    def refresh(self, db):
+        version = self.read_version(db)
+        if not self.stale(version):
+            return
+        if not self.loading.acquire(blocking=self.loaded_at is None):
+            return
+        try:
+            # Another request may have reloaded the index while this one waited
+            if self.stale(version):
+                self.load(db)
+        finally:
+            self.loading.release()
+
+    # Record a write of this process to Orase, already applied to the index, given the versions of Orase
+    # read before and after it in its transaction. An index that was stale before the write stays stale.
+    # A write committed by another process between the two reads is only seen through the refresh interval.
+    def advance(self, before, after):
+        with self.lock:
+            if before is not None and before == self.version:
+                self.version = after
+
+    def add(self, city_id, country_id, lat, lon):
+        lat, lon = float(lat), float(lon)
+        with self.lock:
+            self.remove(city_id)
+            self.cities[city_id] = (country_id, lat, lon)
+            self.cells.setdefault(self.cell(lat, lon), set()).add(city_id)
+            self.countries.setdefault(country_id, set()).add(city_id)
+
+    def remove(self, city_id):
+        with self.lock:
+            city = self.cities.pop(city_id, None)
+            if city is None:
+                return
+
+            cell = self.cell(city[1], city[2])
+            self.cells[cell].discard(city_id)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+            self.countries[city[0]].discard(city_id)
+            if not self.countries[city[0]]:
+                del self.countries[city[0]]
+
+    # Remove the cities of a deleted country, mirroring ON DELETE CASCADE
+    def remove_country(self, country_id):
+        with self.lock:
+            for city_id in list(self.countries.get(country_id, ())):
+                self.remove(city_id)
+
+    # Move the cities of a country to its new id, mirroring ON UPDATE CASCADE
+    def update_country(self, old_id, new_id):
+        with self.lock:
+            moved = self.countries.pop(old_id, set())
+            for city_id in moved:
+                self.cities[city_id] = (new_id,) + self.cities[city_id][1:]
+            if moved:
+                self.countries.setdefault(new_id, set()).update(moved)
+
+    # Ids of the cities of a country
+    def country_cities(self, country_id):
+        with self.lock:
+            return list(self.countries.get(country_id, ()))
+
+    # Ids of the cities whose coordinates are closer than tolerance to lat and lon.
+    # Either coordinate may be None, in which case it is not checked.
+    def lookup(self, lat, lon, tolerance):
+        with self.lock:
+            if lat is None or lon is None:
+                return [city_id for city_id, city in self.cities.items()
+                        if (lat is None or abs(city[1] - lat) < tolerance)
+                        and (lon is None or abs(city[2] - lon) < tolerance)]
+
+            low = self.cell(lat - tolerance, lon - tolerance)
+            high = self.cell(lat + tolerance, lon + tolerance)
+            return [city_id
+                    for cell in self.cells_between(low, high)
+                    for city_id in self.cells.get(cell, ())
+                    if abs(self.cities[city_id][1] - lat) < tolerance
+                    and abs(self.cities[city_id][2] - lon) < tolerance]
+
+    # Ids of the cities at most radius km away from lat and lon
+    def within(self, lat, lon, radius):
+        lat_span = radius / DEGREE_LENGTH
+        # Near the poles, a circle can cover every longitude
+        cos_lat = math.cos(math.radians(min(90.0, abs(lat) + lat_span)))
+        lon_span = 180.0 if cos_lat < 1e-6 else min(180.0, lat_span / cos_lat)
+
+        with self.lock:
+            low = self.cell(lat - lat_span, lon - lon_span)
+            high = self.cell(lat + lat_span, lon + lon_span)
+            if (high[0] - low[0] + 1) * (high[1] - low[1] + 1) > len(self.cells):
+                candidates = self.cities
+            else:
+                candidates = [city_id for cell in self.cells_between(low, high)
+                              for city_id in self.cells.get(cell, ())]
+
+            return [city_id for city_id in candidates
+                    if distance(lat, lon, self.cities[city_id][1], self.cities[city_id][2]) <= radius]
+
+    # Grid cells in the rectangle between two cells, wrapping around the antimeridian
+    def cells_between(self, low, high):
+        first, last = self.cell(0, -180)[1], self.cell(0, 180)[1]
+        cells_per_turn = math.ceil(360 / self.cell_size)
+
+        cells = set()
+        for row in range(low[0], high[0] + 1):
+            for col in range(low[1], high[1] + 1):
+                # A longitude past +-180 degrees is stored under its equivalent in range
+                for wrapped in (col, col - cells_per_turn, col + cells_per_turn):
+                    if first <= wrapped <= last:
+                        cells.add((row, wrapped))
+        return cells
@@ -0,0 +1,54 @@
+from flask import Response, request
+from werkzeug.http import http_date, parse_etags, quote_etag, unquote_etag
+
+from Statements import execute, register
+
+# Version and time of the latest change of every table, from the counters of the writing connections
+VERSIONS_QUERY = """
+                 SELECT sum(versiune), max(modificat)
+                 FROM Versiuni
+                 WHERE tabel = ANY(%(tables)s)
+                 GROUP BY tabel
+                 ORDER BY tabel;
+                 """
+VERSIONS_STATEMENT = register('citeste_versiuni', VERSIONS_QUERY)
+
+
+# ETag and Last-Modified headers of a response built from tables with the given (version, modified) rows.
+# Representations of the same rows in another format are told apart by their variant.
+def validator_headers(rows, variant=None):
+    tag = '-'.join(str(version) for version, _ in rows)
+    return {
+        'ETag': quote_etag(tag + '-' + variant if variant else tag),
+        'Last-Modified': http_date(max(modified for _, modified in rows))
+    }
+
+
+# Read the versions of the given tables, returning the ETag and Last-Modified headers
+# of a response built from them. They must be read before the rows, so that a response
+# never claims to be newer than its content.
+def validators(db, tables, variant=None):
+    cur = db.cursor()
+    execute(cur, VERSIONS_STATEMENT, {'tables': sorted(tables)})
+    rows = cur.fetchall()
+    cur.close()
+
+    return validator_headers(rows, variant)
+
+
+# Whether the client already holds the response described by the validator headers,
+# according to the If-None-Match header of the request (the current Flask request by default).
+# If-Modified-Since is ignored: the times of the changes are taken when they are made, not when they commit,
+# so a change committed after a response was read may still be dated before its Last-Modified.
+def not_modified(headers, request_headers=None):
+    if request_headers is None:
+        request_headers = request.headers
+
+    if request_headers.get('If-None-Match'):
+        etags = parse_etags(request_headers.get('If-None-Match'))
+        return etags.contains_weak(unquote_etag(headers['ETag'])[0])
+    return False
+
+
+def not_modified_response(headers):
+    return Response(status=304, headers=headers)
@@ -0,0 +1,93 @@
+import os
+
+# Database connection settings
+DB_HOST = os.environ.get('DB_HOST', 'postgresql')
+DB_NAME = os.environ.get('DB_NAME', 'measurements')
+DB_USER = os.environ.get('DB_USER', 'pgsql')
+DB_PASSWORD = os.environ.get('DB_PASSWORD', 'pgsql')
+
+# Read-only replicas serving the GET requests, as a comma separated list of host[:port] entries
+DB_REPLICA_HOSTS = os.environ.get('DB_REPLICA_HOSTS', '')
+# Seconds a replica that could not be connected to is left out of the rotation
+DB_REPLICA_RETRY = float(os.environ.get('DB_REPLICA_RETRY', 10))
+# Seconds a read waits for a free connection of a busy replica before trying the next server
+DB_REPLICA_WAIT = float(os.environ.get('DB_REPLICA_WAIT', 0.05))
+# Seconds the reads of a client that wrote are sent to the primary, so that it sees its own writes (0 never)
+DB_READ_YOUR_WRITES = int(os.environ.get('DB_READ_YOUR_WRITES', 5))
+
+# Databases the readings are sharded over by city, besides DB_HOST, as a comma separated list of host[:port] entries.
+# Every shard must have the schema of create-table.sql; countries and cities are copied to all of them.
+DB_SHARD_HOSTS = os.environ.get('DB_SHARD_HOSTS', '')
+
+# Connection pool settings
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+# Seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Connections idle for longer than this many seconds are pinged before reuse
+DB_POOL_CHECK_INTERVAL = float(os.environ.get('DB_POOL_CHECK_INTERVAL', 30))
+
+# Largest number of readings accepted by a single batch request
+BATCH_MAX_RECORDS = int(os.environ.get('BATCH_MAX_RECORDS', 10000))
+
+# Largest number of ids accepted by the ids argument of batched reads
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', 1000))
+
+# Whether single readings are queued and inserted in groups, with one commit per group
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+# Largest number of readings in a group, and milliseconds a reading waits for its group to fill
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', 500))
+WRITE_BEHIND_INTERVAL = int(os.environ.get('WRITE_BEHIND_INTERVAL', 10))
+
+# Days after which readings are moved to compressed archive segments, a month at a time (0 never archives).
+# Archived readings are still listed, but are immutable: PUT and DELETE on them return 404.
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+# Seconds between the checks for readings to archive
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+
+# Events queued for a live feed subscriber before its stream is ended for being too slow
+LIVE_FEED_QUEUE_SIZE = int(os.environ.get('LIVE_FEED_QUEUE_SIZE', 1000))
+# Seconds between the heartbeats sent to idle live feed subscribers
+LIVE_FEED_HEARTBEAT = float(os.environ.get('LIVE_FEED_HEARTBEAT', 15))
+# Seconds waited before reconnecting the live feed listener after its connection was lost
+LIVE_FEED_RETRY = float(os.environ.get('LIVE_FEED_RETRY', 1))
+
+# Number of rows fetched at a time from server-side cursors when streaming responses
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 2000))
+
+# Page size of list requests that don't set a limit, 0 returns every row
+PAGE_LIMIT_DEFAULT = int(os.environ.get('PAGE_LIMIT_DEFAULT', 0))
+# Largest page size a client can request
+PAGE_LIMIT_MAX = int(os.environ.get('PAGE_LIMIT_MAX', 10000))
+
+# Largest number of buckets returned at once by downsampled temperature listings
+DOWNSAMPLE_MAX_POINTS = int(os.environ.get('DOWNSAMPLE_MAX_POINTS', 5000))
+
+# Whether list responses are rendered as JSON by the database instead of by the API
+DB_JSON_RENDERING = os.environ.get('DB_JSON_RENDERING', '0') == '1'
+
+# Size in degrees of the grid cells of the in-memory city index
+CITY_INDEX_CELL_SIZE = float(os.environ.get('CITY_INDEX_CELL_SIZE', 0.5))
+# Seconds after which the city index is reloaded, picking up writes made by other processes (0 never reloads)
+CITY_INDEX_REFRESH = float(os.environ.get('CITY_INDEX_REFRESH', 60))
+
+# Number of country and city listings kept in the in-memory cache
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 1024))
+# Seconds a cached listing is served before being read again from the database. Writes only invalidate the cache
+# of the worker process that handled them, so the other workers may serve stale listings for this long.
+METADATA_CACHE_TTL = float(os.environ.get('METADATA_CACHE_TTL', 60))
+
+# Server used to serve the API: 'flask' for the Flask development server, 'async' for the asyncio server,
+# 'production' for the multi-process server
+SERVER_MODE = os.environ.get('SERVER_MODE', 'flask')
+
+# Worker processes of the production server, each with its own connection pool
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1))
+# Threads serving requests in every worker process
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 4))
+# Live feed streams open at once in every process of the threaded servers. Every stream holds a thread while it
+# is open, so further streams are answered 503 to leave threads to the other requests. The asyncio server
+# has no such limit.
+LIVE_FEED_MAX_STREAMS = int(os.environ.get('LIVE_FEED_MAX_STREAMS', SERVER_THREADS // 2))
+# Seconds workers are given to finish their in-flight requests when shutting down or reloading
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from Metrics import TimedCursor
+from Statements import PreparedConnection, prepare
+
+
+class ConnectionPool:
+    def __init__(self, logger, minconn, maxconn, timeout, check_interval, **dsn):
+        self.logger = logger
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.dsn = dsn
+
+        # Idle connections, as (connection, time it was returned) pairs
+        self.idle = deque()
+        # Number of open connections, both idle and checked out
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+        for _ in range(minconn):
+            self.idle.append((self.connect(), time.monotonic()))
+            self.size += 1
+
+    # Open a connection, with the fixed statements of the service prepared in its session
+    def connect(self):
+        self.logger.info('Connecting to database')
+        conn = psycopg2.connect(connection_factory=PreparedConnection, cursor_factory=TimedCursor, **self.dsn)
+        prepare(conn, self.logger)
+        return conn
+
+    # Check that an idle connection can still be used
+    def healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    # Forget about a connection that was closed or found broken
+    def discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    # Check out a connection, waiting at most timeout seconds (the timeout of the pool by default) for a free one
+    def getconn(self, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        conn = None
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise psycopg2.pool.PoolError('connection pool is closed')
+                if self.idle:
+                    conn, idle_since = self.idle.pop()
+                    break
+                if self.size < self.maxconn:
+                    self.size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError('connection pool exhausted')
+                self.cond.wait(remaining)
+
+        # Health checks and reconnects happen outside the lock, so they don't block other requests
+        if conn is not None:
+            if self.healthy(conn, idle_since):
+                return conn
+            self.logger.warning('Discarding broken database connection')
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+        try:
+            return self.connect()
+        except psycopg2.Error:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def putconn(self, conn):
+        if conn.closed or self.closed:
+            self.discard(conn)
+            return
+
+        # Never hand out a connection with an open or failed transaction
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            self.discard(conn)
+            return
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self.discard(conn)
+                return
+
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    def closeall(self):
+        with self.cond:
+            self.closed = True
+            while self.idle:
+                conn, _ = self.idle.pop()
+                conn.close()
+                self.size -= 1
+            self.cond.notify_all()
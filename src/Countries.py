@@ -1,29 +1,57 @@
 import psycopg2
 from flask import request
-from flask_restful import Resource
-
-
-class Countries(Resource):
-    def __init__(self, **kwargs):
-        self.logger = kwargs['logger']
-        self.db = kwargs['db']
 
+import Config
+from Conditional import not_modified, not_modified_response, validators
+from DatabaseResource import DatabaseResource
+from Formatting import COUNTRY_COLUMNS, COUNTRY_JSON, format_rows
+from Pagination import PAGE_PARSER, Page
+from QueryBuilder import QueryBuilder
+from Rendering import fetch_rendered, render
+from Statements import execute, register
+
+# Statements writing a country, also applied to the copies of the other shards
+INSERT_QUERY = """
+               INSERT INTO Tari(nume_tara, latitudine, longitudine)
+               VALUES (%(nume)s, %(lat)s, %(lon)s)
+               RETURNING id;
+               """
+MIRROR_INSERT_QUERY = """
+                      INSERT INTO Tari(id, nume_tara, latitudine, longitudine)
+                      VALUES (%(id)s, %(nume)s, %(lat)s, %(lon)s);
+                      """
+UPDATE_QUERY = """
+               UPDATE Tari
+               SET id = %(id)s, nume_tara = %(nume)s, latitudine = %(lat)s, longitudine = %(lon)s
+               WHERE id = %(current_id)s;
+               """
+DELETE_QUERY = """
+               DELETE FROM Tari
+               WHERE id = %(id)s;
+               """
+INSERT_STATEMENT = register('insereaza_tara', INSERT_QUERY)
+MIRROR_INSERT_STATEMENT = register('copiaza_tara', MIRROR_INSERT_QUERY)
+UPDATE_STATEMENT = register('actualizeaza_tara', UPDATE_QUERY)
+DELETE_STATEMENT = register('sterge_tara', DELETE_QUERY)
+
+
+class Countries(DatabaseResource):
     # Check that the request body is correctly formatted as a country
     def check_country(self, req):
         if 'nume' not in req or 'lat' not in req or 'lon' not in req:
-            self.logger.warning('request ' + str(req) + ' does not contain a country')
+            self.logger.warning('request %s does not contain a country', req)
             return 400
 
         try:
             float(req['lat'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', latitude is not a real number')
+            self.logger.warning('in request %s, latitude is not a real number', req)
             return 400
 
         try:
             float(req['lon'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', longitude is not a real number')
+            self.logger.warning('in request %s, longitude is not a real number', req)
             return 400
 
         return None
@@ -31,7 +59,7 @@ class Countries(Resource):
     # Check that the request body is correctly formatted for POST request
     def check_post(self, req):
         if len(req) != 3:
-            self.logger.warning('request ' + str(req) + ' does not contain correct number of parameters')
+            self.logger.warning('request %s does not contain correct number of parameters', req)
             return 400
 
         return self.check_country(req)
@@ -39,15 +67,15 @@ class Countries(Resource):
     # Check that the request body is correctly formatted for PUT request
     def check_put(self, req):
         if len(req) != 4:
-            self.logger.warning('request ' + str(req) + ' does not contain correct number of parameters')
+            self.logger.warning('request %s does not contain correct number of parameters', req)
             return 400
         if 'id' not in req:
-            self.logger.warning('request ' + str(req) + ' does not contain an id')
+            self.logger.warning('request %s does not contain an id', req)
             return 400
         try:
             int(req['id'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', id is not an integer')
+            self.logger.warning('in request %s, id is not an integer', req)
             return 400
 
         return self.check_country(req)
@@ -61,21 +89,16 @@ class Countries(Resource):
         # Execute INSERT SQL operation
         cur = self.db.cursor()
         try:
-            cur.execute("""
-                        INSERT INTO Tari(nume_tara, latitudine, longitudine)
-                        VALUES (%(nume)s, %(lat)s, %(lon)s)
-                        RETURNING id;
-                        """,
-                        country)
+            execute(cur, INSERT_STATEMENT, country)
         except psycopg2.errors.UniqueViolation:
             cur.close()
             self.db.rollback()
-            self.logger.warning(country['nume'] + ' already exists in table')
+            self.logger.warning('%s already exists in table', country['nume'])
             return {}, 409
         except psycopg2.errors.DatabaseError:
             cur.close()
             self.db.rollback()
-            self.logger.error(str(country) + ' could not be inserted in database')
+            self.logger.error('%s could not be inserted in database', country)
             return {}, 409
 
         # Retrieve ID of country, if the insert was succesful
@@ -84,27 +107,64 @@ class Countries(Resource):
         except psycopg2.ProgrammingError:
             cur.close()
             self.db.rollback()
-            self.logger.error(str(country) + ' could not be inserted in database')
+            self.logger.error('%s could not be inserted in database', country)
             return {}, 400
 
+        # Every shard holds a copy of the countries, with the same ids
+        try:
+            self.shards.mirror(MIRROR_INSERT_STATEMENT, dict(country, id=country_id))
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.shards.rollback()
+            self.logger.error('%s could not be copied to every shard', country)
+            return {}, 500
+
         cur.close()
-        self.db.commit()
+        self.shards.commit()
+        self.cache.invalidate('Tari')
 
-        self.logger.info(str(country) + ' was inserted in database with id ' + str(country_id))
+        self.logger.info('%s was inserted in database with id %s', country, country_id)
         return {'id': country_id}, 201
 
     def get(self):
+        # Listings are served from memory until they expire or the table is written to
+        cached = self.cached()
+        if cached:
+            if not_modified(cached[2]):
+                return not_modified_response(cached[2])
+            return cached
+        version = self.cache.version('Tari')
+
+        args = PAGE_PARSER.parse_args()
+        try:
+            page = Page(args, [('id', 0, int)])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return {}, 400
+
+        headers = validators(self.db, ['tari'])
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        query = page.apply(QueryBuilder('SELECT * FROM Tari'))
+
         cur = self.db.cursor()
-        cur.execute('SELECT * FROM Tari;')
-        rows = cur.fetchall()
+        if Config.DB_JSON_RENDERING:
+            cur.execute(*render(query, COUNTRY_JSON, page))
+            rows, next_headers = fetch_rendered(cur, page)
+        else:
+            cur.execute(*query.build())
+            rows, next_headers = page.finish(cur.fetchall())
+        headers.update(next_headers)
         cur.close()
 
         # Format response as a list of dictionaries
-        cols = ['id', 'nume', 'lat', 'lon']
-        rows = [dict(zip(cols, row)) for row in rows]
-        self.logger.info('Selected rows: ' + str(rows))
+        if not Config.DB_JSON_RENDERING:
+            rows = format_rows(COUNTRY_COLUMNS, rows)
+        self.logger.info('Selected rows: %s', rows)
 
-        return rows, 200
+        self.cache.put(request.url, 'Tari', version, (rows, 200, headers))
+        return rows, 200, headers
 
     def put(self, id):
         country = request.get_json()
@@ -112,54 +172,84 @@ class Countries(Resource):
         if err:
             return {}, err
 
+        # Orase is versioned in the same transaction as the write, to keep the city index current
+        before = self.cities.read_version(self.db)
+
         # Execute UPDATE SQL operation
         cur = self.db.cursor()
         try:
-            cur.execute("""
-                        UPDATE Tari
-                        SET id = %s, nume_tara = %s, latitudine = %s, longitudine = %s
-                        WHERE id = %s;
-                        """,
-                        (country['id'], country['nume'], country['lat'], country['lon'], id))
+            execute(cur, UPDATE_STATEMENT, dict(country, current_id=id))
         except psycopg2.errors.DataError:
             cur.close()
             self.db.rollback()
-            self.logger.warning(id + ' not found in table')
+            self.logger.warning('%s not found in table', id)
             return {}, 404
         except psycopg2.errors.DatabaseError:
             cur.close()
             self.db.rollback()
-            self.logger.error(str(country) + ' could not be inserted in database')
+            self.logger.error('%s could not be inserted in database', country)
             return {}, 400
 
-        cur.close()
-        self.db.commit()
+        updated = cur.rowcount
 
-        self.logger.info('country with id=' + str(id) + ' was updated in database to ' + str(country))
+        after = self.cities.read_version(self.db)
+
+        # Every shard holds a copy of the countries, with the same ids
+        try:
+            self.shards.mirror(UPDATE_STATEMENT, dict(country, current_id=id))
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.shards.rollback()
+            self.logger.error('%s could not be copied to every shard', country)
+            return {}, 500
+
+        cur.close()
+        self.shards.commit()
+        if updated:
+            self.cities.update_country(id, int(country['id']))
+            self.cities.advance(before, after)
+        # Cities refer to their country, so a change of id cascades to them
+        self.cache.invalidate('Tari', 'Orase')
+
+        self.logger.info('country with id=%s was updated in database to %s', id, country)
         return {}, 200
 
     def delete(self, id):
+        # Orase is versioned in the same transaction as the write, to keep the city index current
+        before = self.cities.read_version(self.db)
+
         # Execute DELETE SQL operation
         cur = self.db.cursor()
         try:
-            cur.execute("""
-                        DELETE FROM Tari
-                        WHERE id = %s;
-                        """,
-                        (id,))
+            execute(cur, DELETE_STATEMENT, {'id': id})
         except psycopg2.errors.DataError:
             cur.close()
             self.db.rollback()
-            self.logger.warning(id + ' not found in table')
+            self.logger.warning('%s not found in table', id)
             return {}, 404
         except psycopg2.errors.DatabaseError:
             cur.close()
             self.db.rollback()
-            self.logger.error('id=' + str(id) + ' could not be deleted from database')
+            self.logger.error('id=%s could not be deleted from database', id)
             return {}, 400
 
+        after = self.cities.read_version(self.db)
+
+        # Every shard holds a copy of the countries, with the same ids
+        try:
+            self.shards.mirror(DELETE_STATEMENT, {'id': id})
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.shards.rollback()
+            self.logger.error('id=%s could not be deleted from every shard', id)
+            return {}, 500
+
         cur.close()
-        self.db.commit()
+        self.shards.commit()
+        self.cities.remove_country(id)
+        self.cities.advance(before, after)
+        # Deleting a country cascades to its cities
+        self.cache.invalidate('Tari', 'Orase')
 
-        self.logger.info('country with id=' + str(id) + ' was deleted from database')
+        self.logger.info('country with id=%s was deleted from database', id)
         return {}, 200
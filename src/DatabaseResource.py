@@ -0,0 +1,26 @@
+from flask import request
+from flask_restful import Resource
+
+
+class DatabaseResource(Resource):
+    def __init__(self, **kwargs):
+        self.logger = kwargs['logger']
+        self.router = kwargs['router']
+        self.cities = kwargs['cities']
+        self.cache = kwargs['cache']
+        self.metrics = kwargs['metrics']
+        self.writer = kwargs['writer']
+        self.feed = kwargs['feed']
+        self.shards = kwargs['shards']
+
+    # Connection of the current request, to a replica for reads, returned to its pool when the request ends
+    @property
+    def db(self):
+        return self.router.connection()
+
+    # Cached response to the current request, if any. Clients that read their own writes from the primary
+    # skip the cache, which may hold a response read by another client from a lagging replica.
+    def cached(self):
+        if self.router.reads_primary():
+            return None
+        return self.cache.get(request.url)
@@ -0,0 +1,65 @@
+import datetime
+import re
+
+import Config
+from Metrics import timed_phase
+from Pagination import Page
+from QueryBuilder import QueryBuilder
+
+# Units of the interval argument
+INTERVAL_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+INTERVAL_PATTERN = re.compile(r'^([1-9][0-9]*)([mhd])$')
+
+# Buckets start at multiples of the interval since this date
+ORIGIN = datetime.datetime(2000, 1, 1)
+
+# Buckets are sorted by their start
+BUCKET_KEYS = [('inceput', 0, datetime.datetime.fromisoformat)]
+
+# Format of the start of a bucket in responses
+BUCKET_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# Parse an interval argument like 15m, 1h or 1d, raising ValueError if it is invalid
+def parse_interval(text):
+    match = INTERVAL_PATTERN.match(text)
+    if not match:
+        raise ValueError(text + ' is not an interval like 15m, 1h or 1d')
+    return datetime.timedelta(**{INTERVAL_UNITS[match.group(2)]: int(match.group(1))})
+
+
+# Page of buckets, never longer than the configured number of points
+def bucket_page(args):
+    cap = Config.DOWNSAMPLE_MAX_POINTS
+    return Page(dict(args, limit=min(args['limit'] or cap, cap)), BUCKET_KEYS)
+
+
+# Query grouping the temperatures selected by a resource (on the given shard) into one bucket per interval,
+# with the count, average, minimum and maximum of each bucket
+def bucket_query(resource, args, page, shard=None):
+    # The next page starts with the readings after the last bucket, a range that can use an index
+    # and that skips the archive segments of the earlier pages
+    if page.after:
+        start = page.after[0] + args['interval']
+        args = dict(args, **{'from': start if args['from'] is None else max(args['from'], start)})
+
+    sql, params = resource.query(args, Page(args, resource.page_keys, paginate=False), shard).build()
+    query = QueryBuilder('SELECT date_bin(%(interval)s, b.timestamp, %(origin)s) AS inceput, count(*), '
+                         'avg(b.valoare), min(b.valoare), max(b.valoare) FROM (' + sql.rstrip(';') + ') b',
+                         dict(params, interval=args['interval'], origin=ORIGIN))
+    query.group_by('1').order_by('1')
+    return query.limit_to(page.limit + 1)
+
+
+# Combine the buckets of several shards starting at the same time into one
+def combine_buckets(rows):
+    count = sum(row[1] for row in rows)
+    return (rows[0][0], count, sum(row[1] * row[2] for row in rows) / count,
+            min(row[3] for row in rows), max(row[4] for row in rows))
+
+
+# Format buckets as a list of dictionaries
+@timed_phase('shape')
+def format_buckets(rows):
+    return [{'timestamp': start.strftime(BUCKET_FORMAT), 'count': count, 'avg': average, 'min': low, 'max': high}
+            for start, count, average, low, high in rows]
@@ -0,0 +1,35 @@
+from Metrics import timed_phase
+
+# Response fields of the columns selected for each table
+COUNTRY_COLUMNS = ['id', 'nume', 'lat', 'lon']
+CITY_COLUMNS = ['id', 'idTara', 'nume', 'lat', 'lon']
+TEMPERATURE_COLUMNS = ['id', 'valoare', 'timestamp']
+
+# Format of the dates of temperatures in responses
+DATE_FORMAT = '%Y-%m-%d'
+
+
+# Format rows as a list of dictionaries
+@timed_phase('shape')
+def format_rows(cols, rows):
+    return [dict(zip(cols, row)) for row in rows]
+
+
+@timed_phase('shape')
+def format_temperatures(rows):
+    rows = format_rows(TEMPERATURE_COLUMNS, rows)
+    for row in rows:
+        row['timestamp'] = row['timestamp'].strftime(DATE_FORMAT)
+    return rows
+
+
+# SQL expressions rendering a row of each table as the JSON object of its response fields,
+# written exactly as the json module writes the formatted rows
+COUNTRY_JSON = ("""'{"id": ' || q.id || ', "nume": ' || to_json(q.nume_tara)::text"""
+                """ || ', "lat": ' || valoare_json(q.latitudine) || ', "lon": ' || valoare_json(q.longitudine)"""
+                """ || '}'""")
+CITY_JSON = ("""'{"id": ' || q.id || ', "idTara": ' || q.id_tara || ', "nume": ' || to_json(q.nume_oras)::text"""
+             """ || ', "lat": ' || valoare_json(q.latitudine) || ', "lon": ' || valoare_json(q.longitudine)"""
+             """ || '}'""")
+TEMPERATURE_JSON = ("""'{"id": ' || q.id || ', "valoare": ' || valoare_json(q.valoare)"""
+                    """ || ', "timestamp": "' || to_char(q.timestamp, 'YYYY-MM-DD') || '"}'""")
@@ -0,0 +1,182 @@
+import asyncio
+import datetime
+import json
+import queue
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from Formatting import format_temperatures
+
+# Channel the database publishes new readings on, see publica_temperaturi() in create-table.sql
+CHANNEL = 'temperaturi'
+# Registers the session listening to the channel, as readings are only published while a listener is connected
+REGISTER_QUERY = 'SELECT inregistreaza_ascultator();'
+
+# Comment sent to idle subscribers, so that proxies keep their connection open and closed ones are noticed
+HEARTBEAT = ': heartbeat\n\n'
+EVENT_STREAM = 'text/event-stream'
+EVENT_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+# Server-sent event of a published reading, with the fields of the temperature listings and its city,
+# returned with the city and country of the reading
+def format_event(payload):
+    reading = json.loads(payload)
+    data = format_temperatures([(reading['id'], reading['valoare'],
+                                 datetime.datetime.fromisoformat(reading['timestamp']))])[0]
+    data['idOras'] = reading['idOras']
+    return reading['idOras'], reading['idTara'], 'id: %s\nevent: temperature\ndata: %s\n\n' % (
+        reading['id'], json.dumps(data))
+
+
+class Subscription:
+    # Events of the readings of a city, of a country or of every city, waiting to be sent to a client.
+    # events is a queue.Queue for threads or an asyncio.Queue for the asyncio server; None ends the stream.
+    def __init__(self, city_id, country_id, events):
+        self.city_id = city_id
+        self.country_id = country_id
+        self.events = events
+
+    def matches(self, city_id, country_id):
+        return ((self.city_id is None or self.city_id == city_id) and
+                (self.country_id is None or self.country_id == country_id))
+
+    # Queue an event, ending the stream of clients that can't keep up instead of buffering without bound
+    def offer(self, event):
+        try:
+            self.events.put_nowait(event)
+            return True
+        except (queue.Full, asyncio.QueueFull):
+            self.end()
+            return False
+
+    # End the stream once the client has read the queued events, dropping the oldest ones if the queue is full.
+    # The client may be reading the queue meanwhile, so it is never expected to hold anything.
+    def end(self):
+        while True:
+            try:
+                self.events.put_nowait(None)
+                return
+            except (queue.Full, asyncio.QueueFull):
+                try:
+                    self.events.get_nowait()
+                except (queue.Empty, asyncio.QueueEmpty):
+                    pass
+
+
+class Subscribers:
+    # Subscriptions of this process, receiving the readings published by the database
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+
+    def add(self, subscription):
+        with self.lock:
+            self.subscriptions.add(subscription)
+
+    def remove(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    # Send a notification of the database to every matching subscription, formatting it only once
+    def publish(self, payload):
+        try:
+            city_id, country_id, event = format_event(payload)
+        except (ValueError, KeyError, TypeError):
+            self.logger.error('notification %s is not a reading', payload)
+            return
+
+        with self.lock:
+            for subscription in list(self.subscriptions):
+                if subscription.matches(city_id, country_id) and not subscription.offer(event):
+                    self.logger.warning('subscriber of city=%s country=%s is too slow, ending its stream',
+                                        subscription.city_id, subscription.country_id)
+                    self.subscriptions.discard(subscription)
+
+    # End every stream, so that clients reconnect knowing they may have missed readings
+    def end_all(self):
+        with self.lock:
+            for subscription in self.subscriptions:
+                subscription.end()
+            self.subscriptions.clear()
+
+
+class LiveFeed(Subscribers):
+    # Listener of the readings published by the databases of every shard, given by their connection settings,
+    # on connections of its own outside of the pools. They are opened by the first subscription of the process
+    # and kept afterwards.
+    def __init__(self, logger, queue_size, retry_interval, max_streams, dsns):
+        super().__init__(logger)
+        self.queue_size = queue_size
+        self.retry_interval = retry_interval
+        # Streams served at once, each holding a thread of the server
+        self.max_streams = max_streams
+        self.dsns = dsns
+
+        self.stopped = threading.Event()
+        self.threads = []
+
+    # Whether the process already serves max_streams streams
+    def full(self):
+        with self.lock:
+            return len(self.subscriptions) >= self.max_streams
+
+    # Subscribe to the readings of a city, of a country or of every city, if both are None.
+    # Returns None if the process already serves max_streams streams.
+    def subscribe(self, city_id, country_id):
+        subscription = Subscription(city_id, country_id, queue.Queue(self.queue_size))
+        with self.lock:
+            if self.stopped.is_set():
+                subscription.end()
+                return subscription
+            if len(self.subscriptions) >= self.max_streams:
+                return None
+            if not self.threads:
+                for dsn in self.dsns:
+                    thread = threading.Thread(target=self.run, args=(dsn,), name='live-feed', daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def run(self, dsn):
+        while not self.stopped.is_set():
+            try:
+                self.listen(dsn)
+            except psycopg2.Error:
+                self.logger.error('live feed connection lost, reconnecting')
+            except Exception:
+                # The thread is never started again, so it must outlive any failure
+                self.logger.exception('live feed listener failed, reconnecting')
+            # Readings published while reconnecting are missed
+            self.end_all()
+            self.stopped.wait(self.retry_interval)
+
+    def listen(self, dsn):
+        conn = psycopg2.connect(**dsn)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute('LISTEN ' + CHANNEL + ';')
+            cur.execute(REGISTER_QUERY)
+            cur.close()
+
+            while not self.stopped.is_set():
+                # Waits are bounded so that closing the feed is noticed
+                if not select.select([conn], [], [], 1)[0]:
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self.publish(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.end_all()
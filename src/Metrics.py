@@ -0,0 +1,182 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2.extensions
+from flask import g, has_request_context, request
+
+# Upper bounds of the histogram buckets, for durations in seconds and for row counts and sizes in bytes
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# Name, type, description and buckets of every metric
+METRICS = {
+    'request_duration_seconds': ('histogram', 'Time spent serving requests', DURATION_BUCKETS),
+    'phase_duration_seconds': ('histogram', 'Time spent in each phase of the requests: parse (until the first '
+                               'query), execute, fetch, shape and serialize', DURATION_BUCKETS),
+    'rows_fetched': ('histogram', 'Rows fetched from the database per request', SIZE_BUCKETS),
+    'response_bytes': ('histogram', 'Size of the response bodies, unless streamed', SIZE_BUCKETS),
+    'requests_total': ('counter', 'Requests served, by status', None),
+}
+PREFIX = 'weatherstation_'
+
+
+# Add the time spent in a phase to the current Flask request. Phases nested in a phase
+# of the same name are not counted twice. Outside of Flask requests, nothing is recorded.
+@contextmanager
+def timed(phase):
+    if not has_request_context() or 'phases' not in g or phase in g.active_phases:
+        yield
+        return
+
+    g.active_phases.add(phase)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.phases[phase] = g.phases.get(phase, 0) + time.perf_counter() - started
+        g.active_phases.discard(phase)
+
+
+# Decorate a function so that its calls are timed as the given phase
+def timed_phase(phase):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_rows(count):
+    if has_request_context() and 'phases' in g:
+        g.rows += count
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Cursor timing its queries and fetches as phases of the current request.
+    # The time before the first query of a request is its parsing and validation.
+    def execute(self, query, vars=None):
+        if has_request_context() and 'phases' in g and 'parse' not in g.phases:
+            g.phases['parse'] = time.perf_counter() - g.request_started
+        with timed('execute'):
+            return super().execute(query, vars)
+
+    def fetchone(self):
+        with timed('fetch'):
+            row = super().fetchone()
+        count_rows(1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        with timed('fetch'):
+            rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        with timed('fetch'):
+            rows = super().fetchall()
+        count_rows(len(rows))
+        return rows
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+# Labels formatted for the exposition format
+def format_labels(labels):
+    return ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                    for name, value in labels)
+
+
+class Metrics:
+    # Histograms and counters of the requests served by an application, per endpoint and method
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Histograms and counters of every metric, by their labels
+        self.values = {name: {} for name in METRICS}
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histograms = self.values[name]
+            if labels not in histograms:
+                histograms[labels] = Histogram(METRICS[name][2])
+            histograms[labels].observe(value)
+
+    def increment(self, name, labels):
+        with self.lock:
+            self.values[name][labels] = self.values[name].get(labels, 0) + 1
+
+    # Record the metrics of every request of a Flask application
+    def init_app(self, app):
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.request_started = time.perf_counter()
+        g.phases = {}
+        g.active_phases = set()
+        g.rows = 0
+
+    # Streamed responses are recorded once they are sent, with the phases of their generator
+    def finish(self, response):
+        if 'phases' not in g:
+            return response
+        labels = (('endpoint', request.endpoint or 'none'), ('method', request.method))
+        started, phases, size = g.request_started, g.phases, response.content_length
+        state = g._get_current_object()
+
+        def record():
+            self.observe('request_duration_seconds', labels, time.perf_counter() - started)
+            for phase, elapsed in phases.items():
+                self.observe('phase_duration_seconds', labels + (('phase', phase),), elapsed)
+            self.observe('rows_fetched', labels, state.rows)
+            if size is not None:
+                self.observe('response_bytes', labels, size)
+            self.increment('requests_total', labels + (('status', response.status_code),))
+
+        if response.is_streamed:
+            response.call_on_close(record)
+        else:
+            record()
+        return response
+
+    # Text exposition format of Prometheus
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, description, buckets) in METRICS.items():
+                metric = PREFIX + name
+                lines.append('# HELP ' + metric + ' ' + description)
+                lines.append('# TYPE ' + metric + ' ' + kind)
+                for labels, value in sorted(self.values[name].items()):
+                    if kind == 'counter':
+                        lines.append(metric + '{' + format_labels(labels) + '} ' + str(value))
+                        continue
+
+                    cumulative = 0
+                    for bound, count in zip(buckets, value.counts):
+                        cumulative += count
+                        lines.append(metric + '_bucket{' + format_labels(labels + (('le', bound),)) + '} ' +
+                                     str(cumulative))
+                    lines.append(metric + '_bucket{' + format_labels(labels + (('le', '+Inf'),)) + '} ' +
+                                 str(value.count))
+                    lines.append(metric + '_sum{' + format_labels(labels) + '} ' + repr(value.sum))
+                    lines.append(metric + '_count{' + format_labels(labels) + '} ' + str(value.count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,9 @@
+from flask import Response
+
+from DatabaseResource import DatabaseResource
+
+
+class MetricsExport(DatabaseResource):
+    # Metrics of the requests served by this process, in the text format scraped by Prometheus
+    def get(self):
+        return Response(self.metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,117 @@
+import base64
+import binascii
+import datetime
+import json
+from urllib.parse import urlencode
+
+from flask import request
+from flask_restful import reqparse
+
+import Config
+
+
+def add_page_arguments(parser):
+    parser.add_argument('limit', default=None, required=False, type=int, location='args')
+    parser.add_argument('next', default=None, required=False, type=str, location='args')
+
+
+# Parser of listings taking no other arguments than those of their pages, built once
+PAGE_PARSER = reqparse.RequestParser()
+add_page_arguments(PAGE_PARSER)
+
+
+# Encode the sort key of the last row of a page as an opaque token
+def encode_token(key):
+    key = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+# Decode a token created by encode_token, parsing each value with the matching type
+def decode_token(token, types):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('invalid page token ' + token)
+    if not isinstance(key, list) or len(key) != len(types):
+        raise ValueError('invalid page token ' + token)
+
+    try:
+        return tuple(parse(value) for parse, value in zip(types, key))
+    except (TypeError, OverflowError):
+        raise ValueError('invalid page token ' + token)
+
+
+class Page:
+    # Keyset page of a list request, sorted by keys given as (column, index in row, type) tuples.
+    # Unless paginate is set, every row is returned. Raises ValueError if the limit or next arguments are invalid.
+    def __init__(self, args, keys, paginate=True):
+        self.keys = keys
+        if not paginate:
+            args = {'limit': None, 'next': None}
+
+        limit = args['limit'] or Config.PAGE_LIMIT_DEFAULT
+        if limit < 0:
+            raise ValueError('negative page limit ' + str(limit))
+        self.limit = min(limit, Config.PAGE_LIMIT_MAX) if limit else None
+
+        self.after = None
+        if args['next']:
+            self.after = decode_token(args['next'], [key[2] for key in keys])
+
+        self.params = {}
+        if self.after:
+            self.params = {'page_' + str(i): value for i, value in enumerate(self.after)}
+
+    # Whether the rows have to be sorted by the page keys
+    def active(self):
+        return self.limit is not None or self.after is not None
+
+    # Lowest value of the first sort key of the rows of the page: the given lower bound, or the key the page
+    # starts after if it is later, so that queries can skip what the earlier pages covered
+    def lower_bound(self, bound=None):
+        if not self.after:
+            return bound
+        return self.after[0] if bound is None else max(bound, self.after[0])
+
+    # Number of rows fetched by the query of the page, or None if it fetches every row
+    def fetched(self):
+        return self.limit + 1 if self.limit is not None else None
+
+    # Restrict a query to the rows of the page, fetching one extra row to detect the next page
+    def apply(self, query):
+        if not self.active():
+            return query
+
+        cols = [key[0] for key in self.keys]
+        if self.after:
+            params = ['%(page_' + str(i) + ')s' for i in range(len(cols))]
+            if len(cols) == 1:
+                query.where(cols[0] + ' > ' + params[0], self.params)
+            else:
+                # The range on the first key can use an index, the row comparison breaks ties
+                query.where(cols[0] + ' >= ' + params[0], self.params)
+                query.where('(' + ', '.join(cols) + ') > (' + ', '.join(params) + ')', self.params)
+
+        query.order_by(', '.join(cols))
+        if self.limit is not None:
+            query.limit_to(self.limit + 1)
+        return query
+
+    # Trim the fetched rows to the page, returning them with the headers linking to the next page.
+    # The link is built from the URL and arguments of the current Flask request, unless given.
+    def finish(self, rows, base_url=None, args=None):
+        if self.limit is None or len(rows) <= self.limit:
+            return rows, {}
+
+        rows = rows[:self.limit]
+        return rows, self.next_headers([rows[-1][key[1]] for key in self.keys], base_url, args)
+
+    # Headers linking to the page following the row with the given sort key
+    def next_headers(self, key, base_url=None, args=None):
+        token = encode_token(key)
+
+        if base_url is None:
+            base_url, args = request.base_url, request.args.to_dict(flat=False)
+        args = dict(args, next=[token])
+        url = base_url + '?' + urlencode(args, doseq=True)
+        return {'X-Next-Cursor': token, 'Link': '<' + url + '>; rel="next"'}
@@ -0,0 +1,29 @@
+from gunicorn.app.base import BaseApplication
+
+import Config
+
+
+class ProductionServer(BaseApplication):
+    # Pre-forking server running the Flask application in several worker processes.
+    # SIGTERM and SIGHUP let the workers finish their in-flight requests before stopping
+    # or being replaced, then shutdown closes their database connections.
+    def __init__(self, create_app, shutdown):
+        self.create_app = create_app
+        self.shutdown = shutdown
+        super().__init__()
+
+    def load_config(self):
+        self.cfg.set('bind', '0.0.0.0:5000')
+        self.cfg.set('workers', Config.SERVER_WORKERS)
+        self.cfg.set('worker_class', 'gthread')
+        self.cfg.set('threads', Config.SERVER_THREADS)
+        self.cfg.set('graceful_timeout', Config.SERVER_GRACEFUL_TIMEOUT)
+        self.cfg.set('worker_exit', self.worker_exit)
+
+    # Called in every worker after the fork, so that no database connection is shared between processes
+    def load(self):
+        return self.create_app()
+
+    def worker_exit(self, server, worker):
+        if getattr(worker, 'wsgi', None):
+            self.shutdown(worker.wsgi)
@@ -0,0 +1,81 @@
+import re
+
+
+class QueryBuilder:
+    # SELECT statement made of a fixed head and only the predicates that were actually supplied,
+    # so that Postgres can match each of them against an index
+    def __init__(self, select, params=None):
+        self.select = select
+        self.joins = []
+        self.conditions = []
+        self.params = dict(params or {})
+        self.group = ''
+        self.order = ''
+        self.limit = None
+
+    def join(self, clause):
+        if clause not in self.joins:
+            self.joins.append(clause)
+        return self
+
+    # Add a condition using the given parameters, unless one of them was not supplied
+    def where(self, condition, params=None):
+        params = params or {}
+        if condition is None or any(value is None for value in params.values()):
+            return self
+
+        self.conditions.append(condition)
+        self.params.update(params)
+        return self
+
+    def group_by(self, clause):
+        self.group = clause
+        return self
+
+    def order_by(self, clause):
+        self.order = clause
+        return self
+
+    def limit_to(self, limit):
+        self.limit = limit
+        return self
+
+    # Return the SQL text of the query and its parameters
+    def build(self):
+        sql = self.select
+        if self.joins:
+            sql += ' ' + ' '.join(self.joins)
+        if self.conditions:
+            sql += ' WHERE ' + ' AND '.join(self.conditions)
+        if self.group:
+            sql += ' GROUP BY ' + self.group
+        if self.order:
+            sql += ' ORDER BY ' + self.order
+        if self.limit is not None:
+            sql += ' LIMIT ' + str(int(self.limit))
+        return sql + ';', self.params
+
+    # Return the arguments of an asyncpg call running the query
+    def build_numbered(self):
+        return numbered_args(*self.build())
+
+
+# Convert a query with named %(name)s placeholders to numbered placeholders,
+# returning it with the list of its parameters in the order of the placeholders
+def numbered(sql, params):
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '$' + str(names.index(match.group(1)) + 1)
+
+    sql = re.sub(r'%\((\w+)\)s', number, sql).replace('%%', '%')
+    return sql, [params[name] for name in names]
+
+
+# Arguments of an asyncpg call running a query with named %(name)s placeholders:
+# its text with numbered ($1, $2, ...) placeholders, followed by each of its parameters
+def numbered_args(sql, params):
+    sql, params = numbered(sql, params)
+    return (sql, *params)
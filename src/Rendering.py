@@ -0,0 +1,67 @@
+import re
+
+from flask import make_response
+from flask_restful.representations.json import output_json as restful_output_json
+
+from Metrics import timed
+
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+
+class RenderedJson(str):
+    # JSON text of a response body rendered by the database, sent as it is instead of being encoded again
+    pass
+
+
+# Escape non-ASCII characters the way the json module does, as they only appear inside strings
+def escape(match):
+    code = ord(match.group())
+    if code > 0xffff:
+        code -= 0x10000
+        return '\\u%04x\\u%04x' % (0xd800 | code >> 10, 0xdc00 | code & 0x3ff)
+    return '\\u%04x' % code
+
+
+# JSON representation of the API, passing bodies rendered by the database through unchanged
+def output_json(data, code, headers=None):
+    with timed('serialize'):
+        if not isinstance(data, RenderedJson):
+            return restful_output_json(data, code, headers)
+
+        body = data if data.isascii() else NON_ASCII.sub(escape, data)
+        resp = make_response(body + '\n', code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+# Wrap a list query so that the database renders its rows as the JSON array of the response,
+# each row as the given SQL expression over the columns of the query, aliased q.
+# The first column of the result is the body. With a page limit, the second column tells whether
+# a next page exists and the remaining columns are the sort key of the last row of the page.
+def render(query, fields, page):
+    sql, params = query.build()
+    sql = sql.rstrip(';')
+    keys = ['q.' + key[0].split('.')[-1] for key in page.keys]
+
+    if page.limit is None:
+        order = ' ORDER BY ' + ', '.join(keys) if page.active() else ''
+        return ("SELECT coalesce('[' || string_agg(" + fields + ", ', '" + order + ") || ']', '[]')"
+                " FROM (" + sql + ") q;", params)
+
+    # The query fetches one row more than the page, numbered to leave it out of the body
+    limit = str(page.limit)
+    return ("SELECT coalesce('[' || string_agg(r.body, ', ' ORDER BY r.n) FILTER (WHERE r.n <= " + limit +
+            ") || ']', '[]'), count(*) > " + limit +
+            ''.join(', (array_agg(r.key_' + str(i) + ') FILTER (WHERE r.n = ' + limit + '))[1]'
+                    for i in range(len(keys))) +
+            " FROM (SELECT " + fields + " AS body, " +
+            ''.join(key + ' AS key_' + str(i) + ', ' for i, key in enumerate(keys)) +
+            "row_number() OVER (ORDER BY " + ', '.join(keys) + ") AS n FROM (" + sql + ") q) r;", params)
+
+
+# Fetch the body rendered by a query wrapped by render, with the headers linking to the next page
+def fetch_rendered(cur, page):
+    row = cur.fetchone()
+    if page.limit is None or not row[1]:
+        return RenderedJson(row[0]), {}
+    return RenderedJson(row[0]), page.next_headers(list(row[2:]))
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.pool
+from flask import g, request
+
+# Requests that only read, served by the replicas
+READ_METHODS = ('GET', 'HEAD')
+# Cookie set on the responses to writes, sending the reads of the client to the primary while it lasts
+WRITE_COOKIE = 'recent_write'
+
+
+# Host and port of every "host[:port]" entry of a comma separated list
+def parse_hosts(text):
+    hosts = []
+    for entry in text.split(','):
+        entry = entry.strip()
+        if entry:
+            host, _, port = entry.partition(':')
+            hosts.append({'host': host, 'port': int(port or 5432)})
+    return hosts
+
+
+class ReplicaSet:
+    # Read-only replicas tried in round-robin order. A replica that can't be connected to
+    # is skipped for retry_interval seconds, and reads fall back to the primary while none is available.
+    def __init__(self, logger, replicas, retry_interval, wait):
+        self.logger = logger
+        self.replicas = replicas
+        self.retry_interval = retry_interval
+        # Seconds to wait for a connection of a busy replica before trying the next server
+        self.wait = wait
+
+        self.next = 0
+        self.down_until = [0] * len(replicas)
+        self.lock = threading.Lock()
+
+    # Indexes of the replicas to try for a read, starting with the next one in turn
+    def candidates(self):
+        if not self.replicas:
+            return []
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.replicas)
+        now = time.monotonic()
+        order = [(start + i) % len(self.replicas) for i in range(len(self.replicas))]
+        return [i for i in order if self.down_until[i] <= now]
+
+    def failed(self, index):
+        self.logger.warning('replica %s unavailable, reading from the other servers for %s seconds',
+                            index, self.retry_interval)
+        self.down_until[index] = time.monotonic() + self.retry_interval
+
+
+class ReplicaRouter(ReplicaSet):
+    # Chooses the connection of every Flask request: reads go to the replicas, writes to the primary.
+    # Clients that wrote in the last read_your_writes seconds read from the primary, so that they see
+    # their own writes, which may not have been replayed by the replicas yet.
+    def __init__(self, logger, primary, replicas, retry_interval, wait, read_your_writes):
+        super().__init__(logger, replicas, retry_interval, wait)
+        self.primary = primary
+        self.read_your_writes = read_your_writes
+
+    def init_app(self, app):
+        # Every request checks out its own connection, which is returned once the request ends
+        app.teardown_appcontext(self.release)
+        if self.replicas and self.read_your_writes > 0:
+            app.after_request(self.remember_write)
+
+    def reads_primary(self):
+        return request.method not in READ_METHODS or WRITE_COOKIE in request.cookies
+
+    # Connection used by the current request, checked out on first use
+    def connection(self):
+        if 'db' in g:
+            return g.db
+
+        if not self.reads_primary():
+            for index in self.candidates():
+                try:
+                    g.db = self.replicas[index].getconn(self.wait)
+                except psycopg2.pool.PoolError:
+                    # Exhausted replicas are busy, not broken
+                    continue
+                except psycopg2.Error:
+                    self.failed(index)
+                    continue
+                g.db_pool = self.replicas[index]
+                return g.db
+
+        g.db = self.primary.getconn()
+        g.db_pool = self.primary
+        return g.db
+
+    # Return the connection of the current request to its pool
+    def release(self, exc=None):
+        conn = g.pop('db', None)
+        if conn is not None:
+            g.pop('db_pool').putconn(conn)
+
+    def remember_write(self, response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            response.set_cookie(WRITE_COOKIE, '1', max_age=self.read_your_writes, httponly=True)
+        return response
+
+    def closeall(self):
+        self.primary.closeall()
+        for replica in self.replicas:
+            replica.closeall()
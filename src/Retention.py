@@ -0,0 +1,62 @@
+import threading
+
+import psycopg2
+
+# Key of the advisory lock held while archiving, so that a single process archives at a time
+ARCHIVE_LOCK = 7203541
+
+# Readings are archived a whole month at a time, once the month ended more than the given number of days ago
+ARCHIVE_QUERY = """
+                SELECT arhiveaza_temperaturi(date_trunc('month', localtimestamp - make_interval(days => %(days)s)))
+                WHERE pg_try_advisory_xact_lock(%(lock)s);
+                """
+
+
+class Retention:
+    # Background thread moving the readings older than days to the compressed archive segments
+    # every interval seconds. Every process of the API runs one, but only one of them archives at a time.
+    def __init__(self, logger, pool, days, interval):
+        self.logger = logger
+        self.pool = pool
+        self.days = days
+        self.interval = interval
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='retention', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.archive()
+            self.stopped.wait(self.interval)
+
+    # Archive the readings past the retention horizon, returning the number of segments created
+    def archive(self):
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.logger.warning('no database connection to archive temperatures')
+            return 0
+
+        cur = conn.cursor()
+        try:
+            cur.execute(ARCHIVE_QUERY, {'days': self.days, 'lock': ARCHIVE_LOCK})
+            row = cur.fetchone()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            self.logger.error('temperatures could not be archived')
+            return 0
+        finally:
+            cur.close()
+            self.pool.putconn(conn)
+
+        # No row is returned while another process holds the lock
+        segments = row[0] if row else 0
+        if segments:
+            self.logger.info('%s archive segments created', segments)
+        return segments
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,187 @@
+import heapq
+import itertools
+import operator
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from flask import g
+
+import Config
+from Conditional import VERSIONS_STATEMENT, validator_headers
+from Metrics import timed
+from Statements import execute
+
+SEQUENCE_QUERY = """
+                 SELECT s.seqrelid::regclass::text, s.seqincrement
+                 FROM pg_sequence s
+                 WHERE s.seqrelid = pg_get_serial_sequence('temperaturi', 'id')::regclass;
+                 """
+
+
+# Key of the rows of a query sorted by the given (column, index in row, type) keys
+def sort_key(keys):
+    return operator.itemgetter(*[key[1] for key in keys]) if len(keys) > 1 else lambda row: (row[keys[0][1]],)
+
+
+class MergedCursor:
+    # Cursors of several shards read as one, their rows being merged in the order given by key.
+    # Rows of different shards with equal keys are combined into one by combine, if given.
+    def __init__(self, cursors, key, combine=None):
+        self.cursors = cursors
+        rows = heapq.merge(*[self.read(cur) for cur in cursors], key=key)
+        if combine:
+            rows = (combine(list(group)) for _, group in itertools.groupby(rows, key=key))
+        self.rows = rows
+
+    @staticmethod
+    def read(cur):
+        while True:
+            rows = cur.fetchmany(Config.STREAM_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+    def close(self):
+        for cur in self.cursors:
+            cur.close()
+
+
+class ShardSet:
+    # Databases the readings are spread over by city: a city belongs to the shard whose index is
+    # its id modulo the number of shards. The first shard is the primary database, whose connections
+    # are chosen by the replica router. Every shard holds a copy of the countries and cities,
+    # and reading ids are unique across shards, every shard drawing the ids equal to its index modulo their number.
+    def __init__(self, logger, router, pools):
+        self.logger = logger
+        self.router = router
+        self.pools = pools
+        self.executor = ThreadPoolExecutor(max_workers=len(pools) * Config.DB_POOL_MAX) if len(pools) > 1 else None
+
+    def init_app(self, app):
+        app.teardown_appcontext(self.release)
+
+    def sharded(self):
+        return len(self.pools) > 1
+
+    def indexes(self):
+        return list(range(len(self.pools)))
+
+    # Shard of a city id, which may be given as a number or a string. Ids that are not integers
+    # belong to the first shard, which rejects them like the unsharded database does.
+    def city_shard(self, city_id):
+        try:
+            city_id = float(city_id)
+        except (TypeError, ValueError):
+            return 0
+        return int(city_id) % len(self.pools) if city_id.is_integer() else 0
+
+    # Split the city ids of a list by shard, leaving out the shards without any of them
+    def split(self, city_ids):
+        shards = {}
+        for city_id in city_ids:
+            shards.setdefault(self.city_shard(city_id), []).append(city_id)
+        return shards
+
+    # Connection of the current request to a shard, checked out on first use
+    def connection(self, index):
+        if index == 0:
+            return self.router.connection()
+        if 'shard_dbs' not in g:
+            g.shard_dbs = {}
+        if index not in g.shard_dbs:
+            g.shard_dbs[index] = self.pools[index].getconn()
+        return g.shard_dbs[index]
+
+    # Return the connections of the current request to their shards
+    def release(self, exc=None):
+        for index, conn in g.pop('shard_dbs', {}).items():
+            self.pools[index].putconn(conn)
+
+    # Connections checked out by the current request, the one of the first shard last
+    def used(self):
+        return list(g.get('shard_dbs', {}).values()) + ([g.db] if 'db' in g else [])
+
+    # Commit the transaction of the current request on every shard it used
+    def commit(self):
+        for conn in self.used():
+            conn.commit()
+
+    def rollback(self):
+        for conn in self.used():
+            conn.rollback()
+
+    # Apply a write of the countries or cities, a registered statement, to the copies of the other shards,
+    # in the transaction of the current request. Raises the psycopg2.Error of a failing shard.
+    def mirror(self, statement, params):
+        for index in self.indexes()[1:]:
+            cur = self.connection(index).cursor()
+            try:
+                execute(cur, statement, params)
+            finally:
+                cur.close()
+
+    # ETag and Last-Modified headers of a response built from the given tables of several shards
+    def validators(self, indexes, tables, variant=None):
+        rows = []
+        for index in indexes:
+            cur = self.connection(index).cursor()
+            execute(cur, VERSIONS_STATEMENT, {'tables': sorted(tables)})
+            rows += cur.fetchall()
+            cur.close()
+        return validator_headers(rows, variant)
+
+    # Run the (sql, params) query of every shard, by index, in parallel. Returns a cursor over the rows
+    # of every shard, merged in the order of key, or the cursor of the shard if there is only one.
+    # Streamed results use server-side cursors with the given name. Raises the psycopg2.Error of a failing shard.
+    def execute(self, queries, key, combine=None, name=None):
+        cursors = [self.connection(index).cursor(name=name) if name else self.connection(index).cursor()
+                   for index in queries]
+        try:
+            if len(cursors) == 1:
+                cursors[0].execute(*next(iter(queries.values())))
+                return cursors[0]
+
+            with timed('execute'):
+                list(self.executor.map(lambda cur, query: cur.execute(*query), cursors, queries.values()))
+        except psycopg2.Error:
+            for cur in cursors:
+                cur.close()
+            raise
+        return MergedCursor(cursors, key, combine)
+
+    # Make every shard draw reading ids equal to its index modulo the number of shards,
+    # so that ids never collide. Sequences that already do are left alone.
+    def prepare(self):
+        if not self.sharded():
+            return
+
+        for index, pool in enumerate(self.pools):
+            conn = pool.getconn()
+            try:
+                cur = conn.cursor()
+                cur.execute(SEQUENCE_QUERY)
+                sequence, increment = cur.fetchone()
+                cur.execute('SELECT last_value FROM ' + sequence + ';')
+                last = cur.fetchone()[0]
+                if increment != len(self.pools) or last % len(self.pools) != index:
+                    self.logger.warning('shard %s now draws reading ids equal to %s modulo %s',
+                                        index, index, len(self.pools))
+                    cur.execute('ALTER SEQUENCE ' + sequence + ' INCREMENT BY %s;', (len(self.pools),))
+                    cur.execute('SELECT setval(%s, %s);', (sequence, last + (index - last) % len(self.pools)))
+                cur.close()
+                conn.commit()
+            finally:
+                pool.putconn(conn)
+
+    # Close the connections of the shards other than the first, which belongs to the replica router
+    def closeall(self):
+        if self.executor:
+            self.executor.shutdown()
+        for pool in self.pools[1:]:
+            pool.closeall()
@@ -0,0 +1,56 @@
+import re
+
+import psycopg2
+import psycopg2.extensions
+
+from QueryBuilder import numbered
+
+# Fixed statements of the service by name, as (SQL text with numbered placeholders, names of its parameters
+# in the order of the placeholders, SQL text with named placeholders)
+STATEMENTS = {}
+
+
+# Register a fixed statement, with named %(name)s placeholders, to be prepared on every connection of the pools.
+# Returns the name the statement is executed by.
+def register(name, sql):
+    names = re.findall(r'%\((\w+)\)s', sql)
+    text, params = numbered(sql.strip().rstrip(';'), dict(zip(names, names)))
+    STATEMENTS[name] = (text, params, sql)
+    return name
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    # Connection remembering which registered statements are prepared in its session
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# Prepare every registered statement in the session of a new connection, so that Postgres parses
+# and plans them once instead of on every execution. Statements that can't be prepared, on a database
+# without the latest schema for instance, are left to be sent in full.
+def prepare(conn, logger):
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        for name, (text, _, _) in STATEMENTS.items():
+            try:
+                cur.execute('PREPARE ' + name + ' AS ' + text + ';')
+                conn.prepared.add(name)
+            except psycopg2.Error:
+                logger.warning('statement %s could not be prepared', name)
+    finally:
+        cur.close()
+        conn.autocommit = False
+
+
+# Execute a registered statement with a dict of parameters, by name if it is prepared on the connection
+def execute(cur, name, params=None):
+    text, names, sql = STATEMENTS[name]
+    if name not in getattr(cur.connection, 'prepared', ()):
+        cur.execute(sql, params)
+        return
+    if not names:
+        cur.execute('EXECUTE ' + name + ';')
+        return
+    cur.execute('EXECUTE ' + name + '(' + ', '.join(['%s'] * len(names)) + ');', [params[key] for key in names])
@@ -0,0 +1,117 @@
+import csv
+import datetime
+import io
+import json
+import struct
+
+from flask import Response, request, stream_with_context
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import Config
+from Formatting import DATE_FORMAT
+from Metrics import timed
+
+# Content type of every streaming format
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'columnar': 'application/vnd.weatherstation.columnar'
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# Streaming format of a request, given by its stream argument or else by its Accept header
+# (that of the current Flask request by default). Returns None when the client prefers the
+# regular JSON response, which is also sent when none of the accepted types is available.
+def requested_format(stream, accept=None):
+    if stream:
+        return stream
+
+    if accept is None:
+        accept = request.headers.get('Accept')
+    types = [FORMATS['json']] + [FORMATS[fmt] for fmt in FORMATS if fmt != 'json']
+    best = parse_accept_header(accept, MIMEAccept).best_match(types)
+    if best is None or best == FORMATS['json']:
+        return None
+    return next(fmt for fmt in FORMATS if FORMATS[fmt] == best)
+
+
+# Dates are formatted the same way as in the non-streaming responses
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATE_FORMAT)
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def encode_json(cols, rows):
+    return [json.dumps(dict(zip(cols, row)), default=encode_value) for row in rows]
+
+
+def encode_csv(rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerows([encode_value(value) if isinstance(value, datetime.datetime) else value for value in row]
+                     for row in rows)
+    return out.getvalue()
+
+
+# Encode temperature rows as a columnar block: the number of rows as an unsigned 32-bit integer,
+# then the ids as 32-bit integers, the values as 32-bit floats and the timestamps as 64-bit
+# seconds since the epoch, all little-endian. A response is a sequence of blocks.
+def encode_columnar(rows):
+    count = len(rows)
+    ids, values, timestamps = zip(*rows)
+    return (struct.pack('<I', count) +
+            struct.pack('<' + str(count) + 'i', *ids) +
+            struct.pack('<' + str(count) + 'f', *values) +
+            struct.pack('<' + str(count) + 'q', *(int((ts - EPOCH).total_seconds()) for ts in timestamps)))
+
+
+# Beginning, batch and end of the body of a streamed response
+def stream_start(cols, fmt):
+    if fmt == 'json':
+        return '['
+    if fmt == 'csv':
+        return ','.join(cols) + '\n'
+    return ''
+
+
+def stream_batch(cols, rows, fmt, first):
+    if fmt == 'json':
+        return ('' if first else ',') + ','.join(encode_json(cols, rows))
+    if fmt == 'ndjson':
+        return '\n'.join(encode_json(cols, rows)) + '\n'
+    if fmt == 'csv':
+        return encode_csv(rows)
+    return encode_columnar(rows)
+
+
+def stream_end(fmt):
+    return ']\n' if fmt == 'json' else ''
+
+
+# Write the rows of an executed server-side cursor to the client in batches,
+# so that the whole result is never held in memory
+def stream_rows(cur, cols, fmt, headers):
+    def generate():
+        try:
+            yield stream_start(cols, fmt)
+            first = True
+            while True:
+                rows = cur.fetchmany(Config.STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+
+                with timed('serialize'):
+                    chunk = stream_batch(cols, rows, fmt, first)
+                yield chunk
+                first = False
+            yield stream_end(fmt)
+        finally:
+            cur.close()
+
+    # The request context (and its database connection) is kept until the generator is done
+    return Response(stream_with_context(generate()), status=200, headers=headers, mimetype=FORMATS[fmt])
@@ -2,30 +2,70 @@ import datetime
 
 import psycopg2
 from flask import request
-from flask_restful import Resource, reqparse
+from flask_restful import reqparse
 
+import Config
+from Conditional import not_modified, not_modified_response
+from DatabaseResource import DatabaseResource
+from Downsampling import BUCKET_KEYS, bucket_page, bucket_query, combine_buckets, format_buckets, parse_interval
+from Formatting import TEMPERATURE_COLUMNS, TEMPERATURE_JSON, format_temperatures
+from Pagination import Page, add_page_arguments
+from QueryBuilder import QueryBuilder
+from Rendering import fetch_rendered, render
+from ShardSet import sort_key
+from Statements import execute, register
+from Streaming import FORMATS, requested_format, stream_rows
 
-class Temperatures(Resource):
-    def __init__(self, **kwargs):
-        self.logger = kwargs['logger']
-        self.db = kwargs['db']
+INSERT_QUERY = """
+               INSERT INTO Temperaturi(valoare, timestamp, id_oras)
+               VALUES (%(valoare)s, current_timestamp, %(idOras)s)
+               RETURNING id;
+               """
+UPDATE_QUERY = """
+               UPDATE Temperaturi
+               SET id = %(id)s, id_oras = %(idOras)s, valoare = %(valoare)s
+               WHERE id = %(current_id)s;
+               """
+DELETE_QUERY = """
+               DELETE FROM Temperaturi
+               WHERE id = %(id)s;
+               """
+INSERT_STATEMENT = register('insereaza_temperatura', INSERT_QUERY)
+UPDATE_STATEMENT = register('actualizeaza_temperatura', UPDATE_QUERY)
+DELETE_STATEMENT = register('sterge_temperatura', DELETE_QUERY)
+
+# Arguments of GET requests, parsed by a parser built once
+PARSER = reqparse.RequestParser()
+PARSER.add_argument('lat', default=None, required=False, type=float, location='args')
+PARSER.add_argument('lon', default=None, required=False, type=float, location='args')
+PARSER.add_argument('radius', default=None, required=False, type=float, location='args')
+PARSER.add_argument('from', default=None, required=False, type=str, location='args')
+PARSER.add_argument('until', default=None, required=False, type=str, location='args')
+PARSER.add_argument('stream', default=None, required=False, type=str, choices=tuple(FORMATS), location='args')
+PARSER.add_argument('interval', default=None, required=False, type=parse_interval, location='args')
+add_page_arguments(PARSER)
+
+
+class Temperatures(DatabaseResource):
+    # Listings are sorted by timestamp, then id
+    page_keys = [('t.timestamp', 2, datetime.datetime.fromisoformat), ('t.id', 0, int)]
 
     # Check that the request body is correctly formatted as a temperature
     def check_temperature(self, req):
         if 'idOras' not in req or 'valoare' not in req:
-            self.logger.warning('request ' + str(req) + ' does not contain a temperature')
+            self.logger.warning('request %s does not contain a temperature', req)
             return 400
 
         try:
             float(req['idOras'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', idOras is not an integer')
+            self.logger.warning('in request %s, idOras is not an integer', req)
             return 400
 
         try:
             float(req['valoare'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', valoare is not a real number')
+            self.logger.warning('in request %s, valoare is not a real number', req)
             return 400
 
         return None
@@ -33,7 +73,7 @@ class Temperatures(Resource):
     # Check that the request body is correctly formatted for POST request
     def check_post(self, req):
         if len(req) != 2:
-            self.logger.warning('request ' + str(req) + ' does not contain correct number of parameters')
+            self.logger.warning('request %s does not contain correct number of parameters', req)
             return 400
 
         return self.check_temperature(req)
@@ -42,15 +82,15 @@ class Temperatures(Resource):
     def check_put(self, req):
 
         if len(req) != 3:
-            self.logger.warning('request ' + str(req) + ' does not contain correct number of parameters')
+            self.logger.warning('request %s does not contain correct number of parameters', req)
             return 400
         if 'id' not in req:
-            self.logger.warning('request ' + str(req) + ' does not contain an id')
+            self.logger.warning('request %s does not contain an id', req)
             return 400
         try:
             int(req['id'])
         except ValueError:
-            self.logger.warning('in request ' + str(req) + ', id is not an integer')
+            self.logger.warning('in request %s, id is not an integer', req)
             return 400
 
         return self.check_temperature(req)
@@ -61,25 +101,27 @@ class Temperatures(Resource):
         if err:
             return {}, err
 
-        # Execute INSERT SQL operation
-        cur = self.db.cursor()
+        # The reading can be left to the write-behind queue, which answers once its group is committed
+        if self.writer:
+            status, temp_id = self.writer.submit(temp)
+            if status != 201:
+                return {}, status
+            return {'id': temp_id}, 201
+
+        # Execute INSERT SQL operation, on the shard of the city
+        db = self.shards.connection(self.shards.city_shard(temp['idOras']))
+        cur = db.cursor()
         try:
-            cur.execute("""
-                        INSERT INTO Temperaturi(valoare, timestamp, id_oras)
-                        VALUES (%(valoare)s, current_timestamp, %(idOras)s)
-                        RETURNING id;
-                        """,
-                        temp)
+            execute(cur, INSERT_STATEMENT, temp)
         except psycopg2.errors.UniqueViolation:
             cur.close()
-            self.db.rollback()
-            self.logger.warning(
-                'Temperature for ' + str((temp['idOras'], temp['timestamp'])) + ' already exists in table')
+            db.rollback()
+            self.logger.warning('Temperature for %s already exists in table', temp['idOras'])
             return {}, 409
         except psycopg2.errors.DatabaseError:
             cur.close()
-            self.db.rollback()
-            self.logger.error(str(temp) + ' could not be inserted in database')
+            db.rollback()
+            self.logger.error('%s could not be inserted in database', temp)
             return {}, 400
 
         # Retrieve ID of the inserted temperature, if the insert was succesful
@@ -87,14 +129,14 @@ class Temperatures(Resource):
             temp_id = cur.fetchone()[0]
         except psycopg2.ProgrammingError:
             cur.close()
-            self.db.rollback()
-            self.logger.error(str(temp) + ' could not be inserted in database')
+            db.rollback()
+            self.logger.error('%s could not be inserted in database', temp)
             return {}, 400
 
         cur.close()
-        self.db.commit()
+        db.commit()
 
-        self.logger.info(str(temp) + ' was inserted in database with id ' + str(temp_id))
+        self.logger.info('%s was inserted in database with id %s', temp, temp_id)
         return {'id': temp_id}, 201
 
     def put(self, id):
@@ -103,102 +145,184 @@ class Temperatures(Resource):
         if err:
             return {}, err
 
-        # Execute UPDATE SQL operation
-        cur = self.db.cursor()
-        try:
-            cur.execute("""
-                        UPDATE Temperaturi
-                        SET id = %s, id_oras = %s, valoare = %s
-                        WHERE id = %s;
-                        """,
-                        (temp['id'], temp['idOras'], temp['valoare'], id))
-        except psycopg2.errors.DataError:
+        # Execute UPDATE SQL operation on every shard, only the one holding the reading has it
+        updated = []
+        for index in self.shards.indexes():
+            cur = self.shards.connection(index).cursor()
+            try:
+                execute(cur, UPDATE_STATEMENT, dict(temp, current_id=id))
+            except psycopg2.errors.DataError:
+                cur.close()
+                self.shards.rollback()
+                self.logger.warning('%s not found in table', id)
+                return {}, 404
+            except psycopg2.errors.DatabaseError:
+                cur.close()
+                self.shards.rollback()
+                self.logger.error('%s could not be inserted in database', temp)
+                return {}, 400
+            if cur.rowcount:
+                updated.append(index)
             cur.close()
-            self.db.rollback()
-            self.logger.warning(id + ' not found in table')
+
+        # Archived readings can't be updated, like readings that don't exist
+        if not updated:
+            self.shards.rollback()
+            self.logger.warning('%s not found in table', id)
             return {}, 404
-        except psycopg2.errors.DatabaseError:
-            cur.close()
-            self.db.rollback()
-            self.logger.error(str(temp) + ' could not be inserted in database')
+        # Readings stay on their shard, so they can't be moved to a city of another shard
+        if any(index != self.shards.city_shard(temp['idOras']) for index in updated):
+            self.shards.rollback()
+            self.logger.warning('temperature with id=%s can not be moved to city %s of another shard',
+                                id, temp['idOras'])
             return {}, 400
+        self.shards.commit()
 
-        cur.close()
-        self.db.commit()
-
-        self.logger.info('temperature with id=' + str(id) + ' was updated in database to ' + str(temp))
+        self.logger.info('temperature with id=%s was updated in database to %s', id, temp)
         return {}, 200
 
     def delete(self, id):
-        # Execute DELETE SQL operation
-        cur = self.db.cursor()
-        try:
-            cur.execute("""
-                        DELETE FROM Temperaturi
-                        WHERE id = %s;
-                        """,
-                        (id,))
-        except psycopg2.errors.DataError:
-            cur.close()
-            self.db.rollback()
-            self.logger.warning(id + ' not found in table')
-            return {}, 404
-        except psycopg2.errors.DatabaseError:
+        # Execute DELETE SQL operation on every shard, only the one holding the reading has it
+        deleted = 0
+        for index in self.shards.indexes():
+            cur = self.shards.connection(index).cursor()
+            try:
+                execute(cur, DELETE_STATEMENT, {'id': id})
+            except psycopg2.errors.DataError:
+                cur.close()
+                self.shards.rollback()
+                self.logger.warning('%s not found in table', id)
+                return {}, 404
+            except psycopg2.errors.DatabaseError:
+                cur.close()
+                self.shards.rollback()
+                self.logger.error('id=%s could not be deleted from database', id)
+                return {}, 400
+            deleted += cur.rowcount
             cur.close()
-            self.db.rollback()
-            self.logger.error('id=' + str(id) + ' could not be deleted from database')
-            return {}, 400
 
-        cur.close()
-        self.db.commit()
+        # Archived readings can't be deleted, like readings that don't exist
+        if not deleted:
+            self.shards.rollback()
+            self.logger.warning('%s not found in table', id)
+            return {}, 404
+        self.shards.commit()
 
-        self.logger.info('country with id=' + str(id) + ' was deleted from database')
+        self.logger.info('country with id=%s was deleted from database', id)
         return {}, 200
 
-    def get(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('lat', default=None, required=False, type=float, location='args')
-        parser.add_argument('lon', default=None, required=False, type=float, location='args')
-        parser.add_argument('from', default=None, required=False, type=str, location='args')
-        parser.add_argument('until', default=None, required=False, type=str, location='args')
+    # Query selecting the temperatures matching the parsed arguments of a GET request, on the given shard
+    def query(self, args, page, shard=None):
+        # Coordinates are resolved to cities by the in-memory city index, instead of joining Orase
+        city_ids = None
+        if args['lat'] is not None or args['lon'] is not None:
+            if args['radius'] is not None:
+                city_ids = self.cities.within(args['lat'], args['lon'], args['radius'])
+            else:
+                city_ids = self.cities.lookup(args['lat'], args['lon'], 0.001)
+            if shard is not None:
+                city_ids = self.shards.split(city_ids).get(shard, [])
+
+        # Readings of the table and of the archive segments overlapping the requested dates and the page,
+        # up to the segments holding enough readings to fill the page
+        query = QueryBuilder('SELECT t.id, t.valoare, t.timestamp '
+                             'FROM temperaturi_toate(%(segments_from)s, '
+                             'least(%(until)s, orizont_arhiva(%(segments_from)s, %(cities)s, %(rows)s))) t',
+                             {'segments_from': page.lower_bound(args['from']), 'until': args['until'],
+                              'cities': city_ids, 'rows': page.fetched()})
+        query.where('t.id_oras = ANY(%(cities)s)', {'cities': city_ids})
+        query.where('t.timestamp >= %(from)s', {'from': args['from']})
+        query.where('t.timestamp <= %(until)s', {'until': args['until']})
+        return page.apply(query)
+
+    # Whether the query of a request resolves cities with the city index
+    def needs_city_index(self, args):
+        return args['lat'] is not None or args['lon'] is not None
 
-        args = parser.parse_args()
+    def get(self):
+        args = PARSER.parse_args()
+        if args['radius'] is not None and (args['lat'] is None or args['lon'] is None or args['radius'] < 0):
+            self.logger.error('radius %s needs both lat and lon', args['radius'])
+            return {}, 400
         if args['from']:
             try:
                 args['from'] = datetime.datetime.strptime(args['from'], '%Y-%m-%d')
             except ValueError:
-                self.logger.error(str(args['from']) + ' not a YYYY-MM-DD date')
+                self.logger.error('%s not a YYYY-MM-DD date', args['from'])
                 return {}, 400
         if args['until']:
             try:
                 args['until'] = datetime.datetime.strptime(args['until'], '%Y-%m-%d')
             except ValueError:
-                self.logger.error(str(args['until']) + ' not a YYYY-MM-DD date')
+                self.logger.error('%s not a YYYY-MM-DD date', args['until'])
                 return {}, 400
 
-        cur = self.db.cursor()
+        # Downsampled series are only sent as JSON, one bucket per interval
+        if args['interval'] and args['stream']:
+            self.logger.error('downsampled temperatures can not be streamed')
+            return {}, 400
+
+        # Formats other than JSON can also be asked for with the Accept header, and are always streamed
+        if not args['interval']:
+            args['stream'] = requested_format(args['stream'])
+
+        # Streamed responses are never paginated, they are meant for results of any size
         try:
-            cur.execute("""
-                        SELECT t.id, t.valoare, t.timestamp FROM Temperaturi t JOIN Orase o ON t.id_oras = o.id
-                        WHERE (%(lat)s IS NULL OR abs(o.latitudine - %(lat)s) < 0.001)
-                          AND (%(lon)s IS NULL OR abs(o.longitudine - %(lon)s) < 0.001)
-                          AND (%(from)s IS NULL OR t.timestamp >= %(from)s)
-                          AND (%(until)s IS NULL OR t.timestamp <= %(until)s);
-                        """,
-                        args)
+            if args['interval']:
+                page = bucket_page(args)
+            else:
+                page = Page(args, self.page_keys, paginate=not args['stream'])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return {}, 400
+
+        # Readings of every shard are read in parallel and merged
+        shards = self.shards.indexes()
+        headers = self.shards.validators(shards, ['temperaturi', 'orase'], args['stream'])
+        headers['Vary'] = 'Accept'
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        if self.needs_city_index(args):
+            self.cities.refresh(self.db)
+
+        # Unless streamed, the body can be rendered by the database, if a single shard holds it
+        rendered = Config.DB_JSON_RENDERING and not args['stream'] and not args['interval'] and len(shards) == 1
+
+        queries = {}
+        for shard in shards:
+            query = bucket_query(self, args, page, shard) if args['interval'] else self.query(args, page, shard)
+            # Rows of several shards are merged by timestamp, so each shard sorts its own
+            if len(shards) > 1 and not args['interval'] and not page.active():
+                query.order_by(', '.join(key[0] for key in self.page_keys))
+            queries[shard] = render(query, TEMPERATURE_JSON, page) if rendered else query.build()
+
+        # Streamed results are read through server-side cursors, in batches
+        try:
+            if args['interval']:
+                cur = self.shards.execute(queries, sort_key(BUCKET_KEYS), combine_buckets)
+            else:
+                cur = self.shards.execute(queries, sort_key(self.page_keys),
+                                          name='temperatures' if args['stream'] else None)
         except psycopg2.errors.DatabaseError:
-            cur.close()
-            self.logger.error('query with args ' + str(args) + ' failed')
+            self.logger.error('query with args %s failed', args)
             return {}, 400
 
-        rows = cur.fetchall()
+        if args['stream']:
+            return stream_rows(cur, TEMPERATURE_COLUMNS, args['stream'], headers)
+
+        if rendered:
+            rows, next_headers = fetch_rendered(cur, page)
+        else:
+            rows, next_headers = page.finish(cur.fetchall())
+        headers.update(next_headers)
         cur.close()
 
         # Format response as a list of dictionaries
-        cols = ['id', 'valoare', 'timestamp']
-        rows = [dict(zip(cols, row)) for row in rows]
-        for row in rows:
-            row['timestamp'] = row['timestamp'].strftime("%Y-%m-%d")
-        self.logger.info('Selected rows: ' + str(rows))
+        if args['interval']:
+            rows = format_buckets(rows)
+        elif not rendered:
+            rows = format_temperatures(rows)
+        self.logger.info('Selected rows: %s', rows)
 
-        return rows, 200
+        return rows, 200, headers
@@ -0,0 +1,167 @@
+import datetime
+
+import psycopg2
+from flask import request
+
+import Config
+from DatabaseResource import DatabaseResource
+from Statements import execute, register
+
+# Cities of a batch that exist
+CITIES_QUERY = 'SELECT id FROM Orase WHERE id = ANY(%(cities)s);'
+CITIES_STATEMENT = register('citeste_orase', CITIES_QUERY)
+# Readings of a batch, sent as one array per column so that a batch of any size is a single statement.
+# Readings already stored for their city and timestamp, in Temperaturi or in the archive, are left out.
+INSERT_QUERY = """
+               INSERT INTO Temperaturi(valoare, timestamp, id_oras)
+               SELECT r.valoare, r.timestamp, r.id_oras
+               FROM unnest(%(values)s::real[], %(timestamps)s::timestamp[], %(cities)s::integer[])
+                    AS r(valoare, timestamp, id_oras)
+               WHERE NOT arhivata(r.id_oras, r.timestamp)
+               ON CONFLICT (id_oras, timestamp) DO NOTHING
+               RETURNING id, id_oras, timestamp;
+               """
+INSERT_STATEMENT = register('insereaza_temperaturi', INSERT_QUERY)
+
+
+class TemperaturesBatch(DatabaseResource):
+    # Check that a record of the batch is correctly formatted as a temperature,
+    # returning the (idOras, valoare, timestamp) row to insert or None
+    def check_record(self, index, req):
+        if not isinstance(req, dict) or 'idOras' not in req or 'valoare' not in req:
+            self.logger.warning('record %s does not contain a temperature', index)
+            return None
+        if len(req) != (3 if 'timestamp' in req else 2):
+            self.logger.warning('record %s does not contain correct number of parameters', index)
+            return None
+
+        try:
+            city_id = float(req['idOras'])
+        except (TypeError, ValueError):
+            self.logger.warning('in record %s, idOras is not an integer', index)
+            return None
+        if not city_id.is_integer():
+            self.logger.warning('in record %s, idOras is not an integer', index)
+            return None
+
+        try:
+            value = float(req['valoare'])
+        except (TypeError, ValueError):
+            self.logger.warning('in record %s, valoare is not a real number', index)
+            return None
+
+        timestamp = None
+        if 'timestamp' in req:
+            try:
+                timestamp = datetime.datetime.fromisoformat(req['timestamp'])
+            except (TypeError, ValueError):
+                self.logger.warning('in record %s, timestamp is not an ISO 8601 date', index)
+                return None
+            if timestamp.tzinfo is not None:
+                self.logger.warning('in record %s, timestamp must not have a time zone', index)
+                return None
+
+        return int(city_id), value, timestamp
+
+    # Check that the request body is a list of temperatures, returning an error status or None
+    def check_batch(self, temps):
+        if not isinstance(temps, list):
+            self.logger.warning('request is not a list of temperatures')
+            return 400
+        if len(temps) > Config.BATCH_MAX_RECORDS:
+            self.logger.warning('request contains %s temperatures, more than %s', len(temps), Config.BATCH_MAX_RECORDS)
+            return 413
+        return None
+
+    # Validate every record in one pass, returning the status of each record
+    # and the rows of the valid ones, by index
+    def check_records(self, temps):
+        results = [{'status': 400} for _ in temps]
+        rows = {}
+        for index, temp in enumerate(temps):
+            row = self.check_record(index, temp)
+            if row:
+                rows[index] = row
+        return results, rows
+
+    # Readings to insert by (idOras, timestamp), as (index, valoare) pairs. Readings of unknown cities
+    # are left out, and only the first reading of every (idOras, timestamp) pair is kept.
+    def pending(self, rows, cities, now, results):
+        pending = {}
+        for index, (city_id, value, timestamp) in rows.items():
+            if city_id not in cities:
+                self.logger.warning('in record %s, city %s does not exist', index, city_id)
+                continue
+            key = (city_id, timestamp or now)
+            if key in pending:
+                results[index]['status'] = 409
+                continue
+            pending[key] = (index, value)
+        return pending
+
+    # Parameters of INSERT_QUERY inserting the given readings by (idOras, timestamp), as (index, valoare) pairs
+    def insert_params(self, pending):
+        return {'values': [value for index, value in pending.values()],
+                'timestamps': [key[1] for key in pending],
+                'cities': [key[0] for key in pending]}
+
+    # Record the ids of the inserted (id, idOras, timestamp) rows in the results
+    def collect(self, results, pending, inserted):
+        # Readings that were not returned by the insert already exist in the table
+        for index, value in pending.values():
+            results[index]['status'] = 409
+        for temp_id, city_id, timestamp in inserted:
+            index = pending[(city_id, timestamp)][0]
+            results[index] = {'status': 201, 'id': temp_id}
+        return results
+
+    def post(self):
+        temps = request.get_json()
+        err = self.check_batch(temps)
+        if err:
+            return {}, err
+
+        results, rows = self.check_records(temps)
+
+        cur = self.db.cursor()
+        try:
+            # Readings without a timestamp share the timestamp of the transaction,
+            # just like single readings inserted with current_timestamp
+            cur.execute('SELECT localtimestamp;')
+            now = cur.fetchone()[0]
+
+            execute(cur, CITIES_STATEMENT, {'cities': list({row[0] for row in rows.values()})})
+            cities = {city[0] for city in cur.fetchall()}
+        except psycopg2.errors.DatabaseError:
+            cur.close()
+            self.db.rollback()
+            self.logger.error('batch of %s temperatures could not be inserted in database', len(temps))
+            return {}, 400
+
+        pending = self.pending(rows, cities, now, results)
+
+        cur.close()
+
+        # Insert the readings of every shard with a single statement, committed together
+        shards = {}
+        for key, reading in pending.items():
+            shards.setdefault(self.shards.city_shard(key[0]), {})[key] = reading
+
+        inserted = []
+        for shard, readings in shards.items():
+            cur = self.shards.connection(shard).cursor()
+            try:
+                execute(cur, INSERT_STATEMENT, self.insert_params(readings))
+                inserted += cur.fetchall()
+            except psycopg2.errors.DatabaseError:
+                cur.close()
+                self.shards.rollback()
+                self.logger.error('batch of %s temperatures could not be inserted in database', len(temps))
+                return {}, 400
+            cur.close()
+
+        self.shards.commit()
+
+        results = self.collect(results, pending, inserted)
+        self.logger.info('%s of %s temperatures were inserted in database', len(inserted), len(temps))
+        return results, 200
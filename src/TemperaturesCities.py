@@ -1,56 +1,177 @@
 import datetime
+import operator
 
 import psycopg2
-from flask_restful import Resource, reqparse
+from flask_restful import reqparse
 
+import Config
+from Batching import group_rows, parse_ids
+from Conditional import not_modified, not_modified_response, validators
+from DatabaseResource import DatabaseResource
+from Downsampling import bucket_page, bucket_query, format_buckets, parse_interval
+from Formatting import TEMPERATURE_COLUMNS, TEMPERATURE_JSON, format_temperatures
+from Pagination import Page, add_page_arguments
+from QueryBuilder import QueryBuilder
+from Rendering import fetch_rendered, render
+from Streaming import FORMATS, requested_format, stream_rows
 
-class TemperaturesCities(Resource):
-    def __init__(self, **kwargs):
-        self.logger = kwargs['logger']
-        self.db = kwargs['db']
+# Arguments of GET requests for a single city, and for several cities, parsed by parsers built once
+PARSER = reqparse.RequestParser()
+PARSER.add_argument('from', default=None, required=False, type=str, location='args')
+PARSER.add_argument('until', default=None, required=False, type=str, location='args')
+PARSER.add_argument('stream', default=None, required=False, type=str, choices=tuple(FORMATS), location='args')
+PARSER.add_argument('interval', default=None, required=False, type=parse_interval, location='args')
+add_page_arguments(PARSER)
 
-    def get(self, id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('from', default=None, required=False, type=str, location='args')
-        parser.add_argument('until', default=None, required=False, type=str, location='args')
+BATCH_PARSER = reqparse.RequestParser()
+BATCH_PARSER.add_argument('ids', required=True, type=parse_ids, location='args')
+BATCH_PARSER.add_argument('from', default=None, required=False, type=str, location='args')
+BATCH_PARSER.add_argument('until', default=None, required=False, type=str, location='args')
 
-        args = parser.parse_args()
+
+class TemperaturesCities(DatabaseResource):
+    # Listings are sorted by timestamp, then id
+    page_keys = [('timestamp', 2, datetime.datetime.fromisoformat), ('id', 0, int)]
+
+    # Query selecting the temperatures matching the parsed arguments of a GET request.
+    # Every reading of a city is on the same shard.
+    def query(self, args, page, shard=None):
+        # Archive segments before the requested dates and the page are skipped, and so are those after
+        # the segments of the city holding enough readings to fill the page
+        query = QueryBuilder('SELECT id, valoare, timestamp '
+                             'FROM temperaturi_toate(%(segments_from)s, '
+                             'least(%(until)s, orizont_arhiva(%(segments_from)s, %(cities)s, %(rows)s)))',
+                             {'segments_from': page.lower_bound(args['from']), 'until': args['until'],
+                              'cities': [args['id']], 'rows': page.fetched()})
+        query.where('id_oras = %(id)s', {'id': args['id']})
+        query.where('timestamp >= %(from)s', {'from': args['from']})
+        query.where('timestamp <= %(until)s', {'until': args['until']})
+        return page.apply(query)
+
+    # Query selecting the temperatures of several cities, with the id of their city first
+    def batch_query(self, args):
+        query = QueryBuilder('SELECT id_oras, id, valoare, timestamp FROM temperaturi_toate(%(from)s, %(until)s)',
+                             {'from': args['from'], 'until': args['until']})
+        query.where('id_oras = ANY(%(ids)s)', {'ids': args['ids']})
+        query.where('timestamp >= %(from)s', {'from': args['from']})
+        query.where('timestamp <= %(until)s', {'until': args['until']})
+        return query.order_by('id_oras, timestamp, id')
+
+    # Whether the query of a request resolves cities with the city index
+    def needs_city_index(self, args):
+        return False
+
+    # Temperatures of the cities given by the ids argument, read with a single query and grouped by city
+    def get_batch(self):
+        args = BATCH_PARSER.parse_args()
+        if args['from']:
+            try:
+                args['from'] = datetime.datetime.strptime(args['from'], '%Y-%m-%d')
+            except ValueError:
+                self.logger.error('%s not a YYYY-MM-DD date', args['from'])
+                return {}, 400
+        if args['until']:
+            try:
+                args['until'] = datetime.datetime.strptime(args['until'], '%Y-%m-%d')
+            except ValueError:
+                self.logger.error('%s not a YYYY-MM-DD date', args['until'])
+                return {}, 400
+
+        # Every shard holding some of the cities is read in parallel
+        shards = self.shards.split(args['ids']) or {0: args['ids']}
+        headers = self.shards.validators(shards, ['temperaturi'])
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        queries = {shard: self.batch_query(dict(args, ids=ids)).build() for shard, ids in shards.items()}
+        try:
+            # Rows are merged in the order of the batch query: by city, timestamp and id
+            cur = self.shards.execute(queries, operator.itemgetter(0, 3, 1))
+        except psycopg2.errors.DatabaseError:
+            self.logger.error('query with args %s failed', args)
+            return {}, 400
+        rows = cur.fetchall()
+        cur.close()
+
+        rows = group_rows(args['ids'], rows, format_temperatures)
+        self.logger.info('Selected rows: %s', rows)
+
+        return rows, 200, headers
+
+    def get(self, id=None):
+        if id is None:
+            return self.get_batch()
+
+        args = PARSER.parse_args()
         args['id'] = id
         if args['from']:
             try:
                 args['from'] = datetime.datetime.strptime(args['from'], '%Y-%m-%d')
             except ValueError:
-                self.logger.error(str(args['from']) + ' not a YYYY-MM-DD date')
+                self.logger.error('%s not a YYYY-MM-DD date', args['from'])
                 return {}, 400
         if args['until']:
             try:
                 args['until'] = datetime.datetime.strptime(args['until'], '%Y-%m-%d')
             except ValueError:
-                self.logger.error(str(args['until']) + ' not a YYYY-MM-DD date')
+                self.logger.error('%s not a YYYY-MM-DD date', args['until'])
                 return {}, 400
 
-        cur = self.db.cursor()
+        # Downsampled series are only sent as JSON, one bucket per interval
+        if args['interval'] and args['stream']:
+            self.logger.error('downsampled temperatures can not be streamed')
+            return {}, 400
+
+        # Formats other than JSON can also be asked for with the Accept header, and are always streamed
+        if not args['interval']:
+            args['stream'] = requested_format(args['stream'])
+
+        # Streamed responses are never paginated, they are meant for results of any size
         try:
-            cur.execute("""
-                        SELECT id, valoare, timestamp FROM Temperaturi
-                        WHERE id_oras = %(id)s
-                          AND (%(from)s IS NULL OR timestamp >= %(from)s)
-                          AND (%(until)s IS NULL OR timestamp <= %(until)s);
-                        """,
-                        args)
+            if args['interval']:
+                page = bucket_page(args)
+            else:
+                page = Page(args, self.page_keys, paginate=not args['stream'])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return {}, 400
+
+        # The readings of the city are read from its shard
+        db = self.shards.connection(self.shards.city_shard(id))
+        headers = validators(db, ['temperaturi'], args['stream'])
+        headers['Vary'] = 'Accept'
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        query = bucket_query(self, args, page) if args['interval'] else self.query(args, page)
+
+        # Unless streamed, the body can be rendered by the database
+        rendered = Config.DB_JSON_RENDERING and not args['stream'] and not args['interval']
+
+        # Streamed results are read through a server-side cursor, in batches
+        cur = db.cursor(name='temperatures') if args['stream'] else db.cursor()
+        try:
+            cur.execute(*(render(query, TEMPERATURE_JSON, page) if rendered else query.build()))
         except psycopg2.errors.DatabaseError:
             cur.close()
-            self.logger.error('query with args ' + str(args) + ' failed')
+            self.logger.error('query with args %s failed', args)
             return {}, 400
 
-        rows = cur.fetchall()
+        if args['stream']:
+            return stream_rows(cur, TEMPERATURE_COLUMNS, args['stream'], headers)
+
+        if rendered:
+            rows, next_headers = fetch_rendered(cur, page)
+        else:
+            rows, next_headers = page.finish(cur.fetchall())
+        headers.update(next_headers)
         cur.close()
 
         # Format response as a list of dictionaries
-        cols = ['id', 'valoare', 'timestamp']
-        rows = [dict(zip(cols, row)) for row in rows]
-        for row in rows:
-            row['timestamp'] = row['timestamp'].strftime("%Y-%m-%d")
-        self.logger.info('Selected rows: ' + str(rows))
+        if args['interval']:
+            rows = format_buckets(rows)
+        elif not rendered:
+            rows = format_temperatures(rows)
+        self.logger.info('Selected rows: %s', rows)
 
-        return rows, 200
+        return rows, 200, headers
@@ -1,57 +1,136 @@
 import datetime
 
 import psycopg2
-from flask_restful import Resource, reqparse
+from flask_restful import reqparse
 
+import Config
+from Conditional import not_modified, not_modified_response
+from DatabaseResource import DatabaseResource
+from Downsampling import BUCKET_KEYS, bucket_page, bucket_query, combine_buckets, format_buckets, parse_interval
+from Formatting import TEMPERATURE_COLUMNS, TEMPERATURE_JSON, format_temperatures
+from Pagination import Page, add_page_arguments
+from QueryBuilder import QueryBuilder
+from Rendering import fetch_rendered, render
+from ShardSet import sort_key
+from Streaming import FORMATS, requested_format, stream_rows
 
-class TemperaturesCountries(Resource):
-    def __init__(self, **kwargs):
-        self.logger = kwargs['logger']
-        self.db = kwargs['db']
+# Arguments of GET requests, parsed by a parser built once
+PARSER = reqparse.RequestParser()
+PARSER.add_argument('from', default=None, required=False, type=str, location='args')
+PARSER.add_argument('until', default=None, required=False, type=str, location='args')
+PARSER.add_argument('stream', default=None, required=False, type=str, choices=tuple(FORMATS), location='args')
+PARSER.add_argument('interval', default=None, required=False, type=parse_interval, location='args')
+add_page_arguments(PARSER)
 
-    def get(self, id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('from', default=None, required=False, type=str, location='args')
-        parser.add_argument('until', default=None, required=False, type=str, location='args')
 
-        args = parser.parse_args()
+class TemperaturesCountries(DatabaseResource):
+    # Listings are sorted by timestamp, then id
+    page_keys = [('tmp.timestamp', 2, datetime.datetime.fromisoformat), ('tmp.id', 0, int)]
+
+    # Query selecting the temperatures matching the parsed arguments of a GET request, on the given shard
+    def query(self, args, page, shard=None):
+        # The country is resolved to its cities by the in-memory city index, instead of joining Orase and Tari
+        city_ids = self.cities.country_cities(args['id'])
+        if shard is not None:
+            city_ids = self.shards.split(city_ids).get(shard, [])
+
+        # Archive segments before the requested dates and the page are skipped, and so are those after
+        # the segments holding enough readings to fill the page
+        query = QueryBuilder('SELECT tmp.id, tmp.valoare, tmp.timestamp '
+                             'FROM temperaturi_toate(%(segments_from)s, '
+                             'least(%(until)s, orizont_arhiva(%(segments_from)s, %(cities)s, %(rows)s))) tmp',
+                             {'segments_from': page.lower_bound(args['from']), 'until': args['until'],
+                              'cities': city_ids, 'rows': page.fetched()})
+        query.where('tmp.id_oras = ANY(%(cities)s)', {'cities': city_ids})
+        query.where('tmp.timestamp >= %(from)s', {'from': args['from']})
+        query.where('tmp.timestamp <= %(until)s', {'until': args['until']})
+        return page.apply(query)
+
+    # Whether the query of a request resolves cities with the city index
+    def needs_city_index(self, args):
+        return True
+
+    def get(self, id):
+        args = PARSER.parse_args()
         args['id'] = id
         if args['from']:
             try:
                 args['from'] = datetime.datetime.strptime(args['from'], '%Y-%m-%d')
             except ValueError:
-                self.logger.error(str(args['from']) + ' not a YYYY-MM-DD date')
+                self.logger.error('%s not a YYYY-MM-DD date', args['from'])
                 return {}, 400
         if args['until']:
             try:
                 args['until'] = datetime.datetime.strptime(args['until'], '%Y-%m-%d')
             except ValueError:
-                self.logger.error(str(args['until']) + ' not a YYYY-MM-DD date')
+                self.logger.error('%s not a YYYY-MM-DD date', args['until'])
                 return {}, 400
 
-        cur = self.db.cursor()
+        # Downsampled series are only sent as JSON, one bucket per interval
+        if args['interval'] and args['stream']:
+            self.logger.error('downsampled temperatures can not be streamed')
+            return {}, 400
+
+        # Formats other than JSON can also be asked for with the Accept header, and are always streamed
+        if not args['interval']:
+            args['stream'] = requested_format(args['stream'])
+
+        # Streamed responses are never paginated, they are meant for results of any size
         try:
-            cur.execute("""
-                        SELECT tmp.id, tmp.valoare, tmp.timestamp
-                        FROM Temperaturi tmp JOIN Orase o ON tmp.id_oras = o.id JOIN Tari t ON o.id_tara = t.id
-                        WHERE t.id = %(id)s
-                          AND (%(from)s IS NULL OR tmp.timestamp >= %(from)s)
-                          AND (%(until)s IS NULL OR tmp.timestamp <= %(until)s);
-                        """,
-                        args)
+            if args['interval']:
+                page = bucket_page(args)
+            else:
+                page = Page(args, self.page_keys, paginate=not args['stream'])
+        except ValueError as e:
+            self.logger.error('%s', e)
+            return {}, 400
+
+        # Readings of every shard are read in parallel and merged
+        shards = self.shards.indexes()
+        headers = self.shards.validators(shards, ['temperaturi', 'orase'], args['stream'])
+        headers['Vary'] = 'Accept'
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        self.cities.refresh(self.db)
+
+        # Unless streamed, the body can be rendered by the database, if a single shard holds it
+        rendered = Config.DB_JSON_RENDERING and not args['stream'] and not args['interval'] and len(shards) == 1
+
+        queries = {}
+        for shard in shards:
+            query = bucket_query(self, args, page, shard) if args['interval'] else self.query(args, page, shard)
+            # Rows of several shards are merged by timestamp, so each shard sorts its own
+            if len(shards) > 1 and not args['interval'] and not page.active():
+                query.order_by(', '.join(key[0] for key in self.page_keys))
+            queries[shard] = render(query, TEMPERATURE_JSON, page) if rendered else query.build()
+
+        # Streamed results are read through server-side cursors, in batches
+        try:
+            if args['interval']:
+                cur = self.shards.execute(queries, sort_key(BUCKET_KEYS), combine_buckets)
+            else:
+                cur = self.shards.execute(queries, sort_key(self.page_keys),
+                                          name='temperatures' if args['stream'] else None)
         except psycopg2.errors.DatabaseError:
-            cur.close()
-            self.logger.error('query with args ' + str(args) + ' failed')
+            self.logger.error('query with args %s failed', args)
             return {}, 400
 
-        rows = cur.fetchall()
+        if args['stream']:
+            return stream_rows(cur, TEMPERATURE_COLUMNS, args['stream'], headers)
+
+        if rendered:
+            rows, next_headers = fetch_rendered(cur, page)
+        else:
+            rows, next_headers = page.finish(cur.fetchall())
+        headers.update(next_headers)
         cur.close()
 
         # Format response as a list of dictionaries
-        cols = ['id', 'valoare', 'timestamp']
-        rows = [dict(zip(cols, row)) for row in rows]
-        for row in rows:
-            row['timestamp'] = row['timestamp'].strftime("%Y-%m-%d")
-        self.logger.info('Selected rows: ' + str(rows))
+        if args['interval']:
+            rows = format_buckets(rows)
+        elif not rendered:
+            rows = format_temperatures(rows)
+        self.logger.info('Selected rows: %s', rows)
 
-        return rows, 200
+        return rows, 200, headers
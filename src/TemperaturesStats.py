@@ -0,0 +1,96 @@
+import datetime
+import operator
+
+import psycopg2
+from flask_restful import reqparse
+
+from Conditional import not_modified, not_modified_response
+from DatabaseResource import DatabaseResource
+from Metrics import timed_phase
+from QueryBuilder import QueryBuilder
+
+# Rollup table and date format of every granularity
+GRANULARITIES = {
+    'hour': ('Agregate_Ore', '%Y-%m-%d %H:%M:%S'),
+    'day': ('Agregate_Zile', '%Y-%m-%d')
+}
+
+# Arguments of GET requests, parsed by a parser built once
+PARSER = reqparse.RequestParser()
+PARSER.add_argument('city', default=None, required=False, type=int, location='args')
+PARSER.add_argument('country', default=None, required=False, type=int, location='args')
+PARSER.add_argument('from', default=None, required=False, type=str, location='args')
+PARSER.add_argument('until', default=None, required=False, type=str, location='args')
+PARSER.add_argument('granularity', default='day', required=False, type=str, choices=tuple(GRANULARITIES),
+                    location='args')
+
+
+class TemperaturesStats(DatabaseResource):
+    # Query selecting the buckets matching the parsed arguments of a GET request
+    def query(self, args):
+        # Every bucket of the rollup table combines the rollups of the cities in scope
+        query = QueryBuilder('SELECT a.inceput, sum(a.numar)::bigint, sum(a.suma), min(a.minim), max(a.maxim) FROM '
+                             + GRANULARITIES[args['granularity']][0] + ' a')
+        if args['country'] is not None:
+            query.join('JOIN Orase o ON a.id_oras = o.id')
+            query.where('o.id_tara = %(country)s', {'country': args['country']})
+        query.where('a.id_oras = %(city)s', {'city': args['city']})
+        query.where('a.inceput >= %(from)s', {'from': args['from']})
+        query.where('a.inceput <= %(until)s', {'until': args['until']})
+        query.group_by('a.inceput')
+        return query.order_by('a.inceput')
+
+    # Combine the buckets of several shards starting at the same time into one
+    @staticmethod
+    def combine(rows):
+        return (rows[0][0], sum(row[1] for row in rows), sum(row[2] for row in rows),
+                min(row[3] for row in rows), max(row[4] for row in rows))
+
+    # Format buckets as a list of dictionaries
+    @timed_phase('shape')
+    def format(self, args, rows):
+        date_format = GRANULARITIES[args['granularity']][1]
+        return [{'timestamp': start.strftime(date_format), 'count': count, 'avg': total / count,
+                 'min': low, 'max': high}
+                for start, count, total, low, high in rows]
+
+    def get(self):
+        args = PARSER.parse_args()
+        if args['city'] is not None and args['country'] is not None:
+            self.logger.error('statistics can be scoped to either a city or a country')
+            return {}, 400
+        if args['from']:
+            try:
+                args['from'] = datetime.datetime.strptime(args['from'], '%Y-%m-%d')
+            except ValueError:
+                self.logger.error('%s not a YYYY-MM-DD date', args['from'])
+                return {}, 400
+        if args['until']:
+            try:
+                args['until'] = datetime.datetime.strptime(args['until'], '%Y-%m-%d')
+            except ValueError:
+                self.logger.error('%s not a YYYY-MM-DD date', args['until'])
+                return {}, 400
+
+        # Every shard holds the rollups of its cities, so only a city scope is read from a single shard
+        shards = [self.shards.city_shard(args['city'])] if args['city'] is not None else self.shards.indexes()
+
+        # Rollups are derived from Temperaturi, country scopes also depend on Orase
+        headers = self.shards.validators(shards, ['temperaturi', 'orase'])
+        if not_modified(headers):
+            return not_modified_response(headers)
+
+        try:
+            cur = self.shards.execute({shard: self.query(args).build() for shard in shards},
+                                      operator.itemgetter(0), self.combine)
+        except psycopg2.errors.DatabaseError:
+            self.logger.error('query with args %s failed', args)
+            return {}, 400
+
+        rows = cur.fetchall()
+        cur.close()
+
+        rows = self.format(args, rows)
+        self.logger.info('Selected rows: %s', rows)
+
+        return rows, 200, headers
@@ -0,0 +1,56 @@
+import queue
+
+from flask import Response
+from flask_restful import reqparse
+
+import Config
+from DatabaseResource import DatabaseResource
+from LiveFeed import EVENT_HEADERS, EVENT_STREAM, HEARTBEAT
+
+# Arguments of GET requests, parsed by a parser built once
+PARSER = reqparse.RequestParser()
+PARSER.add_argument('city', default=None, required=False, type=int, location='args')
+PARSER.add_argument('country', default=None, required=False, type=int, location='args')
+
+
+class TemperaturesStream(DatabaseResource):
+    # New readings of a city, of a country or of every city, pushed as server-sent events once committed.
+    # The stream holds no database connection, readings come from the live feed of the process.
+    def get(self):
+        args = PARSER.parse_args()
+        if args['city'] is not None and args['country'] is not None:
+            self.logger.error('live feeds can be scoped to either a city or a country')
+            return {}, 400
+
+        subscription = self.feed.subscribe(args['city'], args['country'])
+        if subscription is None:
+            self.logger.warning('too many live feed streams open, refusing a new one')
+            return {}, 503
+        self.logger.info('subscribed to readings of city=%s country=%s', args['city'], args['country'])
+
+        def events():
+            try:
+                while True:
+                    try:
+                        event = subscription.events.get(timeout=Config.LIVE_FEED_HEARTBEAT)
+                    except queue.Empty:
+                        event = HEARTBEAT
+                    if event is None:
+                        return
+                    yield event
+            finally:
+                self.feed.remove(subscription)
+
+        return Response(events(), status=200, mimetype=EVENT_STREAM, headers=EVENT_HEADERS)
+
+    # Headers of a stream, without subscribing: the body of a HEAD response is never read,
+    # so a subscription would never be removed
+    def head(self):
+        args = PARSER.parse_args()
+        if args['city'] is not None and args['country'] is not None:
+            self.logger.error('live feeds can be scoped to either a city or a country')
+            return {}, 400
+        if self.feed.full():
+            self.logger.warning('too many live feed streams open, refusing a new one')
+            return {}, 503
+        return Response(status=200, mimetype=EVENT_STREAM, headers=EVENT_HEADERS)
@@ -0,0 +1,195 @@
+import datetime
+import threading
+import time
+
+import psycopg2
+
+from Statements import execute, register
+from Temperatures import INSERT_STATEMENT
+from TemperaturesBatch import INSERT_STATEMENT as INSERT_BATCH_STATEMENT
+
+# Timestamp of the group transaction and the cities of the group that exist
+GROUP_QUERY = 'SELECT localtimestamp, ARRAY(SELECT id FROM Orase WHERE id = ANY(%(cities)s));'
+GROUP_STATEMENT = register('citeste_grup', GROUP_QUERY)
+
+
+class Reading:
+    # Reading of a single POST request, waiting for the group commit that holds it
+    def __init__(self, temp):
+        self.temp = temp
+        self.arrived = time.monotonic()
+        self.status = None
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+
+        # Readings whose city is not an integer are left to a single insert, which handles them as before
+        city_id = float(temp['idOras'])
+        self.city_id = int(city_id) if city_id.is_integer() else None
+        self.value = float(temp['valoare'])
+
+
+class WriteBehind:
+    # Queue of single readings, inserted by a background thread with one multi-row statement
+    # and one commit per group and shard. A group is written once max_batch readings are queued,
+    # or interval seconds after its first reading was queued.
+    def __init__(self, logger, shards, max_batch, interval):
+        self.logger = logger
+        self.shards = shards
+        self.max_batch = max_batch
+        self.interval = interval
+
+        self.queue = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    # Queue a reading checked by the Temperatures resource and wait until its group is committed,
+    # returning its status and id. Errors of the group, like an exhausted pool, are raised again.
+    def submit(self, temp):
+        reading = Reading(temp)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('write-behind queue is closed')
+            self.queue.append(reading)
+            if len(self.queue) == 1 or len(self.queue) >= self.max_batch:
+                self.cond.notify()
+
+        reading.done.wait()
+        if reading.error:
+            raise reading.error
+        return reading.status, reading.id
+
+    # Take the next group off the queue, once it is full or old enough.
+    # Returns None once the queue is closed and empty.
+    def next_group(self):
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            if not self.queue:
+                return None
+
+            deadline = self.queue[0].arrived + self.interval
+            while len(self.queue) < self.max_batch and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            group, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+            return group
+
+    def run(self):
+        while True:
+            group = self.next_group()
+            if group is None:
+                return
+            self.write(group)
+
+    # Write a group, the readings of every shard together, releasing their requests once they are committed
+    def write(self, group):
+        shards = {}
+        for reading in group:
+            shards.setdefault(self.shards.city_shard(reading.city_id), []).append(reading)
+        for shard, readings in shards.items():
+            self.write_shard(self.shards.pools[shard], readings)
+
+    def write_shard(self, pool, group):
+        try:
+            conn = pool.getconn()
+        except Exception as e:
+            for reading in group:
+                reading.error = e
+                reading.done.set()
+            return
+
+        try:
+            try:
+                irregular = self.insert_group(conn, group)
+            except psycopg2.Error:
+                conn.rollback()
+                # A reading failed the whole statement, so the group is inserted one reading at a time
+                self.logger.warning('group of %s temperatures failed, inserting them one by one', len(group))
+                irregular = group
+            for reading in irregular:
+                self.insert_one(conn, reading)
+        except Exception as e:
+            for reading in group:
+                if reading.status is None:
+                    reading.error = e
+        finally:
+            pool.putconn(conn)
+            for reading in group:
+                reading.done.set()
+
+    # Insert the readings of a group with a single statement, with the same statuses as single inserts:
+    # 400 for unknown cities and 409 for readings of a city at an existing timestamp.
+    # Returns the readings that have to be inserted on their own.
+    def insert_group(self, conn, group):
+        regular = [reading for reading in group if reading.city_id is not None]
+        irregular = [reading for reading in group if reading.city_id is None]
+        if not regular:
+            return irregular
+
+        cur = conn.cursor()
+        started = time.monotonic()
+        execute(cur, GROUP_STATEMENT, {'cities': list({reading.city_id for reading in regular})})
+        now, cities = cur.fetchone()
+        cities = set(cities)
+
+        # Every reading is timestamped with the time it was received, on the clock of the database
+        pending = {}
+        statuses = {}
+        for reading in regular:
+            if reading.city_id not in cities:
+                statuses[reading] = 400
+                continue
+            key = (reading.city_id, now - datetime.timedelta(seconds=started - reading.arrived))
+            if key in pending:
+                statuses[reading] = 409
+                continue
+            pending[key] = reading
+
+        inserted = []
+        if pending:
+            execute(cur, INSERT_BATCH_STATEMENT, {'values': [reading.value for reading in pending.values()],
+                                                  'timestamps': [key[1] for key in pending],
+                                                  'cities': [key[0] for key in pending]})
+            inserted = cur.fetchall()
+        cur.close()
+        conn.commit()
+
+        # Readings that were not returned by the insert already exist in the table
+        ids = {(city_id, timestamp): temp_id for temp_id, city_id, timestamp in inserted}
+        for key, reading in pending.items():
+            reading.status, reading.id = (201, ids[key]) if key in ids else (409, None)
+        for reading, status in statuses.items():
+            reading.status = status
+        self.logger.info('group of %s temperatures committed', len(group))
+        return irregular
+
+    # Insert a reading like the Temperatures resource does without write-behind
+    def insert_one(self, conn, reading):
+        cur = conn.cursor()
+        try:
+            execute(cur, INSERT_STATEMENT, reading.temp)
+            reading.id = cur.fetchone()[0]
+            conn.commit()
+            reading.status = 201
+        except psycopg2.errors.UniqueViolation:
+            conn.rollback()
+            reading.status = 409
+        except psycopg2.errors.DatabaseError:
+            conn.rollback()
+            self.logger.error('%s could not be inserted in database', reading.temp)
+            reading.status = 400
+        finally:
+            cur.close()
+
+    # Stop queueing readings and wait for the queued ones to be written
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
@@ -3,44 +3,105 @@ import signal
 
 from flask import Flask
 from flask_restful import Api
-import psycopg2
 
+import Config
+from Cache import Cache
+from CacheStats import CacheStats
 from Cities import Cities
 from CitiesCountry import CitiesCountry
+from CityIndex import CityIndex
+from ConnectionPool import ConnectionPool
 from Countries import Countries
+from LiveFeed import LiveFeed
+from Metrics import Metrics
+from MetricsExport import MetricsExport
+from Rendering import output_json
+from ReplicaRouter import ReplicaRouter, parse_hosts
+from Retention import Retention
+from ShardSet import ShardSet
 from TemperaturesCities import TemperaturesCities
 from TemperaturesCountries import TemperaturesCountries
+from TemperaturesStats import TemperaturesStats
 from Temperatures import Temperatures
+from TemperaturesBatch import TemperaturesBatch
+from TemperaturesStream import TemperaturesStream
+from WriteBehind import WriteBehind
 
 
-def handler(signum, frame):
-    global app
-    global conn
-
-    if conn:
-        app.logger.info("Database connection closed")
-        conn.close()
-    if app:
-        app.logger.info("Shutting down")
-    exit()
-
-
-if __name__ == '__main__':
-    signal.signal(signal.SIGINT, handler)
-    logging.basicConfig(level=logging.WARN)
-
+# Create the Flask application, with its own pool of database connections
+def create_app():
     app = Flask(__name__)
     api = Api(app)
-
-    app.logger.info('Connecting to database')
-    conn = psycopg2.connect(
-        host='postgresql',
-        database='measurements',
-        user='pgsql',
-        password='pgsql'
+    # Bodies rendered by the database are sent without being encoded again
+    api.representation('application/json')(output_json)
+
+    pool = ConnectionPool(
+        app.logger,
+        Config.DB_POOL_MIN,
+        Config.DB_POOL_MAX,
+        Config.DB_POOL_TIMEOUT,
+        Config.DB_POOL_CHECK_INTERVAL,
+        host=Config.DB_HOST,
+        database=Config.DB_NAME,
+        user=Config.DB_USER,
+        password=Config.DB_PASSWORD
     )
 
-    kwargs = {'logger': app.logger, 'db': conn}
+    # Reads are spread over the replicas, whose pools connect on first use so that they can start later
+    replicas = [ConnectionPool(app.logger, 0, Config.DB_POOL_MAX, Config.DB_POOL_TIMEOUT,
+                               Config.DB_POOL_CHECK_INTERVAL, database=Config.DB_NAME, user=Config.DB_USER,
+                               password=Config.DB_PASSWORD, **replica)
+                for replica in parse_hosts(Config.DB_REPLICA_HOSTS)]
+    router = ReplicaRouter(app.logger, pool, replicas, Config.DB_REPLICA_RETRY, Config.DB_REPLICA_WAIT,
+                           Config.DB_READ_YOUR_WRITES)
+    router.init_app(app)
+    app.extensions['router'] = router
+
+    # Readings are spread over the primary database and the shards, which all hold the countries and cities
+    shard_pools = [pool] + [ConnectionPool(app.logger, Config.DB_POOL_MIN, Config.DB_POOL_MAX, Config.DB_POOL_TIMEOUT,
+                                           Config.DB_POOL_CHECK_INTERVAL, database=Config.DB_NAME,
+                                           user=Config.DB_USER, password=Config.DB_PASSWORD, **shard)
+                            for shard in parse_hosts(Config.DB_SHARD_HOSTS)]
+    shards = ShardSet(app.logger, router, shard_pools)
+    shards.init_app(app)
+    shards.prepare()
+    app.extensions['shards'] = shards
+
+    # Coordinates of every city, kept in memory for coordinate lookups
+    cities = CityIndex(app.logger, Config.CITY_INDEX_CELL_SIZE, Config.CITY_INDEX_REFRESH)
+    conn = pool.getconn()
+    try:
+        cities.load(conn)
+    finally:
+        pool.putconn(conn)
+
+    # Country and city listings, invalidated by the write handlers
+    cache = Cache(Config.METADATA_CACHE_SIZE, Config.METADATA_CACHE_TTL)
+
+    # Timings, row counts and sizes of every request
+    metrics = Metrics()
+    metrics.init_app(app)
+
+    # Single readings can be queued and inserted in groups, by a thread of this application
+    writer = None
+    if Config.WRITE_BEHIND:
+        writer = WriteBehind(app.logger, shards, Config.WRITE_BEHIND_BATCH, Config.WRITE_BEHIND_INTERVAL / 1000)
+    app.extensions['writer'] = writer
+
+    # Old readings of every shard are moved to its archive segments in the background
+    retention = []
+    if Config.ARCHIVE_AFTER_DAYS > 0:
+        retention = [Retention(app.logger, shard_pool, Config.ARCHIVE_AFTER_DAYS, Config.ARCHIVE_INTERVAL)
+                     for shard_pool in shard_pools]
+    app.extensions['retention'] = retention
+
+    # New readings published by the database, pushed to the subscribers of this process
+    feed = LiveFeed(app.logger, Config.LIVE_FEED_QUEUE_SIZE, Config.LIVE_FEED_RETRY, Config.LIVE_FEED_MAX_STREAMS,
+                    [shard_pool.dsn for shard_pool in shard_pools])
+    app.extensions['feed'] = feed
+
+    kwargs = {'logger': app.logger, 'router': router, 'cities': cities, 'cache': cache, 'metrics': metrics,
+              'writer': writer, 'feed': feed, 'shards': shards}
     api.add_resource(Countries, '/api/countries', endpoint='countries',
                      resource_class_kwargs=kwargs)
     api.add_resource(Countries, '/api/countries/<int:id>', endpoint='countries_id',
@@ -54,15 +115,75 @@ if __name__ == '__main__':
     api.add_resource(CitiesCountry, '/api/cities/country/<int:id>', endpoint='cities_country_id',
                      resource_class_kwargs=kwargs)
 
+    api.add_resource(CacheStats, '/api/cache', endpoint='cache',
+                     resource_class_kwargs=kwargs)
+
+    api.add_resource(MetricsExport, '/metrics', endpoint='metrics',
+                     resource_class_kwargs=kwargs)
+
     api.add_resource(Temperatures, '/api/temperatures', endpoint='temperatures',
                      resource_class_kwargs=kwargs)
     api.add_resource(Temperatures, '/api/temperatures/<int:id>', endpoint='temperatures_id',
                      resource_class_kwargs=kwargs)
 
+    api.add_resource(TemperaturesBatch, '/api/temperatures/batch', endpoint='temperatures_batch',
+                     resource_class_kwargs=kwargs)
+
+    api.add_resource(TemperaturesStream, '/api/temperatures/stream', endpoint='temperatures_stream',
+                     resource_class_kwargs=kwargs)
+
+    api.add_resource(TemperaturesStats, '/api/temperatures/stats', endpoint='temperatures_stats',
+                     resource_class_kwargs=kwargs)
+
+    api.add_resource(TemperaturesCities, '/api/temperatures/cities',
+                     endpoint='temperatures_cities_batch', resource_class_kwargs=kwargs)
     api.add_resource(TemperaturesCities, '/api/temperatures/cities/<int:id>',
                      endpoint='temperatures_cities', resource_class_kwargs=kwargs)
 
     api.add_resource(TemperaturesCountries, '/api/temperatures/countries/<int:id>',
                      endpoint='temperatures_countries', resource_class_kwargs=kwargs)
 
+    return app
+
+
+# Close the database connections of an application, once it no longer serves requests
+def shutdown(app):
+    # Queued readings are written before the connections are closed
+    if app.extensions['writer']:
+        app.extensions['writer'].close()
+    # Live feed streams are ended, so that their clients reconnect to another process
+    app.extensions['feed'].close()
+    for retention in app.extensions['retention']:
+        retention.close()
+    app.logger.info("Database connections closed")
+    app.extensions['shards'].closeall()
+    app.extensions['router'].closeall()
+
+
+def handler(signum, frame):
+    global app
+
+    if app:
+        shutdown(app)
+        app.logger.info("Shutting down")
+    exit()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARN)
+
+    # The asyncio server handles its own signals and database connections
+    if Config.SERVER_MODE == 'async':
+        import AsyncServer
+        AsyncServer.run(logging.getLogger('WeatherStation'))
+        exit()
+
+    # The production server creates one application per worker process, after forking
+    if Config.SERVER_MODE == 'production':
+        from ProductionServer import ProductionServer
+        ProductionServer(create_app, shutdown).run()
+        exit()
+
+    signal.signal(signal.SIGINT, handler)
+    app = create_app()
     app.run(host='0.0.0.0', port=5000)